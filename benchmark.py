@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmark of the pipeline stages against a local mock hub.
+
+    python benchmark.py --scale small medium --save bench.json
+    python benchmark.py --scale small medium --compare bench.json
+
+Starts mock_hub.py once per scale and runs export_to_vote,
+create_choices_json and the filter stages against it, reporting wall time,
+number of hub requests, bytes received and peak python memory per stage.
+"""
+
+import argparse, contextlib, json, os, socket, subprocess, sys, tempfile, time
+import tracemalloc, urllib.request
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# size of the synthetic hub per scale (see mock_hub.py for all options)
+SCALES = {
+    'small': {'wallets': 50, 'spaces': 20, 'votes': 200},
+    'medium': {'wallets': 200, 'spaces': 50, 'votes': 1000},
+    'large': {'wallets': 1000, 'spaces': 200, 'votes': 5000},
+}
+LATENCY = 0.02        # seconds added to every hub response
+TOLERANCE = 0.25      # max. relative slowdown before --compare fails
+TRIGGERS = ['bot', 'sybil', 'human', 'Do not vote', 'Don\'t vote']
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class MockHub:
+    '''
+    Runs mock_hub.py in a subprocess for the duration of a with block.
+    Exposes the graphql url, the wallet file and the hub's request stats.
+    '''
+
+    def __init__(self, workdir, latency=LATENCY, **options):
+        self.port = free_port()
+        self.url = f'http://127.0.0.1:{self.port}'
+        self.wallet_path = os.path.join(workdir, 'wallets.txt')
+        self.args = [
+            sys.executable, os.path.join(HERE, 'mock_hub.py'),
+            '--port', str(self.port), '--latency', str(latency),
+            '--write-wallets', self.wallet_path,
+        ]
+        for key, value in options.items():
+            self.args += ['--' + key.replace('_', '-'), str(value)]
+        self.proc = None
+
+    def __enter__(self):
+        self.proc = subprocess.Popen(
+                self.args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+                )
+        deadline = time.time() + 60
+        while True:
+            try:
+                self.stats()
+                return self
+            except OSError:
+                if self.proc.poll() is not None:
+                    raise RuntimeError(self.proc.stderr.read().decode())
+                if time.time() > deadline:
+                    raise RuntimeError('Mock hub did not start.')
+                time.sleep(0.1)
+
+    def __exit__(self, *exc):
+        self.proc.terminate()
+        self.proc.wait()
+
+    def stats(self):
+        with urllib.request.urlopen(self.url + '/stats') as r:
+            return json.load(r)
+
+    def reset_stats(self):
+        req = urllib.request.Request(self.url + '/stats/reset', method='POST')
+        urllib.request.urlopen(req).close()
+
+
+def run_stages(hub, workdir):
+    '''
+    Runs all stages once against the hub, starting with empty files, an
+    empty proposal cache and an empty vote store. Whatever the stages print is discarded.
+    Returns list of dicts, one per stage.
+    '''
+    import query_engine
+    import functions
+
+    query_engine.configure(url=hub.url + '/graphql')
+    functions.logging = False
+    if functions._prop_cache is not None:
+        functions._prop_cache.close()
+    functions._prop_cache = None
+    functions.PROP_CACHE_PATH = os.path.join(workdir, 'proposal_cache.db')
+    functions.VOTE_STORE_PATH = os.path.join(workdir, 'vote_history.db')
+
+    paths = {
+        name: os.path.join(workdir, name)
+        for name in ['already_voted.json', 'to_vote.json', 'choices.json']
+    }
+    for path in list(paths.values()) + [functions.PROP_CACHE_PATH,
+                                        functions.VOTE_STORE_PATH]:
+        if os.path.isfile(path):
+            os.remove(path)
+
+    stages = [
+        ('export_to_vote', lambda: functions.export_to_vote(
+            hub.wallet_path, paths['already_voted.json'], paths['to_vote.json'])),
+        ('create_choices_json', lambda: functions.create_choices_json(
+            paths['to_vote.json'], paths['choices.json'])),
+        ('filter_out_bot_catcher_proposals', lambda: functions.
+            filter_out_bot_catcher_proposals(paths['choices.json'], TRIGGERS)),
+        ('enable_weighted_vote', lambda: functions.enable_weighted_vote(
+            paths['choices.json'])),
+        ('filter_out_low_engagement_props', lambda: functions.
+            filter_out_low_engagement_props(paths['choices.json'])),
+    ]
+
+    results = []
+    for name, stage in stages:
+        hub.reset_stats()
+        tracemalloc.start()
+        started = time.perf_counter()
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            stage()
+        wall = time.perf_counter() - started
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        stats = hub.stats()
+        results.append({
+            'stage': name,
+            'wall_s': round(wall, 3),
+            'requests': stats['requests'],
+            'bytes': stats['bytes_sent'],
+            'peak_mb': round(peak / 1024**2, 2),
+        })
+    return results
+
+
+def benchmark(scales, repeat=1, latency=LATENCY):
+    '''
+    Returns dict of shape {scale: [stage result, ...], ...}. With repeat > 1
+    every stage reports its fastest run.
+    '''
+    out = {}
+    for scale in scales:
+        with tempfile.TemporaryDirectory() as workdir:
+            with MockHub(workdir, latency=latency, **SCALES[scale]) as hub:
+                runs = [run_stages(hub, workdir) for _ in range(repeat)]
+        out[scale] = [
+            min(stage_runs, key=lambda r: r['wall_s'])
+            for stage_runs in zip(*runs)
+        ]
+    return out
+
+
+def print_results(results, baseline=None):
+    header = f'{"scale":<8}{"stage":<34}{"wall s":>9}{"requests":>10}{"MB recv":>10}{"peak MB":>10}'
+    print(header)
+    print('-' * len(header))
+    for scale, stages in results.items():
+        for r in stages:
+            line = (f'{scale:<8}{r["stage"]:<34}{r["wall_s"]:>9.3f}{r["requests"]:>10}'
+                    f'{r["bytes"] / 1024**2:>10.2f}{r["peak_mb"]:>10.2f}')
+            old = find_stage(baseline, scale, r['stage'])
+            if old is not None and old['wall_s'] > 0:
+                line += f'  ({r["wall_s"] / old["wall_s"] - 1:+.0%} vs baseline)'
+            print(line)
+
+
+def find_stage(results, scale, stage):
+    for r in (results or {}).get(scale, []):
+        if r['stage'] == stage:
+            return r
+    return None
+
+
+def regressions(results, baseline, tolerance=TOLERANCE):
+    '''
+    Returns list of messages for every stage that got slower than the
+    baseline by more than {tolerance}, or sends more requests.
+    '''
+    out = []
+    for scale, stages in results.items():
+        for r in stages:
+            old = find_stage(baseline, scale, r['stage'])
+            if old is None:
+                continue
+            if r['wall_s'] > old['wall_s'] * (1 + tolerance):
+                out.append(f'{scale}/{r["stage"]}: {old["wall_s"]}s -> {r["wall_s"]}s')
+            if r['requests'] > old['requests']:
+                out.append(f'{scale}/{r["stage"]}: {old["requests"]} -> {r["requests"]} requests')
+    return out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--scale', nargs='+', choices=SCALES, default=['small'])
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--latency', type=float, default=LATENCY)
+    parser.add_argument('--save', default=None, help='write results to this json file')
+    parser.add_argument('--compare', default=None, help='json file of an earlier run')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args(argv)
+
+    sys.path.insert(0, HERE)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = benchmark(args.scale, repeat=args.repeat, latency=args.latency)
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if baseline is not None:
+        found = regressions(results, baseline, args.tolerance)
+        for msg in found:
+            print('REGRESSION', msg)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
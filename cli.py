@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Runs the whole pipeline or a single stage of it from the command line.
+
+    python cli.py run              # same as snapshotQuery.py
+    python cli.py export           # wallets.txt -> to_vote.json
+    python cli.py choices          # to_vote.json -> choices.json
+    python cli.py filter           # drops proposals from choices.json
+    python cli.py weighted         # fixes choices of weighted votes in choices.json
+    python cli.py csv              # to_vote.json -> to_vote.csv
+
+Paths and settings default to those in snapshotQuery.py. Each stage only
+imports what it needs, so single-stage reruns and short cron invocations
+start quickly (the stages working on local files don't load the query
+engine at all).
+"""
+
+import argparse, os, sys
+
+
+def load_config(args):
+    '''Returns the settings of snapshotQuery.py, overridden by the arguments.'''
+    import snapshotQuery as config
+    for name in ('wallet_path', 'already_voted_path', 'export_json_path',
+                 'choices_json_path', 'export_csv_path', 'workers'):
+        value = getattr(args, name, None)
+        if value is not None:
+            setattr(config, name, value)
+    if getattr(args, 'normalized', False):
+        config.normalized_choices = True
+    if args.quiet:
+        import functions
+        functions.logging = False
+    if args.hub is not None:
+        os.environ['SNAPSHOT_HUB_URL'] = args.hub
+        if 'query_engine' in sys.modules:
+            sys.modules['query_engine'].configure(url=args.hub)
+    return config
+
+
+def run(args):
+    from functions import run_pipeline
+    config = load_config(args)
+    run_pipeline(
+        config.wallet_path, config.already_voted_path,
+        config.export_json_path, config.choices_json_path,
+        export_csv_path=config.export_csv_path, triggers=config.triggers,
+        low_engagement=not args.no_low_engagement,
+        state_path=config.sync_state_path, metrics_path=config.metrics_path,
+        normalized=config.normalized_choices, workers=config.workers
+    )
+
+
+def export(args):
+    from functions import export_to_vote
+    config = load_config(args)
+    export_to_vote(
+        config.wallet_path, config.already_voted_path,
+        config.export_json_path, workers=config.workers, seed=args.seed
+    )
+
+
+def choices(args):
+    from functions import create_choices_json
+    config = load_config(args)
+    create_choices_json(
+        config.export_json_path, config.choices_json_path,
+        normalized=config.normalized_choices, workers=config.workers
+    )
+
+
+def filter_(args):
+    from functions import rewrite_choices, ProposalFilter
+    config = load_config(args)
+    triggers = config.triggers if args.trigger is None else args.trigger
+    prop_filter = ProposalFilter(
+            triggers=triggers, low_engagement=not args.no_low_engagement,
+            search_body=args.body
+            )
+    rewrite_choices(config.choices_json_path, prop_filter.apply)
+
+
+def weighted(args):
+    from functions import enable_weighted_vote
+    config = load_config(args)
+    enable_weighted_vote(config.choices_json_path)
+
+
+def csv(args):
+    from functions import export_readable_csv
+    config = load_config(args)
+    export_readable_csv(config.export_json_path, config.export_csv_path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description=__doc__.split('\n\n')[0],
+            formatter_class=argparse.RawDescriptionHelpFormatter,
+            epilog=__doc__.split('\n\n', 1)[1]
+            )
+    parser.add_argument('--hub', default=None,
+                        help='graphql endpoint (default: $SNAPSHOT_HUB_URL or hub.snapshot.org)')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='no log messages')
+    stages = parser.add_subparsers(dest='stage', metavar='stage', required=True)
+
+    def stage(name, func, help, paths):
+        sub = stages.add_parser(name, help=help)
+        for path in paths:
+            sub.add_argument('--' + path.replace('_path', '').replace('_', '-'),
+                             dest=path, default=None, metavar='PATH')
+        sub.set_defaults(func=func)
+        return sub
+
+    sub = stage('run', run, 'run all stages (same as snapshotQuery.py)',
+                ['wallet_path', 'already_voted_path', 'export_json_path',
+                 'choices_json_path', 'export_csv_path'])
+    sub.add_argument('--workers', type=int, default=None)
+    sub.add_argument('--normalized', action='store_true',
+                     help='write choices.json in the normalized format')
+    sub.add_argument('--no-low-engagement', action='store_true',
+                     help='keep proposals with low engagement')
+
+    sub = stage('export', export, 'query the proposals each wallet can vote on',
+                ['wallet_path', 'already_voted_path', 'export_json_path'])
+    sub.add_argument('--workers', type=int, default=None)
+    sub.add_argument('--seed', type=int, default=None,
+                     help='seed of the random selection for diversity')
+
+    sub = stage('choices', choices, 'tally the most popular choice of each proposal',
+                ['export_json_path', 'choices_json_path'])
+    sub.add_argument('--workers', type=int, default=None)
+    sub.add_argument('--normalized', action='store_true',
+                     help='write choices.json in the normalized format')
+
+    sub = stage('filter', filter_, 'drop ignored, trigger word and low engagement proposals',
+                ['choices_json_path'])
+    sub.add_argument('--trigger', action='append', default=None,
+                     help='trigger word (repeatable, default: triggers of snapshotQuery.py)')
+    sub.add_argument('--body', action='store_true',
+                     help='also look for trigger words in the proposal bodies')
+    sub.add_argument('--no-low-engagement', action='store_true',
+                     help='keep proposals with low engagement (no queries)')
+
+    stage('weighted', weighted, 'convert choices of weighted votes to dictionaries',
+          ['choices_json_path'])
+    stage('csv', csv, 'write to_vote.csv with the space names of the proposals',
+          ['export_json_path', 'export_csv_path'])
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Long-running alternative to launching snapshotQuery.py from cron.
+
+    python daemon.py
+
+Keeps the sync state, proposal cache and connections of one process
+warm and writes the same output files as snapshotQuery.py after every
+cycle. Paths and settings are read from snapshotQuery.py. Spaces and
+proposals are re-checked on their own schedule (see PollScheduler):
+often close to a proposal's end, rarely for spaces without activity.
+"""
+
+import argparse, signal, threading, time, traceback
+from delta_sync import SyncState, FULL_SYNC_EVERY
+from functions import (
+        cond_log, load_wallets, select_to_vote, build_choices,
+        finish_pipeline, query_metrics
+        )
+
+
+MIN_INTERVAL = 60             # seconds, never poll anything more often
+MAX_INTERVAL = 3600           # seconds, never poll anything more rarely
+ACTIVE_SPACE_INTERVAL = 600   # seconds between checks of spaces with open proposals
+WALLET_INTERVAL = 300         # seconds between syncs of follows and votes of the wallets
+DEADLINE_SHARE = 0.25         # poll again after this share of the time left until a deadline
+
+
+def clamp(seconds):
+    return min(MAX_INTERVAL, max(MIN_INTERVAL, seconds))
+
+
+def until(deadline, now):
+    '''Seconds until the next check, given the next deadline.'''
+    return clamp((deadline - now) * DEADLINE_SHARE)
+
+
+class PollScheduler:
+    '''
+    Keeps the time of the next check for every space (new proposals) and
+    every open proposal (new votes), derived from the proposals' start
+    and end timestamps:
+    - an active proposal is re-tallied after {DEADLINE_SHARE} of the time
+      left until its end, so checks get denser towards the deadline
+    - a space with open proposals is checked at least every
+      {ACTIVE_SPACE_INTERVAL} seconds, a space without any every
+      {MAX_INTERVAL} seconds
+    All intervals are clamped to [MIN_INTERVAL, MAX_INTERVAL]. Proposals
+    starting or ending are events of their own, since they change the
+    output even if nothing has to be queried.
+    '''
+
+    def __init__(self):
+        self.next_space = {}
+        self.next_prop = {}
+
+    def due_spaces(self, now, known=()):
+        '''Spaces whose check is due, including known ones never scheduled.'''
+        return {s for s, t in self.next_space.items() if t <= now} | \
+            {s for s in known if s not in self.next_space}
+
+    def due_props(self, now, known=()):
+        '''Proposals whose check is due, including known ones never scheduled.'''
+        return {p for p, t in self.next_prop.items() if t <= now} | \
+            {p for p in known if p not in self.next_prop}
+
+    def plan(self, props, spaces, checked_spaces, checked_props, now):
+        '''
+        Takes the open proposals of the sync state {prop_id: [space, start,
+        end]}, all tracked spaces and what has just been checked. Schedules
+        the next check of everything just checked or not scheduled yet.
+        '''
+        open_ends = {}
+        for _id, (space, start, end) in props.items():
+            open_ends[space] = min(open_ends.get(space, end), end)
+
+        for space in spaces:
+            if space in checked_spaces or space not in self.next_space:
+                if space in open_ends:
+                    wait = min(ACTIVE_SPACE_INTERVAL, until(open_ends[space], now))
+                else:
+                    wait = MAX_INTERVAL
+                self.next_space[space] = now + wait
+        for space in set(self.next_space) - set(spaces):
+            del self.next_space[space]
+
+        for _id, (space, start, end) in props.items():
+            if _id in checked_props or _id not in self.next_prop:
+                self.next_prop[_id] = now + until(end, now)
+        for _id in set(self.next_prop) - set(props):
+            del self.next_prop[_id]
+
+    def next_wakeup(self, props, now):
+        '''Returns time of the next check or proposal start/end.'''
+        events = [now + WALLET_INTERVAL]
+        events += self.next_space.values()
+        events += self.next_prop.values()
+        events += [t for _, start, end in props.values()
+                   for t in (start, end) if t > now]
+        return max(now + 1, min(events))
+
+
+class Daemon:
+    '''
+    Runs the incremental pipeline (as run_pipeline with a state_path) in
+    cycles, sleeping until the next scheduled check in between.
+
+    daemon = Daemon(config)
+    daemon.run()
+    '''
+
+    def __init__(self, config):
+        self.config = config
+        self.state = SyncState(config.sync_state_path)
+        self.scheduler = PollScheduler()
+        self._stop = threading.Event()
+
+    def stop(self, *args):
+        '''Lets the current cycle finish, then ends run().'''
+        self._stop.set()
+
+    def cycle(self):
+        '''
+        Syncs what is due and writes all output files. Returns the number
+        of seconds until the next cycle is due.
+        '''
+        config = self.config
+        now = time.time()
+        query_metrics().reset()
+
+        # rebuild the state from scratch once a day (see SyncState)
+        if now - self.state.state['full_sync'] > FULL_SYNC_EVERY:
+            self.state.save()
+            self.state = SyncState(config.sync_state_path)
+            self.scheduler = PollScheduler()
+
+        # after a restart, everything in the saved state is due once
+        known_spaces = set(self.state.state['proposals']['watermarks'])
+        known_props = set(self.state.state['tallies'])
+        due_spaces = self.scheduler.due_spaces(now, known_spaces)
+        due_props = self.scheduler.due_props(now, known_props)
+
+        wallets = load_wallets(config.wallet_path)
+        spaces_d, active_d, voted_d = self.state.sync_wallets(
+                wallets, due_spaces=due_spaces
+                )
+        to_vote_d = select_to_vote(wallets, voted_d, spaces_d, active_d)
+        props = {p for prop_list in to_vote_d.values() for p in prop_list}
+        prop_data_d = self.state.sync_tallies(props, due=due_props)
+        choices = build_choices(to_vote_d, prop_data_d)
+        self.state.save()
+
+        finish_pipeline(
+                to_vote_d, choices, config.export_json_path,
+                config.choices_json_path, config.export_csv_path,
+                config.triggers, True, config.normalized_choices
+                )
+        if config.metrics_path is not None:
+            query_metrics().write_prometheus(config.metrics_path)
+
+        # everything new to the state has just been queried as well
+        open_props = self.state.state['proposals']['props']
+        spaces = set().union(*spaces_d.values())
+        self.scheduler.plan(
+                open_props, spaces,
+                due_spaces | (spaces - known_spaces),
+                due_props | (props - known_props),
+                now
+                )
+        wakeup = self.scheduler.next_wakeup(open_props, time.time())
+        cond_log(f'\nNext check in {wakeup - time.time():.0f}s.')
+        return wakeup - time.time()
+
+    def run(self, max_cycles=None):
+        '''
+        Runs cycles until stopped (SIGINT/SIGTERM) or after max_cycles.
+        A failed cycle (e.g. the hub not answering after all retries) is
+        logged, the state is saved and the next cycle is tried after a
+        backoff of MIN_INTERVAL seconds, doubled with every further
+        failure up to MAX_INTERVAL.
+        '''
+        n = 0
+        failures = 0
+        while not self._stop.is_set():
+            try:
+                wait = self.cycle()
+                failures = 0
+            except Exception:
+                traceback.print_exc()
+                self.state.save()
+                wait = min(MAX_INTERVAL, MIN_INTERVAL * 2**failures)
+                failures += 1
+                print(f'\nCycle failed, next try in {wait}s.')
+            n += 1
+            if max_cycles is not None and n >= max_cycles:
+                break
+            self._stop.wait(wait)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--state', default=None,
+                        help='sync state file (default: sync_state_path of snapshotQuery.py or ./sync_state.json)')
+    parser.add_argument('--max-cycles', type=int, default=None)
+    args = parser.parse_args(argv)
+
+    import snapshotQuery as config
+    config.sync_state_path = args.state or config.sync_state_path or './sync_state.json'
+
+    daemon = Daemon(config)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.run(max_cycles=args.max_cycles)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Incremental (delta) sync of follows, proposals and votes between runs
+"""
+
+import os, json, time
+from query_builder import Query, query
+from functions import (
+        read_from_json, write_atomic, cond_log, chunks, json_from_queries,
+        paginate_queries, follows_many_query, get_joined_spaces_many,
+        voted_matrix_query, already_voted_many, get_prop_meta_many,
+        tally_votes_many, VoteTally, PAGE_SIZE, WALLET_CHUNK, SPACE_CHUNK
+        )
+
+
+FULL_SYNC_EVERY = 24 * 3600   # seconds until the state is rebuilt from scratch
+MARGIN = 60                   # seconds of overlap when a watermark is a clock time
+PROPOSAL_FIELDS = ['id', 'created', 'start', 'end', {'space': ['id']}]
+
+
+def open_proposals_query(spaces, now):
+    '''
+    Returns function building a paginated graphql query for all proposals
+    of the given spaces that haven't ended yet (see paginate_queries).
+    '''
+    spaces = list(spaces)
+
+    def build_query(first, skip, cursor):
+        return query(
+                'proposals', PROPOSAL_FIELDS, name='Proposals',
+                first=first, skip=skip,
+                where={'space_in': spaces, 'end_gt': now, 'created_gte': cursor},
+                orderBy='created', orderDirection='asc'
+                )
+    return build_query
+
+
+def new_proposals_query(watermarks):
+    '''
+    Returns graphql query for the proposals created at or after the
+    watermark of each space (one aliased sub-query per space).
+    '''
+    q = Query('Proposals')
+    for i, (space, watermark) in enumerate(watermarks):
+        q.add(
+            'proposals', PROPOSAL_FIELDS, alias=f's{i}', first=PAGE_SIZE,
+            where={'space': space, 'created_gte': watermark},
+            orderBy='created', orderDirection='asc'
+        )
+    return q.payload()
+
+
+class SyncState:
+    '''
+    State of previous runs, persisted as json file. Holds high-water marks
+    for the follows of all wallets and their votes (time of the previous
+    sync), for the proposals of each space and the votes on each proposal
+    (last seen 'created' timestamp), so that a run only has to query what
+    changed since.
+    Deletions (unfollows, deleted proposals) can't be seen in a delta,
+    so the state is rebuilt from scratch every {full_sync_every} seconds.
+
+    state = SyncState('./sync_state.json')
+    spaces_d, active_d, voted_d = state.sync_wallets(wallets)
+    prop_data_d = state.sync_tallies(props)
+    state.save()
+    '''
+
+    def __init__(self, path, full_sync_every=FULL_SYNC_EVERY):
+        self.path = path
+        self.state = {}
+        if os.path.isfile(path):
+            self.state = read_from_json(path)
+        if time.time() - self.state.get('full_sync', 0) > full_sync_every:
+            self.state = {'full_sync': int(time.time())}
+        self.state.setdefault('follows', {'watermark': 0, 'spaces': {}})
+        self.state.setdefault('proposals', {'watermarks': {}, 'props': {}})
+        self.state.setdefault('voted', {'watermark': 0, 'props': {}})
+        self.state['voted'].setdefault('checked', {})
+        self.state.setdefault('tallies', {})
+
+    def save(self):
+        '''Writes state to disk (atomically, see functions.write_atomic).'''
+        write_atomic(self.path, json.dumps(self.state))
+
+    # -- follows -----------------------------------------------------------
+
+    def sync_follows(self, wallets):
+        '''
+        Returns dict of shape {wallet: set of spaces, ...}. Only wallets
+        new to the state are resolved in full, for all others only follows
+        newer than the watermark are queried. Wallets that aren't given
+        anymore are forgotten.
+        '''
+        started = int(time.time())
+        follows = self.state['follows']
+        known = [w for w in wallets if w in follows['spaces']]
+        new = [w for w in wallets if w not in follows['spaces']]
+
+        if new != []:
+            for wallet, spaces in get_joined_spaces_many(new).items():
+                follows['spaces'][wallet] = sorted(spaces)
+
+        if known != []:
+            wallet_chunks = chunks(known, WALLET_CHUNK)
+            lower_d = {w.lower(): w for w in known}
+            results = paginate_queries(
+                    [follows_many_query(chunk) for chunk in wallet_chunks],
+                    'follows', cursors=[follows['watermark']] * len(wallet_chunks)
+                    )
+            for records in results:
+                for ele in records:
+                    wallet = lower_d.get(ele['follower'].lower())
+                    spaces = follows['spaces'][wallet]
+                    if ele['space']['id'] not in spaces:
+                        spaces.append(ele['space']['id'])
+
+        follows['watermark'] = started - MARGIN
+
+        # forget wallets that aren't tracked anymore (resolved in full again)
+        for wallet in [w for w in follows['spaces'] if w not in wallets]:
+            del follows['spaces'][wallet]
+
+        return {w: set(follows['spaces'][w]) for w in wallets}
+
+    # -- proposals ---------------------------------------------------------
+
+    def sync_proposals(self, spaces, due=None):
+        '''
+        Returns dict of shape {space: set of active proposal ids, ...}.
+        Spaces new to the state are queried for all proposals that haven't
+        ended yet, for all others only proposals newer than the space's
+        watermark are queried. If a set of due spaces is given, known
+        spaces outside of it aren't queried at all. Activity is derived
+        locally from start/end.
+        '''
+        now = int(time.time())
+        proposals = self.state['proposals']
+        watermarks, props = proposals['watermarks'], proposals['props']
+        new = sorted(s for s in spaces if s not in watermarks)
+        known = sorted(
+                s for s in spaces
+                if s in watermarks and (due is None or s in due)
+                )
+
+        def add(records):
+            for x in records:
+                space = x['space']['id']
+                props[x['id']] = [space, x['start'], x['end']]
+                watermarks[space] = max(watermarks.get(space, 0), x['created'])
+
+        # full fetch for new spaces (and known spaces with too many news)
+        def full_fetch(spaces):
+            space_chunks = chunks(spaces, SPACE_CHUNK)
+            for records in paginate_queries(
+                    [open_proposals_query(chunk, now) for chunk in space_chunks],
+                    'proposals', kind='active_proposals'
+                    ):
+                add(records)
+            for space in spaces:
+                watermarks[space] = max(watermarks.get(space, 0), now - MARGIN)
+
+        overflow = []
+        space_chunks = chunks(known, SPACE_CHUNK)
+        responses = json_from_queries(
+                (new_proposals_query([(s, watermarks[s]) for s in chunk])
+                 for chunk in space_chunks), 'active_proposals'
+                )
+        for chunk, response in zip(space_chunks, responses):
+            for i, space in enumerate(chunk):
+                records = response['data'][f's{i}']
+                add(records)
+                if len(records) == PAGE_SIZE:
+                    overflow.append(space)
+        if new + overflow != []:
+            full_fetch(new + overflow)
+
+        # forget proposals that have ended
+        for _id in [k for k, v in props.items() if v[2] <= now]:
+            del props[_id]
+
+        active_d = {space: set() for space in spaces}
+        for _id, (space, start, end) in props.items():
+            if space in active_d and start <= now:
+                active_d[space].add(_id)
+
+        return active_d
+
+    # -- votes of the wallets ----------------------------------------------
+
+    def sync_voted(self, active_d):
+        '''
+        Takes a dict of shape {wallet: set of active proposals, ...}.
+        Returns dict of the same shape containing the proposals each wallet
+        has voted on already. Proposals a wallet hasn't been checked against
+        yet (all of them for wallets new to the state, those of newly
+        followed spaces otherwise) are looked up in full, for all others
+        only votes newer than the watermark are queried. Wallets that aren't
+        given anymore are forgotten.
+        '''
+        started = int(time.time())
+        voted = self.state['voted']
+        checked = voted['checked']
+        new, known = {}, {}
+        for wallet, props in active_d.items():
+            done = set(checked.get(wallet, ())) if wallet in voted['props'] else set()
+            if props - done:
+                new[wallet] = sorted(props - done)
+            if props & done:
+                known[wallet] = props & done
+            voted['props'].setdefault(wallet, [])
+
+        if new != {}:
+            for wallet, props in already_voted_many(new).items():
+                voted['props'][wallet] += [
+                    p for p in props if p not in voted['props'][wallet]
+                ]
+                checked[wallet] = sorted(set(checked.get(wallet, ())) | set(new[wallet]))
+
+        if known != {}:
+            wallet_chunks = chunks(known, WALLET_CHUNK)
+            props = sorted(set().union(*known.values()))
+            lower_d = {w.lower(): w for w in known}
+            results = paginate_queries(
+                    [voted_matrix_query(chunk, props) for chunk in wallet_chunks],
+                    'votes', cursors=[voted['watermark']] * len(wallet_chunks),
+                    kind='voted'
+                    )
+            for records in results:
+                for vote in records:
+                    wallet = lower_d.get(vote['voter'].lower())
+                    if vote['proposal']['id'] not in voted['props'][wallet]:
+                        voted['props'][wallet].append(vote['proposal']['id'])
+
+        voted['watermark'] = started - MARGIN
+
+        # forget wallets that aren't tracked anymore (looked up in full again)
+        for wallet in [w for w in voted['props'] if w not in active_d]:
+            del voted['props'][wallet]
+            checked.pop(wallet, None)
+
+        # forget votes on proposals that have ended
+        open_props = self.state['proposals']['props']
+        for wallet in voted['props']:
+            voted['props'][wallet] = [
+                p for p in voted['props'][wallet] if p in open_props
+            ]
+        for wallet in checked:
+            checked[wallet] = [p for p in checked[wallet] if p in open_props]
+
+        return {w: list(voted['props'][w]) for w in active_d}
+
+    def sync_wallets(self, wallets, due_spaces=None):
+        '''
+        Brings follows, active proposals and votes of all wallets up to
+        date. Returns tuple (spaces_d, active_d, voted_d) with dicts of
+        shape {wallet: set of spaces / set of active props / voted props}.
+        New proposals are only looked for in due_spaces, if given (see
+        sync_proposals).
+        '''
+        cond_log('Syncing follows, proposals and votes since last run...')
+        spaces_d = self.sync_follows(wallets)
+        props_d = self.sync_proposals(
+                set().union(*spaces_d.values()), due=due_spaces
+                )
+        active_d = {
+            w: set().union(*(props_d[s] for s in spaces))
+            for w, spaces in spaces_d.items()
+        }
+        voted_d = self.sync_voted(active_d)
+        return spaces_d, active_d, voted_d
+
+    # -- tallies -----------------------------------------------------------
+
+    def sync_tallies(self, proposals, due=None):
+        '''
+        Returns dict of shape {prop_id: metadata dict as in get_prop_data}.
+        Proposals new to the state are tallied from their most recent
+        VOTE_BUDGET votes, all others are updated with the votes cast since
+        the previous run. If a set of due proposals is given, the tallies
+        of known proposals outside of it are used as they are.
+        '''
+        tallies = self.state['tallies']
+        proposals = list(proposals)
+        meta_d = get_prop_meta_many(proposals)
+
+        new = {p: VoteTally(meta_d[p]) for p in proposals if p not in tallies}
+        known = {
+            p: VoteTally.from_dict(meta_d[p], tallies[p])
+            for p in proposals if p in tallies
+        }
+        tally_votes_many(new)
+        tally_votes_many(
+                {p: t for p, t in known.items() if due is None or p in due},
+                update=True
+                )
+
+        for p, tally in list(new.items()) + list(known.items()):
+            tallies[p] = tally.to_dict()
+
+        # forget tallies of proposals that have ended
+        open_props = self.state['proposals']['props']
+        for p in [p for p in tallies if p not in open_props]:
+            del tallies[p]
+
+        all_tallies = {**new, **known}
+        return {p: all_tallies[p].result(p)[p] for p in proposals}
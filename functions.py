@@ -4,15 +4,45 @@
 All functions are stored here
 """
 
-import os, json, requests, keyring, csv, random
-from time import sleep
-from copy import deepcopy
+import os, re, json, csv, random
+from operator import itemgetter
+from prop_cache import ProposalCache
+from interning import Interner, InternedSets
+from query_builder import Query, query, batch
+
+try:
+    import orjson     # optional, faster (de)serialization of choices.json
+except ImportError:
+    orjson = None
 
 
 logging = True        # toggles verbosity (False = no messages at all)
 IGNORE_LIST = [       # proposals to forever ignore
         'Qmdpr5nfFdHVsMQskUaEX8TqT54PrAUvFFvuwft7zc9pHU'
         ]
+PAGE_SIZE = 1000      # max. number of records per paginated query
+VOTE_BUDGET = 10000   # max. number of votes tallied per proposal (None = all)
+SAMPLE_CONFIDENCE = 0.99   # stop tallying single choice proposals once the leader is decided at this confidence (None = always tally VOTE_BUDGET votes)
+SAMPLE_PAGE = 100     # votes in the first page of a sampled tally, doubled on every further page
+MAX_TIMESTAMP = 2**31 - 1   # initial cursor when paging newest first
+WALLET_CHUNK = 100    # max. number of wallets per batched query
+SPACE_CHUNK = 100     # max. number of spaces per batched query
+PROP_CHUNK = 100      # max. number of proposals per batched query
+VOTE_BATCH = 10       # max. number of proposals whose votes are paged in one aliased request
+PROP_CACHE_PATH = './proposal_cache.db'   # on-disk cache of proposal metadata
+PROP_CACHE_SIZE = 20000   # max. number of cached proposals
+VOTE_STORE_PATH = './vote_history.db'   # indexed vote history (None = use already_voted.json)
+CHOICES_FORMAT = 'choices/normalized/v1'   # marks the normalized choices.json
+
+# fields of the proposal metadata used by the stages (the body is only
+# fetched on demand, see get_prop_bodies_many)
+PROP_META_FIELDS = [
+        'id', 'title', 'choices', 'start', 'end', 'type',
+        {'space': ['id', 'name']}
+        ]
+AGGREGATE_FIELDS = ('votes', 'scores', 'scores_total')
+
+_prop_cache = None
 
 
 def load_wallets(wallet_path):
@@ -24,37 +54,42 @@ def load_wallets(wallet_path):
     return wallets
 
 
-def create_voted_on_json(wallet_path, already_voted_path):
+def create_voted_on_json(wallet_path, already_voted_path, spaces_d=None,
+                         active_d=None):
     '''
     Will be executed if no already_voted.json is found.
     Queries graphql for active proposals. Creates a dict (wallets as keys)
     containing all active proposals that the wallets have voted on already.
-    Writes dict to json file, to be used as an ignore list.
+    Writes dict to json file, to be used as an ignore list, and returns it.
+    An index of followed spaces per wallet (see get_joined_spaces_many)
+    and of active proposals per wallet (see get_active_proposals_many)
+    can be provided to avoid querying them again.
     '''
     # get active proposals for all wallets -> dict active_props
     active_props = {}
     wallets = load_wallets(wallet_path)
     dummy_d = {k: [] for k in wallets}
+    if spaces_d is None:
+        spaces_d = get_joined_spaces_many(wallets)
+    if active_d is None:
+        active_d = get_active_proposals_many(spaces_d)
     for wallet in wallets:
-        spaces = get_joined_spaces(wallet)
         active_props[wallet] = list(get_not_yet_voted(
-                wallet, spaces, dummy_d, silent=True)
+                wallet, spaces_d[wallet], dummy_d, silent=True,
+                active_props=active_d[wallet])
                 )
 
     # collect proposals already voted on in already_voted dict
-    already_voted_d = {}
-
-    for wallet, props in active_props.items():
-        props_per_wallet = []
-        for prop in props:
-            if already_voted(wallet, prop):
-                props_per_wallet.append(prop)
-        already_voted_d[wallet] = props_per_wallet
+    already_voted_d = already_voted_many(active_props)
 
     # export as json file
-    write_to_json(already_voted_d, already_voted_path)
+    write_to_json(
+            {w: already_voted_d[w] for w in sorted(already_voted_d)},
+            already_voted_path
+            )
 
     cond_log(f'\nCreated a new {already_voted_path.strip("./")}.')
+    return already_voted_d
 
 
 def read_from_json(json_path):
@@ -66,35 +101,143 @@ def read_from_json(json_path):
         return data
 
 
-def set_already_voted_dict(already_voted_path, wallet_path):
+def set_already_voted_dict(already_voted_path, wallet_path, spaces_d=None,
+                           active_d=None):
     '''
     Reads json containing voting history and returns a dict (past votes
-    per wallet).
+    per wallet). If it has to be created, indexes of followed spaces and
+    active proposals per wallet can be provided (see create_voted_on_json).
     '''
-    wallets = load_wallets(wallet_path)
-
     # read data from json if it exists
     if os.path.isfile(already_voted_path):
         with open(already_voted_path, 'r') as jfile:
             data = json.load(jfile)
             return data
 
-    # create json if it doesn't exist and repeat
+    # create json if it doesn't exist
     else:
         print(f'Couldn\'t find {already_voted_path}. Trying to create it...')
-        create_voted_on_json(wallet_path, already_voted_path)
-        sleep(1)
-        data = set_already_voted_dict(already_voted_path, wallet_path)
-        return data
+        return create_voted_on_json(
+                wallet_path, already_voted_path, spaces_d, active_d
+                )
+
+
+def load_voting_history(already_voted_path, wallet_path, spaces_d):
+    '''
+    Returns tuple (dict of shape {wallet: [prop_id voted on, ...], ...},
+    active proposals per wallet as in get_active_proposals_many).
+    Votes on the active proposals are synced into the vote store at
+    VOTE_STORE_PATH (see vote_store.VoteStore), an already_voted.json is
+    imported into it if present. Without a VOTE_STORE_PATH,
+    already_voted.json is read or created (see set_already_voted_dict).
+    '''
+    active_d = get_active_proposals_many(spaces_d)
+    if VOTE_STORE_PATH is None:
+        voted_d = set_already_voted_dict(
+                already_voted_path, wallet_path, spaces_d, active_d
+                )
+        return voted_d, active_d
+
+    from vote_store import VoteStore
+    store = VoteStore(VOTE_STORE_PATH)
+    store.import_json(already_voted_path)
+    voted_d = store.sync({wallet: active_d[wallet] for wallet in spaces_d})
+    store.close()
+    return voted_d, active_d
+
+
+def write_atomic(path, data):
+    '''
+    Writes str or bytes to path via a temporary file that replaces it,
+    so readers never see a half-written file.
+    '''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
 
 
 def write_to_json(_dict, path):
     '''
     Writes dict of shape {wallet1: {prop_id_1, prop_id_2,...}, wallet2: ...}
-    to json file located in path variable.
+    to json file located in path variable (atomically, see write_atomic).
+    '''
+    write_atomic(path, json.dumps(_dict, indent=4))
+
+
+def normalize_choices(choices):
+    '''
+    Takes choices dict of shape {wallet: {prop_id: metadata, ...}, ...}.
+    Returns the normalized form holding each proposal's metadata once:
+    {'format': CHOICES_FORMAT, 'proposals': {prop_id: metadata, ...},
+     'wallets': {wallet: [prop_id, ...], ...}}
+    Assumes the metadata of a proposal is the same for all wallets (as
+    created by build_choices).
+    '''
+    proposals = {}
+    for prop_list in choices.values():
+        for _id, data in prop_list.items():
+            if _id not in proposals:
+                proposals[_id] = data
+    return {
+        'format': CHOICES_FORMAT,
+        'proposals': proposals,
+        'wallets': {wallet: list(prop_list) for wallet, prop_list in choices.items()},
+    }
+
+
+def expand_choices(doc):
+    '''
+    Takes the contents of a choices.json in either format and returns
+    the choices dict of shape {wallet: {prop_id: metadata, ...}, ...}.
+    '''
+    if doc.get('format') != CHOICES_FORMAT:
+        return doc
+    proposals = doc['proposals']
+    return {
+        wallet: {_id: proposals[_id] for _id in prop_ids}
+        for wallet, prop_ids in doc['wallets'].items()
+    }
+
+
+def read_choices(path):
+    '''
+    Reads a choices.json in either format (see write_choices). Returns
+    tuple (choices dict of shape {wallet: {prop_id: metadata, ...}, ...},
+    True if the file was normalized).
+    '''
+    with open(path, 'rb') as jfile:
+        raw = jfile.read()
+    doc = orjson.loads(raw) if orjson is not None else json.loads(raw)
+    return expand_choices(doc), doc.get('format') == CHOICES_FORMAT
+
+
+def write_choices(choices, path, normalized=False):
+    '''
+    Writes choices dict to path, atomically. By default in the format
+    snapshot-vote reads ({wallet: {prop_id: metadata}}, indented). If
+    normalized is True, each proposal's metadata is stored only once
+    (see normalize_choices) and written compactly, using orjson if it
+    is installed.
+    '''
+    if not normalized:
+        write_to_json(choices, path)
+        return
+    doc = normalize_choices(choices)
+    if orjson is not None:
+        raw = orjson.dumps(doc)
+    else:
+        raw = json.dumps(doc, separators=(',', ':')).encode()
+    write_atomic(path, raw)
+
+
+def rewrite_choices(path, stage):
+    '''
+    Applies a pipeline stage (choices dict -> choices dict) to the
+    choices.json at path, keeping the file's format.
     '''
-    with open(path, 'w') as jfile:
-        json_object = json.dump(_dict, jfile, indent=4)
+    choices, normalized = read_choices(path)
+    write_choices(stage(choices), path, normalized)
 
 
 def dict_to_csv(_dict, outpath):
@@ -113,49 +256,172 @@ def cond_log(msg):
         print(msg)
 
 
-def json_from_query(query):
-    '''Returns the response of the graphql query as dictionary'''
-    url = 'https://hub.snapshot.org/graphql'
-    r = requests.post(url, json={'query': query})
-    response_str = r.text
-    out_json = json.loads(response_str)
+def json_from_query(query, kind='other'):
+    '''
+    Returns the response of the graphql query as dictionary. The kind
+    of query (follows, votes, ...) labels its request metrics.
+    '''
+    from query_engine import get_engine
+    return get_engine().query(query, kind)
+
 
-    assert 'errors' not in out_json, f"Caught an error: {out_json['errors']}"
-    return out_json
+def json_from_queries(queries, kind='other'):
+    '''
+    Sends graphql queries concurrently over the shared connection pool.
+    Returns list of responses (dicts) in the same order as the queries.
+    '''
+    from query_engine import get_engine
+    return get_engine().query_many(queries, kind)
 
 
-def already_voted(wallet, proposal):
+def json_stream_queries(queries, on_records, kind='other'):
     '''
-    Queries snapshot, returns True if wallet has voted on proposal already,
-    returns False if not.
+    Sends graphql queries concurrently and decodes the record lists of each
+    response while it is received, passing them to on_records(i, key,
+    records) in batches, key being the root field or alias of the list
+    (see query_engine.stream_many).
+    Returns list of the responses with their record lists emptied.
     '''
+    from query_engine import get_engine
+    return get_engine().stream_many(queries, on_records, kind)
 
-    query = '''query Votes {
-        votes (
-            first: 1000
-            skip: 0
-            where: {
-              proposal: "'''+str(proposal)+'''"
-              voter: "'''+str(wallet)+'''"
-            }
-        orderBy: "created",
-        orderDirection: desc
-        ) {
-        id
-        voter
-        created
-        proposal {
-          id
-        }
-        choice
-        space {
-          id
-        }
+
+def query_metrics():
+    '''Returns the request metrics of this process (metrics.QueryMetrics).'''
+    from query_engine import get_engine
+    return get_engine().metrics
+
+
+def chunks(iterable, size):
+    '''Splits an iterable into lists of at most {size} elements.'''
+    lst = list(iterable)
+    return [lst[i:i+size] for i in range(0, len(lst), size)]
+
+
+def paginate_queries(build_queries, collection, page_size=None,
+                     descending=False, on_page=None, cursors=None, kind=None,
+                     batch_size=None, page_done=None):
+    '''
+    Pages through the results of several queries at once, using the
+    'created' timestamp of the records as cursor. Each element of
+    build_queries is a function (first, skip, cursor) -> query of the root
+    field {collection}. Returns a list of record lists (one per query).
+    '''
+    # The results of each query must contain 'id' and 'created' and be
+    # ordered by 'created' ascending (filtered by created_gte: cursor) or,
+    # if descending, descending (filtered by created_lte: cursor). Queries
+    # are request bodies or Query objects; with batch_size they must be
+    # Query objects, and the pages of up to batch_size queries are fetched
+    # in one request as aliased root fields (see query_builder.batch).
+    # page_size is a number of records or a function i -> size of the next
+    # page of query i. Paging starts at cursors (e.g. a watermark of the
+    # previous run), by default at the oldest (newest) record.
+    if callable(page_size):
+        size_of = page_size
+    else:
+        size_of = lambda i, size=page_size or PAGE_SIZE: size
+    kind = kind or collection   # label of the requests in the metrics
+    n = len(build_queries)
+    results = [[] for _ in range(n)]
+    # state per query: [cursor, skip, ids seen at cursor timestamp]
+    if cursors is None:
+        cursors = [MAX_TIMESTAMP if descending else 0] * n
+    state = {i: [cursors[i], 0, set()] for i in range(n)}
+
+    while state != {}:
+        pending = list(state)
+        sizes = {i: size_of(i) for i in pending}
+        # per query: [last timestamp of the page so far, ids at that timestamp]
+        pages = {i: [None, set()] for i in pending}
+        counts = dict.fromkeys(pending, 0)
+        stopped = set()
+
+        # one request per query, or per batch of queries, and which query
+        # each (request, key of a record list) belongs to
+        page_queries = {
+            i: build_queries[i](sizes[i], state[i][1], state[i][0])
+            for i in pending
         }
-    }'''
+        if batch_size:
+            requests, owners = [], {}
+            for j, group in enumerate(chunks(pending, batch_size)):
+                combined, keys = batch(page_queries[i] for i in group)
+                requests.append(combined.payload())
+                owners.update(
+                    ((j, alias), group[k]) for alias, (k, _) in keys.items()
+                )
+        else:
+            requests = [
+                q.payload() if isinstance(q, Query) else q
+                for q in page_queries.values()
+            ]
+            owners = {(j, collection): i for j, i in enumerate(pending)}
+
+        # with on_page, records are passed to on_page(i, records) in batches
+        # as they are decoded instead of being collected, so no page is held
+        # in memory as a whole, and query i stops once on_page returns False
+        def on_records(j, key, records):
+            i = owners.get((j, key))
+            if i is None:
+                return
+            counts[i] += len(records)
+            if i in stopped:
+                return
+            last, at_last = pages[i]
+            for x in records:
+                if x['created'] != last:
+                    last, at_last = x['created'], set()
+                at_last.add(x['id'])
+            pages[i] = [last, at_last]
+
+            seen = state[i][2]
+            new = [x for x in records if x['id'] not in seen]
+            if on_page is None:
+                results[i] += new
+            elif new != [] and on_page(i, new) is False:
+                stopped.add(i)
+
+        json_stream_queries(requests, on_records, kind)
+
+        for i in pending:
+            if i in stopped or counts[i] < sizes[i]:
+                del state[i]
+                continue
+            # page_done sees whole pages, so unlike on_page its calls don't
+            # depend on how the responses are split in transport
+            if page_done is not None and page_done(i) is False:
+                del state[i]
+                continue
 
+            # move cursor to the last timestamp of the page, or skip ahead
+            # if the whole page shares one timestamp
+            cursor, skip, seen = state[i]
+            last, at_last = pages[i]
+            if last == cursor:
+                state[i] = [cursor, skip + sizes[i], seen | at_last]
+            else:
+                state[i] = [last, 0, at_last]
+
+    return results
+
+
+def already_voted_query(wallet, proposal):
+    '''Returns graphql query for a vote of wallet on proposal (if any).'''
+    return query(
+            'votes', ['id'], name='Votes', first=1,
+            where={'proposal': proposal, 'voter': wallet}
+            )
+
+
+def already_voted(wallet, proposal):
+    '''
+    Queries snapshot, returns True if wallet has voted on proposal already,
+    returns False if not.
+    '''
     # query graphql
-    already_voted = json_from_query(query)
+    already_voted = json_from_query(
+            already_voted_query(wallet, proposal), 'voted'
+            )
 
     # if graphql response is empty list, wallet is not among past voters
     if already_voted['data']['votes'] != []:
@@ -164,87 +430,172 @@ def already_voted(wallet, proposal):
         return False
 
 
-def get_joined_spaces(wallet):
-    '''Returns the set of snapshot spaces this wallet is following'''
+def voted_matrix_query(wallets, proposals):
+    '''
+    Returns function building a paginated graphql query for all votes of
+    the given wallets on the given proposals (see paginate_queries).
+    '''
+    wallets, proposals = list(wallets), list(proposals)
+
+    def build_query(first, skip, cursor):
+        return query(
+                'votes', ['id', 'voter', 'created', {'proposal': ['id']}],
+                name='Votes', first=first, skip=skip,
+                where={
+                    'proposal_in': proposals,
+                    'voter_in': wallets,
+                    'created_gte': cursor
+                },
+                orderBy='created', orderDirection='asc'
+                )
+    return build_query
 
-    # query graphql
-    query_follows = '''query {
-        follows(
-            first: 300,
-            where: {
-              follower: "'''+str(wallet)+'''"
-            }
-        ) {
-        follower
-        space {
-          id
-        }
-        created
-        }
-    }
+
+def already_voted_many(wallet_props):
+    '''
+    Takes a dict of shape {wallet: [prop_id_1, ...], ...}. Queries votes for
+    chunks of {WALLET_CHUNK} wallets at once and returns a dict of the same
+    shape containing only the proposals each wallet has voted on already.
     '''
+    wallet_chunks = chunks(
+            [w for w, props in wallet_props.items() if props != []],
+            WALLET_CHUNK
+            )
+    builders = []
+    for chunk in wallet_chunks:
+        props = {p for w in chunk for p in wallet_props[w]}
+        builders.append(voted_matrix_query(chunk, sorted(props)))
 
-    # extract followed spaces from response
-    id_set = set()
-    d = json_from_query(query_follows)
+    # the hub returns checksummed addresses -> compare lower case
+    voted = set()
+    for votes in paginate_queries(builders, 'votes', kind='voted'):
+        for vote in votes:
+            voted.add((vote['voter'].lower(), vote['proposal']['id']))
 
-    if "data" in d:
+    voted_d = {}
+    for wallet, props in wallet_props.items():
+        voted_d[wallet] = [p for p in props if (wallet.lower(), p) in voted]
 
-        for ele in d['data']['follows']:
-            id_set.add(ele['space']['id'])
+    return voted_d
 
-        return id_set
 
-    else:
+def follows_many_query(wallets):
+    '''
+    Returns function building a paginated graphql query for the follows
+    of the given wallets (see paginate_queries).
+    '''
+    wallets = list(wallets)
+
+    def build_query(first, skip, cursor):
+        return query(
+                'follows', ['id', 'follower', 'created', {'space': ['id']}],
+                name='Follows', first=first, skip=skip,
+                where={'follower_in': wallets, 'created_gte': cursor},
+                orderBy='created', orderDirection='asc'
+                )
+    return build_query
+
+
+def get_joined_spaces_many(wallets):
+    '''
+    Queries followed spaces for chunks of {WALLET_CHUNK} wallets at once,
+    paging through all follows (no truncation). Returns an index of shape
+    {wallet: set of spaces, ...} to be reused by later stages.
+    '''
+    wallets = list(wallets)
+    wallet_chunks = chunks(wallets, WALLET_CHUNK)
+    builders = [follows_many_query(chunk) for chunk in wallet_chunks]
 
-        print("="*20,"\n", f"Couldn't get joined spaces for wallet {wallet}!", "="*20,"\n")
+    # the hub returns checksummed addresses -> compare lower case
+    spaces_d = {w: set() for w in wallets}
+    lower_d = {w.lower(): w for w in wallets}
+    for follows in paginate_queries(builders, 'follows'):
+        for ele in follows:
+            wallet = lower_d.get(ele['follower'].lower())
+            if wallet is not None:
+                spaces_d[wallet].add(ele['space']['id'])
 
-        return set()
+    return spaces_d
 
 
+def get_joined_spaces(wallet):
+    '''Returns the set of snapshot spaces this wallet is following.'''
+    return get_joined_spaces_many([wallet])[wallet]
+
+
+def active_proposals_many_query(spaces):
+    '''
+    Returns function building a paginated graphql query for the active
+    proposals of the given spaces (see paginate_queries).
+    '''
+    spaces = list(spaces)
+
+    def build_query(first, skip, cursor):
+        return query(
+                'proposals', ['id', 'created', {'space': ['id']}],
+                name='Proposals', first=first, skip=skip,
+                where={
+                    'space_in': spaces,
+                    'state': 'active',
+                    'created_gte': cursor
+                },
+                orderBy='created', orderDirection='asc'
+                )
+    return build_query
+
+
+def get_active_proposals_by_space(spaces):
+    '''
+    Queries the active proposals of all given spaces, paging through all
+    results (no truncation). Returns an index of shape
+    {space: set of active proposal ids, ...}.
+    '''
+    spaces = sorted(set(spaces))
+    builders = [active_proposals_many_query(chunk)
+                for chunk in chunks(spaces, SPACE_CHUNK)]
+
+    props_d = {space: set() for space in spaces}
+    for props in paginate_queries(builders, 'proposals', kind='active_proposals'):
+        for prop in props:
+            props_d.setdefault(prop['space']['id'], set()).add(prop['id'])
+
+    return props_d
 
 
 def get_active_proposals(spaces_set, silent=False):
     '''
     Returns the set of active proposals for each space in given set.
     '''
-    # Convert spaces set to graphql-compatible string
-    spaces_str = str(list(spaces_set)).replace("'",'"')
-
-    # Get all active proposals for these spaces
-    query_active = '''query Proposals {
-        proposals (
-            first: 50,
-            skip: 0,
-            where: {
-              space_in: '''+spaces_str+''',
-              state: "active"
-            },
-            orderBy: "created",
-            orderDirection: desc
-        ) {
-            id
-            title
-            body
-            choices
-            start
-            end
-            snapshot
-            state
-            author
-            space {
-              id
-              name
-            }
-          }
-    }'''
-    d = json_from_query(query_active)
+    return set().union(*get_active_proposals_by_space(spaces_set).values())
+
+
+def get_active_proposals_many(spaces_d):
+    '''
+    Takes a dict of shape {wallet: set of spaces, ...}. Queries the active
+    proposals of the union of all spaces once and returns a mapping of
+    shape {wallet: set of active proposal ids, ...}. The proposal ids are
+    interned and stored as compact arrays (see interning.InternedSets),
+    shared between wallets following the same spaces.
+    '''
+    all_spaces = set().union(*spaces_d.values())
+    props_d = get_active_proposals_by_space(all_spaces)
 
-    # Create set of all active proposal id's of those spaces
-    active_props = {x['id'] for x in d['data']['proposals']}
-    active_spaces = {x['space']['id'] for x in d['data']['proposals']}
+    # ids in sorted order -> arrays of ids sort like the proposal ids
+    import numpy as np
+    interner = Interner(sorted(set().union(*props_d.values())))
+    space_ids = {space: interner.ids(props) for space, props in props_d.items()}
+    empty = np.zeros(0, dtype=np.int32)
 
-    return active_props
+    active_d = InternedSets(interner)
+    memo = {}
+    for wallet, spaces in spaces_d.items():
+        key = frozenset(spaces)
+        if key not in memo:
+            arrays = [space_ids[space] for space in key]
+            memo[key] = np.unique(np.concatenate(arrays)) if arrays else empty
+        active_d.arrays[wallet] = memo[key]
+
+    return active_d
 
 
 def remove_voted_on(wallet, proposals, already_voted_dict):
@@ -262,19 +613,23 @@ def remove_voted_on(wallet, proposals, already_voted_dict):
     return removed
 
 
-def add_diversity(prop_dict, probability=0.3):
+def add_diversity(prop_dict, probability=0.3, seed=None):
     '''
     Takes a dict of shape {key1: list, key2: list,..}.
     Removes a random element from each list with a {probability}
     and returns resulting dict and a dict of what's been removed.
+    If a seed is given, each key draws from its own generator seeded with
+    (seed, key), so the result doesn't depend on which other keys are in
+    the dict or in which order they come.
     '''
     d = prop_dict
     out_d = d.copy()
     removed = {}
 
     for k,v in d.items():
-        if random.random() <= probability and v != []:
-            choice = random.choice(v)
+        rng = random if seed is None else random.Random(f'{seed}:{k}')
+        if rng.random() <= probability and v != []:
+            choice = rng.choice(v)
             v.remove(choice)
             out_d[k] = v
             removed[k] = choice
@@ -282,39 +637,91 @@ def add_diversity(prop_dict, probability=0.3):
     return out_d, removed
 
 
-def get_not_yet_voted(wallet, spaces, already_voted_dict, silent=False):
+def get_not_yet_voted(wallet, spaces, already_voted_dict, silent=False,
+                      active_props=None):
     '''
     Takes a set of snapshot spaces and returns the set of active proposals
-    that this wallet has not yet voted on.
+    that this wallet has not yet voted on. If the active proposals of these
+    spaces have been queried already, they can be passed as active_props.
     '''
     global IGNORE_LIST
 
+    if active_props is None:
+        active_props = get_active_proposals(spaces, silent=silent)
+
     # gets active proposals per wallet and removes those already voted on
-    to_vote = remove_voted_on(wallet,
-                              get_active_proposals(spaces, silent=silent),
-                              already_voted_dict
-                              )
+    to_vote = remove_voted_on(wallet, active_props, already_voted_dict)
     # subtract proposals from ignore list
     to_vote = to_vote - set(IGNORE_LIST)
 
     # randomly remove proposals from addresses to add variety between wallets
 
 
-    if not silent and to_vote != set():
+    if not silent:
+        log_found(wallet, to_vote)
+
+    return to_vote
+
+
+def log_found(wallet, to_vote):
+    if to_vote:
         cond_log(f'\n===> Found new proposals for {wallet}:\n')
         [cond_log(x) for x in to_vote]
         cond_log('')
 
-    return to_vote
+
+def not_yet_voted_interned(wallets, active_d, already_voted_dict):
+    '''
+    Same as get_not_yet_voted for all wallets at once, on interned arrays
+    (see get_active_proposals_many): every (wallet, proposal) pair is
+    encoded as one integer, so removing the proposals voted on and those
+    on the ignore list takes a single vectorized membership test instead
+    of python sets per wallet. Returns dict of shape
+    {wallet: sorted list of prop_ids, ...} in sorted wallet order.
+    '''
+    import numpy as np
+    interner = active_d.interner
+    index = interner.index
+    wallets = sorted(wallets)
+    n_props = max(len(interner), 1)
+
+    arrays = [active_d.array(w) for w in wallets]
+    lengths = np.fromiter(map(len, arrays), dtype=np.int64, count=len(arrays))
+    props = np.concatenate(arrays).astype(np.int64) if arrays else np.zeros(0, np.int64)
+    rows = np.repeat(np.arange(len(wallets)), lengths)
+    pairs = rows * n_props + props
+
+    voted = []
+    if already_voted_dict is not None:
+        for row, wallet in enumerate(wallets):
+            voted += [row * n_props + index[p]
+                      for p in already_voted_dict.get(wallet, ()) if p in index]
+
+    keep = ~np.isin(pairs, np.array(voted, dtype=np.int64))
+    keep &= ~np.isin(props, interner.ids(IGNORE_LIST, add=False))
+
+    kept = interner.lookup(props[keep])
+    ends = np.cumsum(np.bincount(rows[keep], minlength=len(wallets))).tolist()
+    starts = [0] + ends[:-1]
+    return {
+        wallet: kept[start:end]
+        for wallet, start, end in zip(wallets, starts, ends)
+    }
 
 
 def get_pk(encr_pk_path, keyr_service_name, keyr_account):
+    '''
+    Decrypts a private key from an encrypted keyfile (json), using the
+    password stored in the system keyring.
+    '''
+    import keyring
+    from eth_account import Account
 
     decr_pw = keyring.get_password(keyr_service_name, keyr_account)
 
     with open(encr_pk_path) as keyfile:
         enc_k = keyfile.read()
-        pk = eth.account.decrypt(enc_k, decr_pw)
+        pk = Account.decrypt(enc_k, decr_pw)
 
     decr_pw = None
     return pk
@@ -324,62 +731,86 @@ def get_choices(proposal_id):
     '''
     Returns list of choices up for vote for a specific proposal.
     '''
-    query_proposal = '''query Proposal {
-        proposal(id:"'''+proposal_id+'''") {
-            id
-            title
-            body
-            choices
-            start
-            end
-            snapshot
-            state
-            author
-            space {
-              id
-              name
-            }
-          }
-        }'''
-    d = json_from_query(query_proposal)
-    return d['data']['proposal']['choices']
+    return get_prop_meta(proposal_id)['choices']
 
 
-def export_to_vote(wallet_path, already_voted_path, export_path, export=True):
+def export_to_vote(wallet_path, already_voted_path, export_path, export=True,
+                   workers=None, seed=None):
     '''
     Wrapper for core functionality. Queries graphql.
     Saves a json file containing all active proposals per wallet that
     the wallet has not yet voted on.
+    With workers > 1, the wallets are split across that many processes
+    (see sharding.export_to_vote_sharded).
     '''
+    if workers is not None and workers > 1:
+        from sharding import export_to_vote_sharded
+        return export_to_vote_sharded(
+                wallet_path, already_voted_path, export_path, workers,
+                seed=seed, export=export
+                )
+
     cond_log('Loading wallets and voting history...')
     wallets = load_wallets(wallet_path)
-    already_voted_dict = set_already_voted_dict(
-            already_voted_path, wallet_path
+    spaces_d = get_joined_spaces_many(wallets)
+    already_voted_dict, active_d = load_voting_history(
+            already_voted_path, wallet_path, spaces_d
             )
 
+    d = select_to_vote(
+            wallets, already_voted_dict, spaces_d, active_d, seed=seed
+            )
+
+    if export:
+        write_to_json(d, export_path)
+        cond_log(f'\n...updated {export_path.strip("./")}')
+
+    return d
+
+
+def select_to_vote(wallets, already_voted_dict, spaces_d=None, active_d=None,
+                   seed=None):
+    '''
+    Pipeline stage. Queries graphql, returns a dict of shape
+    {wallet: [prop_id, ...], ...} containing all active proposals per
+    wallet that the wallet has not yet voted on, minus a random selection
+    for diversity (see add_diversity, seed is passed on). Wallets and
+    proposals are sorted. Followed spaces and active proposals per wallet
+    are only queried if not provided.
+    '''
+    if spaces_d is None:
+        spaces_d = get_joined_spaces_many(wallets)
+
     d = {}
 
     # query graphql for active proposals per wallet
     cond_log('Querying graphql...')
-    for wallet in wallets:
-        spaces = get_joined_spaces(wallet)
-        d[wallet] = list(get_not_yet_voted(wallet, spaces, already_voted_dict))
+    if active_d is None:
+        active_d = get_active_proposals_many(spaces_d)
+
+    if isinstance(active_d, InternedSets):
+        d = not_yet_voted_interned(wallets, active_d, already_voted_dict)
+        for wallet, to_vote in d.items():
+            log_found(wallet, to_vote)
+    else:
+        for wallet in sorted(wallets):
+            d[wallet] = sorted(get_not_yet_voted(
+                    wallet, spaces_d[wallet], already_voted_dict,
+                    active_props=active_d[wallet])
+                    )
 
     #randomly discard some proposals per wallet to add variety btw wallets
-    d, removed = add_diversity(d, probability=0.3)
+    d, removed = add_diversity(d, probability=0.3, seed=seed)
     if removed != {}:
         cond_log('\nRandomly removed these proposals for diversity\n:')
+        meta_d = get_prop_meta_many(set(removed.values()))
         for wallet, prop in removed.items():
-            title = get_prop_data(prop)[prop]['title']
+            title = meta_d[prop]['title']
             cond_log(f'{wallet}:')
             cond_log(f'\t{title}\n')
     else:
         cond_log('\nNo random removal of proposals for diversity this time!\n')
 
-    if export:
-        write_to_json(d, export_path)
-        cond_log(f'\n...updated {export_path.strip("./")}')
-
     return d
 
 
@@ -389,17 +820,9 @@ def get_spaces_from_proposals(proposals_list, id_memo={}):
     A dictionary of shape {proposal_str: id_str, ... } can be provided for
     memoization, to avoid querying for the same proposal twice (i.e. with multiple wallets).
     '''
-    # helper function, queries graphql to get space id from prop id
+    # helper function, looks up space name from prop id
     def id_from_prop(proposal_id):
-        query_proposal = '''query Proposal {
-            proposal(id:"'''+proposal_id+'''") {
-                space {
-                  name
-                }
-              }
-            }'''
-        d = json_from_query(query_proposal)
-        return d['data']['proposal']['space']['name']
+        return get_prop_meta(proposal_id)['space']['name']
 
     ids = set()
 
@@ -420,24 +843,30 @@ def export_readable_csv(json_path, outpath='./to_vote.csv'):
     Takes the wallet: proposals dictionary, replaces all proposals
     with the name of their respective spaces and saves as csv file
     '''
-    cond_log('...resolving space names for csv file...')
-
     # read dict from json
-    with open(json_path, 'r') as jfile:
-        in_dict = json.load(jfile)
+    in_dict = read_from_json(json_path)
+
+    # save as csv
+    dict_to_csv(resolve_space_names(in_dict), outpath)
+    cond_log(f'...updated {outpath.strip("./")}.')
+
+
+def resolve_space_names(to_vote_d):
+    '''
+    Pipeline stage. Takes the wallet: proposals dictionary, returns a dict
+    with all proposals replaced by the name of their respective spaces.
+    '''
+    cond_log('...resolving space names for csv file...')
     out_dict = {}
     memo_dict = {}
 
-    # query spaces ids from graphql
-    for wallet, prop_list in in_dict.items():
+    # look up space names of all proposals at once
+    get_prop_meta_many({p for props in to_vote_d.values() for p in props})
+    for wallet, prop_list in to_vote_d.items():
 
         spaces, memo_dict = get_spaces_from_proposals(prop_list, memo_dict)
         out_dict[wallet] = spaces
 
-    # save as csv
-    dict_to_csv(out_dict, outpath)
-    cond_log(f'...updated {outpath.strip("./")}.')
-
     # print list of spaces with active proposals
     unique_spaces = set(memo_dict.values())
     if unique_spaces == set():
@@ -446,30 +875,7 @@ def export_readable_csv(json_path, outpath='./to_vote.csv'):
         print('\nFound active proposals for these spaces in total:\n')
         [print(x) for x in unique_spaces]
 
-
-def get_choices(proposal_id):
-    '''
-    Returns list of choices up for vote for a specific proposal.
-    '''
-    query_proposal = '''query Proposal {
-        proposal(id:"'''+proposal_id+'''") {
-            id
-            title
-            body
-            choices
-            start
-            end
-            snapshot
-            state
-            author
-            space {
-              id
-              name
-            }
-          }
-        }'''
-    d = json_from_query(query_proposal)
-    return d['data']['proposal']['choices']
+    return out_dict
 
 
 def quadratic_voting_get_most_popular(single_vote_dict, all_poss_choices):
@@ -492,155 +898,410 @@ def quadratic_voting_get_most_popular(single_vote_dict, all_poss_choices):
         return int(max(votes_d.items(), key=lambda x: x[1])[0])
 
 
-def get_prop_data(proposal):
+def prop_votes_query(proposal, descending=True):
+    '''
+    Returns function building a paginated graphql query for the votes on
+    proposal, most recent first unless descending is False
+    (see paginate_queries).
+    '''
+    if descending:
+        cursor_filter, direction = 'created_lte', 'desc'
+    else:
+        cursor_filter, direction = 'created_gte', 'asc'
+
+    def build_query(first, skip, cursor):
+        q = Query('Votes')
+        q.add(
+            'votes', ['id', 'created', 'choice'], first=first, skip=skip,
+            where={'proposal': proposal, cursor_filter: cursor},
+            orderBy='created', orderDirection=direction
+            )
+        return q
+    return build_query
+
+
+def prop_meta_many_query(proposals):
+    '''Returns graphql query for the metadata of the given proposals.'''
+    return query(
+            'proposals', PROP_META_FIELDS, name='Proposals',
+            first=len(proposals), where={'id_in': list(proposals)}
+            )
+
+
+def get_prop_cache():
+    '''Returns the on-disk proposal metadata cache, opened on first use.'''
+    global _prop_cache
+    if _prop_cache is None:
+        _prop_cache = ProposalCache(PROP_CACHE_PATH, max_entries=PROP_CACHE_SIZE)
+    return _prop_cache
+
+
+def get_prop_meta_many(proposals):
+    '''
+    Returns metadata of all proposals as dict of shape {prop_id: metadata}.
+    Served from the proposal cache, only proposals never seen before are
+    queried from graphql, {PROP_CHUNK} per request.
+    '''
+    cache = get_prop_cache()
+    proposals = set(proposals)
+    meta_d = cache.get_many(proposals)
+
+    missing = sorted(prop for prop in proposals if prop not in meta_d)
+    responses = json_from_queries(
+            (prop_meta_many_query(chunk) for chunk in chunks(missing, PROP_CHUNK)),
+            'proposal_meta'
+            )
+    fetched = {
+        prop_meta['id']: prop_meta
+        for response in responses for prop_meta in response['data']['proposals']
+    }
+
+    cache.put_many(fetched)
+    meta_d.update(fetched)
+    return meta_d
+
+
+def get_prop_meta(proposal):
+    '''Returns metadata of a single proposal (see get_prop_meta_many).'''
+    return get_prop_meta_many([proposal])[proposal]
+
+
+def prop_bodies_query(proposals):
+    '''Returns graphql query for the (markdown) bodies of the given proposals.'''
+    return query(
+            'proposals', ['id', 'body'], name='Proposals',
+            first=len(proposals), where={'id_in': list(proposals)}
+            )
+
+
+def get_prop_bodies_many(proposals):
+    '''
+    Returns dict of shape {prop_id: body, ...}. Bodies are large and not
+    part of the cached metadata, so they are only queried here, for the
+    proposals a filter actually has to read (one request per {PROP_CHUNK}
+    proposals).
+    '''
+    prop_chunks = chunks(sorted(set(proposals)), PROP_CHUNK)
+    responses = json_from_queries(
+            (prop_bodies_query(chunk) for chunk in prop_chunks), 'proposal_body'
+            )
+    return {
+        x['id']: x['body'] or ''
+        for response in responses for x in response['data']['proposals']
+    }
+
+
+def get_prop_data(proposal, budget=None):
     '''
     Queries graphql and returns the most popular choice at this moment
     among other metadata as a nested dict with proposal id as key.
-    If proposal has less than 100 votes, popular choice is None.
+    Tallies the most recent {budget} votes (default: VOTE_BUDGET).
     '''
+    return {proposal: get_prop_data_many([proposal], budget=budget)[proposal]}
 
-    # query graphql for the most recent 1000 votes and their choice
-    query_votes = '''query Votes {
-        votes (
-            first: 1000
-            skip: 0
-            where: {
-              proposal: "'''+str(proposal)+'''"
-            }
-        orderBy: "created",
-        orderDirection: desc
-        ) {
-        choice
-        }
-        }'''
-    votes_list = json_from_query(query_votes)['data']['votes']
-
-    # query graphql for some proposal metadata
-    query_proposal = '''query Proposal {
-        proposal(id:"'''+proposal+'''") {
-            id
-            title
-            body
-            choices
-            start
-            end
-            snapshot
-            state
-            author
-            type
-            space {
-              id
-              name
-            }
-          }
-        }'''
-    meta_data = json_from_query(query_proposal)['data']
-
-    title = meta_data['proposal']['title']
-    ts_created = meta_data['proposal']['start']
-    vote_count = len(votes_list)
-    possible_choices = meta_data['proposal']['choices']
-    _type = meta_data['proposal']['type']
-    space = meta_data['proposal']['space']['id']
-    weighted_vote = False
-    _id = meta_data['proposal']['id']
-
-    # set flag for quadratic voting according to data
-    if votes_list != [] and type(votes_list[0]['choice']) != int:
-        weighted_vote = True
-
-
-    # transfer choices to int dictionary keys
-    choices_d = {}
-    for i in range(len(possible_choices)):
-        choices_d[i+1] = 0
-
-    # sum up count of each choice and determine most popular one
-    for vote in votes_list:
-
-        # case: Someone voted for an unavailable choice
-        if not weighted_vote and _type != 'ranked-choice':     # catch quadratic voting error
-            if vote['choice'] not in choices_d:  # catch outsider vote
-                outsider = vote['choice']
+
+def get_prop_data_many(proposals, budget=None, confidence=None):
+    '''
+    Streams the votes of all proposals page by page (concurrently across
+    proposals) into a running tally, metadata comes from the proposal
+    cache. Only the choice counters are kept in memory. Tallying a
+    proposal stops after its most recent {budget} votes (default:
+    VOTE_BUDGET), or for single choice proposals as soon as the leader
+    is decided at the given confidence (see tally_votes_many). Returns
+    dict of shape
+    {prop_id: metadata dict as in get_prop_data, ...}.
+    '''
+    proposals = list(proposals)
+    meta_d = get_prop_meta_many(proposals)
+    tallies = {prop: VoteTally(meta_d[prop]) for prop in proposals}
+    tally_votes_many(tallies, budget=budget, confidence=confidence)
+
+    return {prop: tally.result(prop)[prop] for prop, tally in tallies.items()}
+
+
+def tally_votes_many(tallies, budget=None, update=False, confidence=None):
+    '''
+    Takes a dict of shape {prop_id: VoteTally, ...} and streams votes into
+    the tallies, concurrently across proposals.
+    By default, the most recent {budget} votes (default: VOTE_BUDGET) of
+    each proposal are added. Single choice proposals are sampled instead:
+    their votes are fetched in pages of {SAMPLE_PAGE} votes, doubling up
+    to PAGE_SIZE, and tallying stops as soon as the leading choice is
+    decided at the given confidence (default: SAMPLE_CONFIDENCE, see
+    tally.leader_decided), checked once per page, so only close races are
+    tallied in full. The number of votes on each proposal is read from
+    its aggregate count (VoteTally.total_votes).
+    With update=True, all votes newer than the watermark of each tally
+    are added instead (oldest first), to bring the tallies of a previous
+    run up to date.
+    '''
+    from tally import leader_decided
+    budget = budget if budget is not None else VOTE_BUDGET
+    confidence = confidence if confidence is not None else SAMPLE_CONFIDENCE
+    proposals = list(tallies)
+    full_page = min(PAGE_SIZE, budget) if budget else PAGE_SIZE
+    sampled = {
+        i for i, prop in enumerate(proposals)
+        if confidence is not None and tallies[prop].type in ('single-choice', 'basic')
+    }
+    pages = [0] * len(proposals)
+    looks = [0] * len(proposals)
+
+    def page_size(i):
+        pages[i] += 1
+        if i not in sampled:
+            return full_page
+        return min(full_page, SAMPLE_PAGE * 2**(pages[i] - 1))
+
+    def on_page(i, page):
+        tally = tallies[proposals[i]]
+        if update:
+            tally.add(page)
+            return True
+        if budget is not None:
+            page = page[:budget - tally.n_votes]
+        tally.add(page)
+        return budget is None or tally.n_votes < budget
+
+    def page_done(i):
+        tally = tallies[proposals[i]]
+        if i in sampled and tally.weighted_vote:
+            sampled.discard(i)      # quadratic votes, tally in full
+        if i not in sampled:
+            return True
+        looks[i] += 1
+        remaining = None if budget is None else budget - tally.n_votes
+        return not leader_decided(
+                list(tally.choices_d.values()), confidence, looks[i], remaining
+                )
+
+    if update:
+        paginate_queries(
+                [prop_votes_query(prop, descending=False) for prop in proposals],
+                'votes', on_page=on_page,
+                cursors=[tallies[prop].watermark for prop in proposals],
+                batch_size=VOTE_BATCH
+                )
+    else:
+        paginate_queries(
+                [prop_votes_query(prop) for prop in proposals], 'votes',
+                page_size=page_size, descending=True, on_page=on_page,
+                batch_size=VOTE_BATCH, page_done=page_done
+                )
+
+    counts = get_prop_aggregates_many(proposals, ['votes'])
+    for prop in proposals:
+        if prop in counts:
+            tallies[prop].total_votes = counts[prop]['votes']
+
+    return tallies
+
+
+def tally_prop_data(proposal, votes_list, prop_meta):
+    '''
+    Takes a list of votes and the proposal metadata as queried from graphql.
+    Returns the most popular choice among other metadata as a nested dict
+    with proposal id as key.
+    '''
+    tally = VoteTally(prop_meta)
+    tally.add(votes_list)
+    return tally.result(proposal)
+
+
+class VoteTally:
+    '''
+    Running tally of the votes on a proposal. Votes are added page by page
+    (add), only the counters per choice are kept. result returns the most
+    popular choice so far among other metadata.
+    The newest 'created' timestamp seen (watermark) and the ids of the
+    votes at that timestamp are kept as well, so that a tally can be
+    persisted (to_dict/from_dict) and updated with newer votes only.
+    '''
+
+    def __init__(self, prop_meta):
+        self.prop_meta = prop_meta
+        self.type = prop_meta['type']
+        self.n_votes = 0
+        self.total_votes = None   # votes on the proposal (aggregate count)
+        self.weighted_vote = None
+        self.watermark = 0
+        self.at_watermark = set()
+
+        # transfer choices to int dictionary keys
+        self.choices_d = {}
+        for i in range(len(prop_meta['choices'])):
+            self.choices_d[i+1] = 0
+
+        # count of each distinct approval ballot / ranking (in order of appearance)
+        self.approvals = {}
+        self.rankings = {}
+
+    def add(self, votes_list):
+        '''Adds a list of votes to the tally.'''
+        _type = self.type
+
+        # set flag for quadratic voting according to data
+        if self.weighted_vote is None and votes_list != []:
+            self.weighted_vote = type(votes_list[0]['choice']) != int
+
+        # skip votes that have been tallied before, move watermark
+        if self.at_watermark:
+            votes_list = [v for v in votes_list if v['id'] not in self.at_watermark]
+        if votes_list == []:
+            return
+        import numpy as np
+        from tally import count_single_choice, count_top_weighted, count_ballots
+        created = np.fromiter(
+                map(itemgetter('created'), votes_list),
+                dtype=np.int64, count=len(votes_list)
+                )
+        newest = int(created.max())
+        if newest > self.watermark:
+            self.watermark, self.at_watermark = newest, set()
+        if newest == self.watermark:
+            self.at_watermark.update(
+                    votes_list[i]['id'] for i in np.flatnonzero(created == newest)
+                    )
+        self.n_votes += len(votes_list)
+        n_choices = len(self.prop_meta['choices'])
+        choices = list(map(itemgetter('choice'), votes_list))
+
+        # case: Single choice -> count valid choices, log outsider votes
+        if not self.weighted_vote and _type != 'ranked-choice':     # catch quadratic voting error
+            ints = [c for c in choices if type(c) == int]
+            counts, outsiders = count_single_choice(ints, n_choices)
+            if len(ints) < len(choices):
+                outsiders += [c for c in choices if type(c) != int]
+            self._add_counts(counts)
+            for outsider in outsiders:
                 cond_log(f'Oops, caught an outsider. Choice: {outsider}')
-                continue
+            return
+
+        # case: Quadratic voting -> count choice voted highest
+        weighted = [c for c in choices if type(c) == dict]
+        if weighted != []:
+            self._add_counts(count_top_weighted(weighted, n_choices))
+        if len(weighted) == len(choices):
+            return
+        rest = [v for v in votes_list if type(v['choice']) != dict]
+
+        # case: Voting type: approval -> count identical ballots
+        if _type == 'approval':
+            for ballot, count in count_ballots([v['choice'] for v in rest]):
+                self.approvals[ballot] = self.approvals.get(ballot, 0) + count
+            return
+
+        # case: Ranked choice voting -> count identical rankings, the
+        # instant-runoff is run on them in result()
+        if _type == 'ranked-choice':
+            self.weighted_vote = False
+            rankings = [v['choice'] for v in rest if type(v['choice']) == list]
+            for ranking, count in count_ballots(rankings):
+                self.rankings[ranking] = self.rankings.get(ranking, 0) + count
+            return
+
+        for vote in rest:
+
+            # case: Voting type: weighted vote
+            if _type == 'weighted_vote':
+                pass
 
-        # case: Quadratic voting
-        elif type(vote['choice']) == dict:
-            highest_v = quadratic_voting_get_most_popular(vote['choice'], choices_d)
-            if highest_v == None:
-                continue
             else:
-                choices_d[highest_v] += 1
-
-        # case: Ranked choice voting
-        elif _type == 'ranked-choice':
-            weighted_vote = False
-            print('Got a ranked choice!')
-            choices_list = vote['choice']
-            random.shuffle(choices_list)
-            d_keys = [int(k)-1 for k in list(choices_d.keys())]
-            choices_d = {}
-            for k, v in zip(d_keys, choices_list):
-                choices_d[str(k)] = v
-
-            print("choices_d:", choices_d)
-            print('proposal:', proposal, title, space, _type)
-            print("type(vote['choice']):", type(vote['choice']))
-            print("vote['choice']:", vote['choice'])
-
-        # case: Voting type: approval -> ignore choices_d / count outside of loop
-        elif _type == 'approval':
-            pass
+                try:
+                    self.choices_d[vote['choice']] += 1
+                except (TypeError, KeyError):
+                    print('\n\n======== TypeError ======== Proposal:', self.prop_meta['title'])
+                    print('vote', vote['choice'])
+
+    def ranking(self):
+        '''
+        Returns the instant-runoff result of the rankings so far as list of
+        all choices (1-based), winner first (see tally.instant_runoff).
+        '''
+        from tally import instant_runoff
+        return instant_runoff(
+                list(self.rankings), list(self.rankings.values()),
+                len(self.prop_meta['choices'])
+                )
 
-        # case: Voting type: weighted vote
-        elif _type == 'weighted_vote':
-            pass
+    def _add_counts(self, counts):
+        '''Adds an array of counts per choice to choices_d.'''
+        for i, count in enumerate(counts):
+            self.choices_d[i+1] += int(count)
+
+    def to_dict(self):
+        '''Returns the state of the tally as json-compatible dict.'''
+        return {
+            'n_votes': self.n_votes,
+            'total_votes': self.total_votes,
+            'weighted_vote': self.weighted_vote,
+            'watermark': self.watermark,
+            'at_watermark': sorted(self.at_watermark),
+            'choices': [[k, v] for k, v in self.choices_d.items()],
+            'approvals': [[list(k), v] for k, v in self.approvals.items()],
+            'rankings': [[list(k), v] for k, v in self.rankings.items()],
+        }
 
-        else:
-            try:
-                choices_d[vote['choice']] += 1
-            except TypeError:
-                print('\n\n======== TypeError ======== Proposal:', space, title)
-                print('choices_d[vote]', choices_d[vote])
-                print('type(choices_d[vote])', type(choices_d[vote]))
-
-    # determine most voted choice so far / or set voting dict
-    if _type == 'ranked-choice':
-        most_popular = choices_d
-
-    elif _type == 'approval':
-        votes_list_unpacked = [ele['choice'] for ele in votes_list]
-        most_popular = sorted(votes_list_unpacked,
-                                key = votes_list_unpacked.count,
-                                reverse = True)[0]
-        most_popular = [str(x) for x in most_popular]
+    @classmethod
+    def from_dict(cls, prop_meta, d):
+        '''Restores a tally from the output of to_dict.'''
+        tally = cls(prop_meta)
+        tally.n_votes = d['n_votes']
+        tally.total_votes = d.get('total_votes')
+        tally.weighted_vote = d['weighted_vote']
+        tally.watermark = d['watermark']
+        tally.at_watermark = set(d['at_watermark'])
+        tally.choices_d = {k: v for k, v in d['choices']}
+        tally.approvals = {tuple(k): v for k, v in d['approvals']}
+        tally.rankings = {tuple(k): v for k, v in d.get('rankings', [])}
+        return tally
+
+    def result(self, proposal):
+        '''Returns most popular choice and metadata as in get_prop_data.'''
+        prop_meta = self.prop_meta
+        _type = self.type
+
+        # determine most voted choice so far / or full ranking
+        if _type == 'ranked-choice':
+            most_popular = self.ranking()
 
-    else:
-        most_popular = max(choices_d.items(), key=lambda x: x[1])[0]
-
-    out_d = {
-        proposal: {
-            'title': title,
-            'pop_choice': most_popular,
-            'ts_created': ts_created,
-            'total_votes': vote_count,
-            'weighted_vote': weighted_vote,
-            'type': _type,
-            'space': space,
-            'id': _id
+        elif _type == 'approval':
+            if self.approvals == {}:
+                most_popular = None
+            else:
+                most_popular = max(self.approvals.items(), key=lambda x: x[1])[0]
+                most_popular = [str(x) for x in most_popular]
+
+        else:
+            most_popular = max(self.choices_d.items(), key=lambda x: x[1])[0]
+
+        out_d = {
+            proposal: {
+                'title': prop_meta['title'],
+                'pop_choice': most_popular,
+                'ts_created': prop_meta['start'],
+                'total_votes': self.n_votes if self.total_votes is None else self.total_votes,
+                'tallied_votes': self.n_votes,
+                'weighted_vote': bool(self.weighted_vote),
+                'type': _type,
+                'space': prop_meta['space']['id'],
+                'id': prop_meta['id']
+            }
         }
-    }
 
-    return out_d
+        return out_d
 
 
-def create_choices_json(export_json_path, choices_json_path):
+def create_choices_json(export_json_path, choices_json_path, normalized=False,
+                        workers=None):
     '''
     Takes proposals up for voting from json file and saves another json
     file with the most popular choice so far by other snapshot voters
-    for each proposal. Will be inferred from a sample of the last 1000 voters.
-    If less than 100 voters so far for a proposal, the choice will be None.
+    for each proposal. Will be inferred from the most recent VOTE_BUDGET
+    voters. If normalized is True, the file is written in the compact
+    normalized format (see write_choices). With workers > 1, the
+    proposals are tallied in that many processes (see
+    sharding.tally_sharded).
     '''
     to_vote_d = read_from_json(export_json_path)
 
@@ -648,13 +1309,27 @@ def create_choices_json(export_json_path, choices_json_path):
     if to_vote_d == {}:
         return
 
-    # create empty dict with same structure as to_vote_d
-    out_d = {}
-    for wallet, prop_list in to_vote_d.items():
-        out_d[wallet] = {}
-        for prop in prop_list:
-            out_d[wallet][prop] = {}
+    prop_data_d = None
+    if workers is not None and workers > 1:
+        from sharding import tally_sharded
+        prop_data_d = tally_sharded(
+                {p for props in to_vote_d.values() for p in props}, workers
+                )
 
+    # save to json
+    write_choices(
+            build_choices(to_vote_d, prop_data_d), choices_json_path, normalized
+            )
+    cond_log('\nCreated a choices.json with metadata on active proposals.\n')
+
+
+def build_choices(to_vote_d, prop_data_d=None):
+    '''
+    Pipeline stage. Takes the wallet: proposals dictionary, returns a dict
+    of shape {wallet: {prop_id: metadata, ...}, ...} with the most popular
+    choice so far for each proposal (see get_prop_data). The proposal data
+    is only queried if not provided.
+    '''
     # populate set of unique proposals
     props = set()
     for wallet, prop_list in to_vote_d.items():
@@ -662,83 +1337,167 @@ def create_choices_json(export_json_path, choices_json_path):
             props.add(prop)
 
     # create dict of proposals and their queried metadata
-    prop_data_d = {}
-    for prop in props:
-        prop_data_d[prop] = get_prop_data(prop)[prop]
+    if prop_data_d is None:
+        prop_data_d = get_prop_data_many(props)
 
     # add metadata for each proposal for each wallet (structure as in to_vote)
-    for wallet, props in to_vote_d.items():
-        for prop in props:
-            out_d[wallet][prop] = prop_data_d[prop]
+    out_d = {}
+    for wallet, prop_list in to_vote_d.items():
+        out_d[wallet] = {prop: prop_data_d[prop] for prop in prop_list}
 
-    # save to json
-    write_to_json(out_d, choices_json_path)
-    cond_log('\nCreated a choices.json with metadata on active proposals.\n')
+    return out_d
 
 
 def filter_out_bot_catcher_proposals(choices_json_path, triggers):
     '''
     Removes any proposal containing the word bot, human, or sybil in title.
     '''
-    choices = read_from_json(choices_json_path)
-    props = {}
+    rewrite_choices(
+            choices_json_path, lambda c: drop_bot_catcher_proposals(c, triggers)
+            )
 
-    # populate dict of unique proposals
-    for prop_list in choices.values():
-        if prop_list == {}:
-            continue
-        for _id, data in prop_list.items():
-            props[_id] = data
 
-    # remove any proposal containing a word from trigger list
-    outfile = deepcopy(choices)
-    removed = {}
+def drop_bot_catcher_proposals(choices, triggers):
+    '''
+    Pipeline stage. Returns choices dict without any proposal containing
+    a word from the trigger list in its title.
+    '''
+    prop_filter = ProposalFilter(triggers=triggers, low_engagement=False, ignore=())
+    return prop_filter.apply(choices)
 
-    for wallet, prop_list in choices.items():
-        if prop_list == {}:
-            continue
-        else:
+
+def compile_triggers(triggers):
+    '''
+    Returns a compiled regex matching any of the trigger words (as plain,
+    case-sensitive substrings), or None if there are no triggers.
+    '''
+    triggers = sorted(set(triggers), key=len, reverse=True)
+    if triggers == []:
+        return None
+    return re.compile('|'.join(map(re.escape, triggers)))
+
+
+class ProposalFilter:
+    '''
+    Applies all proposal filters in one pass. Each unique proposal of a
+    choices dict is judged once, by these rules (first match wins):
+    - ignore: the proposal is on the ignore list
+    - trigger: its title (or, with search_body=True, its body) contains a
+      trigger word (might try to identify automated voting). Bodies are
+      only queried for proposals not dropped by their title.
+    - low_engagement: less than {min_engagement} of the usual voters of
+      its space have voted so far (see get_avg_n_votes_many)
+    The dropped proposals are then removed from all wallets in one sweep.
+
+    prop_filter = ProposalFilter(triggers=['bot', 'sybil'])
+    choices = prop_filter.apply(choices)
+    '''
+
+    def __init__(self, triggers=(), low_engagement=True, ignore=None,
+                 min_engagement=0.3, search_body=False):
+        self.trigger_re = compile_triggers(triggers)
+        self.search_body = search_body
+        self.low_engagement = low_engagement
+        self.ignore = frozenset(IGNORE_LIST if ignore is None else ignore)
+        self.min_engagement = min_engagement
+
+    def judge(self, props):
+        '''
+        Takes dict of shape {prop_id: metadata, ...} (unique proposals).
+        Returns dict of shape {prop_id: rule, ...} for the proposals to drop.
+        '''
+        dropped = {}
+        for _id, data in props.items():
+            if _id in self.ignore:
+                dropped[_id] = 'ignore'
+            elif self.trigger_re is not None and self.trigger_re.search(data['title']):
+                dropped[_id] = 'trigger'
+
+        rest = [_id for _id in props if _id not in dropped]
+        if self.search_body and self.trigger_re is not None and rest != []:
+            for _id, body in get_prop_bodies_many(rest).items():
+                if self.trigger_re.search(body):
+                    dropped[_id] = 'trigger'
+
+        # engagement is only looked up for proposals still in the race
+        rest = [_id for _id in props if _id not in dropped]
+        if self.low_engagement and rest != []:
+            counts = get_prop_aggregates_many(rest, ['votes'])
+            spaces_votes = get_avg_n_votes_many({props[_id]['space'] for _id in rest})
+            for _id in rest:
+                votes = counts[_id]['votes']
+                avg = spaces_votes[props[_id]['space']]
+                props[_id] = dict(props[_id], total_votes=votes)
+                if avg > 0 and (votes/avg) < self.min_engagement:
+                    dropped[_id] = 'low_engagement'
+        return dropped
+
+    def apply(self, choices):
+        '''
+        Returns choices dict without the dropped proposals and prints which
+        proposals were removed by which rule.
+        '''
+        props = {}
+        for prop_list in choices.values():
             for _id, data in prop_list.items():
-                title = data['title']
-                print(title)
-                if any(ele in title for ele in triggers):
-                    del outfile[wallet][_id]
-                    removed[_id] = data
-
-    # update json file
-    write_to_json(outfile, choices_json_path)
-    if removed != {}:
-        print('\nRemoved these proposals because of a trigger word caught in the proposal title:')
-        print_dict = {x['id']: x['title'] for x in removed.values()}
-        prettyprint(print_dict, keys_label='Proposal', values_label='Title')
-        print('')
+                if _id not in props:
+                    props[_id] = data
+        dropped = self.judge(props)
+
+        outfile = {
+            wallet: {
+                _id: data for _id, data in prop_list.items() if _id not in dropped
+            }
+            for wallet, prop_list in choices.items()
+        }
+        self.report(props, dropped)
+        return outfile
+
+    def report(self, props, dropped):
+        by_rule = lambda rule: [props[_id] for _id, r in dropped.items() if r == rule]
+        if by_rule('trigger') != []:
+            where = 'title or body' if self.search_body else 'title'
+            print(f'\nRemoved these proposals because of a trigger word caught in the proposal {where}:')
+            print_dict = {x['id']: x['title'] for x in by_rule('trigger')}
+            prettyprint(print_dict, keys_label='Proposal', values_label='Title')
+            print('')
+        if by_rule('low_engagement') != []:
+            print(f'\nRemoved these proposals because less than {self.min_engagement:.0%} of the usual voters have voted so far:')
+            print_dict = {x['title']: x['total_votes'] for x in by_rule('low_engagement')}
+            prettyprint(print_dict, keys_label='Proposal', values_label='Votes so far')
+            print('')
+
 
 def enable_weighted_vote(choices_json_path):
     '''
     Corrects the popular choice to be in a dictionary format.
     '''
-    choices = read_from_json(choices_json_path)
-    outfile = deepcopy(choices)
+    rewrite_choices(choices_json_path, apply_weighted_vote)
+
+
+def apply_weighted_vote(choices):
+    '''
+    Pipeline stage. Returns choices dict with the popular choice of
+    weighted votes converted to dictionary format.
+    '''
+    outfile = {}
 
     # replace single choice with dictionary
     for wallet, prop_list in choices.items():
-        if prop_list == {}:
-            continue
-        else:
-            for _id, data in prop_list.items():
-                if data['weighted_vote'] == True and isinstance(data['pop_choice'], int):
-                    choice_int = data['pop_choice']
-                    #choice_dict = '{"' + str(choice_int) + '":1}'
-                    choice_dict = {str(choice_int): 1}
-                    print('\nChanged a choice to be compatible with the weighted vote...')
-                    print('ID:', _id)
-                    print('Title:', data['title'])
-                    print('Old choice:', choice_int, '\nNew choice:', choice_dict)
+        outfile[wallet] = dict(prop_list)
+        for _id, data in prop_list.items():
+            if data['weighted_vote'] == True and isinstance(data['pop_choice'], int):
+                choice_int = data['pop_choice']
+                choice_dict = {str(choice_int): 1}
+                print('\nChanged a choice to be compatible with the weighted vote...')
+                print('ID:', _id)
+                print('Title:', data['title'])
+                print('Old choice:', choice_int, '\nNew choice:', choice_dict)
 
-                    outfile[wallet][_id]['pop_choice'] = choice_dict
+                outfile[wallet][_id] = dict(data, pop_choice=choice_dict)
+
+    return outfile
 
-    # update json file
-    write_to_json(outfile, choices_json_path)
 
 def filter_out_low_engagement_props(choices_json_path):
     '''
@@ -746,49 +1505,111 @@ def filter_out_low_engagement_props(choices_json_path):
     Removes any proposal where less than 30% of usual voters have voted.
     Saves choices.json with those proposals removed.
     '''
-    choices = read_from_json(choices_json_path)
-    spaces_votes = {}
-    props = {}
+    rewrite_choices(choices_json_path, drop_low_engagement_props)
 
-    # populate dict of unique proposals
-    for prop_list in choices.values():
-        if prop_list == {}:
-            continue
-        for _id, data in prop_list.items():
-            props[_id] = data
 
-    # read avg past votes from memo dict or alternatively query graphql
-    for prop in props.copy():
-        space = props[prop]['space']
-        if space in spaces_votes:
-            props[prop]['avg_votes'] = spaces_votes[space]
-        else:
-            avg_votes = get_avg_n_votes(space)
-            spaces_votes[space] = avg_votes
-            props[prop]['avg_votes'] = avg_votes
+def drop_low_engagement_props(choices):
+    '''
+    Pipeline stage. Returns choices dict without any proposal where less
+    than 30% of usual voters have voted.
+    '''
+    return ProposalFilter(low_engagement=True, ignore=()).apply(choices)
 
-    # remove any proposal with less than 30% of the usual engagement
-    outfile = deepcopy(choices)
-    removed = {}
 
-    for wallet, prop_list in choices.items():
-        if prop_list == {}:
-            continue
-        else:
-            for _id, data in prop_list.items():
-                votes = data['total_votes']
-                avg = props[_id]['avg_votes']
-                if (votes/avg) < (3/10):
-                    del outfile[wallet][_id]
-                    removed[_id] = data
-
-    # update json file
-    write_to_json(outfile, choices_json_path)
-    if removed != {}:
-        print('\nRemoved these proposals because less than 30% of the usual voters have voted so far:')
-        print_dict = {x['title']: x['total_votes'] for x in removed.values()}
-        prettyprint(print_dict, keys_label='Proposal', values_label='Votes so far')
-        print('')
+def run_pipeline(wallet_path, already_voted_path, export_json_path,
+                 choices_json_path, export_csv_path=None, triggers=(),
+                 low_engagement=True, state_path=None, metrics_path=None,
+                 normalized=False, workers=None):
+    '''
+    Runs all stages in a single process, passing the data along in memory.
+    Writes to_vote.json, choices.json and (optionally) to_vote.csv once
+    at the end. Returns tuple (to_vote dict, choices dict).
+    If a state_path is given, runs incrementally: only what changed since
+    the previous run is queried and merged into the state persisted there
+    (see delta_sync.SyncState), already_voted.json isn't used.
+    A summary of all requests sent during the run is logged at the end
+    and, if a metrics_path is given, written there as Prometheus text file.
+    If normalized is True, choices.json is written in the compact
+    normalized format (see write_choices). With workers > 1 (and no
+    state_path), wallets and proposals are split across that many
+    processes (see sharding.py).
+    '''
+    query_metrics().reset()
+    cond_log('Loading wallets and voting history...')
+    wallets = load_wallets(wallet_path)
+
+    if state_path is None and workers is not None and workers > 1:
+        from sharding import export_to_vote_sharded, tally_sharded
+        to_vote_d = export_to_vote_sharded(
+                wallet_path, already_voted_path, export_json_path, workers,
+                export=False
+                )
+        prop_data_d = tally_sharded(
+                {p for props in to_vote_d.values() for p in props}, workers
+                )
+        choices = build_choices(to_vote_d, prop_data_d)
+
+    elif state_path is None:
+        spaces_d = get_joined_spaces_many(wallets)
+        already_voted_dict, active_d = load_voting_history(
+                already_voted_path, wallet_path, spaces_d
+                )
+        to_vote_d = select_to_vote(
+                wallets, already_voted_dict, spaces_d, active_d
+                )
+        choices = build_choices(to_vote_d)
+
+    else:
+        from delta_sync import SyncState
+        state = SyncState(state_path)
+        spaces_d, active_d, voted_d = state.sync_wallets(wallets)
+        to_vote_d = select_to_vote(wallets, voted_d, spaces_d, active_d)
+        prop_data_d = state.sync_tallies(
+                {p for props in to_vote_d.values() for p in props}
+                )
+        choices = build_choices(to_vote_d, prop_data_d)
+        state.save()
+
+    choices = finish_pipeline(
+            to_vote_d, choices, export_json_path, choices_json_path,
+            export_csv_path, triggers, low_engagement, normalized
+            )
+
+    cond_log('\n' + query_metrics().report())
+    if metrics_path is not None:
+        query_metrics().write_prometheus(metrics_path)
+
+    return to_vote_d, choices
+
+
+def finish_pipeline(to_vote_d, choices, export_json_path, choices_json_path,
+                    export_csv_path=None, triggers=(), low_engagement=True,
+                    normalized=False):
+    '''
+    Last stages of run_pipeline: filters and converts the choices dict,
+    then writes to_vote.json, choices.json and (optionally) to_vote.csv.
+    Returns the final choices dict.
+    '''
+    # filter out ignored proposals, proposals that might try to identify
+    # automated voting and those with much less engagement than usual
+    prop_filter = ProposalFilter(triggers=triggers, low_engagement=low_engagement)
+    choices = prop_filter.apply(choices)
+
+    # change choice values to work with weighted votes
+    choices = apply_weighted_vote(choices)
+
+    # export all outputs
+    write_to_json(to_vote_d, export_json_path)
+    cond_log(f'\n...updated {export_json_path.strip("./")}')
+    write_choices(choices, choices_json_path, normalized)
+    cond_log('\nCreated a choices.json with metadata on active proposals.\n')
+
+    # create csv file with names of snapshot spaces resolved (optional)
+    if export_csv_path is not None:
+        dict_to_csv(resolve_space_names(to_vote_d), export_csv_path)
+        cond_log(f'...updated {export_csv_path.strip("./")}.')
+
+    return choices
 
 
 def get_avg_n_votes(space_ens, n=2):
@@ -796,78 +1617,95 @@ def get_avg_n_votes(space_ens, n=2):
     Queries graphql for the 2 most recent closed votes and returns
     average number of voters out of the 2.
     '''
-    # Query graphql: get most recent 2 prop ids
-    # for each id: get n_votes
-    # calculate average
-    # return average
-    recent_props = get_recent_closed_proposals(space_ens, n=n)
-    vote_counts = [get_n_votes(prop) for prop in recent_props]
-    avg = sum(vote_counts)/n
-    return avg
+    return get_avg_n_votes_many([space_ens], n=n)[space_ens]
 
 
-def get_n_votes(proposal):
+def recent_closed_many_query(spaces, n=2):
     '''
-    Queries snapshot, returns True if wallet has voted on proposal already,
-    returns False if not.
+    Returns graphql query for the most recent n closed proposals of each
+    space (one aliased sub-query per space), including their vote counts.
     '''
+    q = Query('Proposals')
+    for i, space in enumerate(spaces):
+        q.add(
+            'proposals', ['id', 'votes'], alias=f's{i}', first=n,
+            where={'space': space, 'state': 'closed'},
+            orderBy='created', orderDirection='desc'
+        )
+    return q.payload()
 
-    query = '''query Votes {
-        votes (
-            first: 5000
-            skip: 0
-            where: {
-              proposal: "'''+str(proposal)+'''"
-            }
-        orderBy: "created",
-        orderDirection: desc
-        ) {
-        id
-        voter
-        created
-        proposal {
-          id
-        }
-        choice
-        space {
-          id
-        }
-        }
-    }'''
-    votes = json_from_query(query)
-    return len(votes['data']['votes'])
+
+def get_avg_n_votes_many(spaces, n=2):
+    '''
+    Returns dict of shape {space: avg number of voters, ...}, averaged
+    over the n most recent closed proposals of each space. Vote counts
+    are read from the proposals' aggregate field, one request per
+    {SPACE_CHUNK} spaces.
+    '''
+    space_chunks = chunks(sorted(set(spaces)), SPACE_CHUNK)
+    responses = json_from_queries(
+            (recent_closed_many_query(chunk, n=n) for chunk in space_chunks),
+            'closed_proposals'
+            )
+
+    avg_d = {}
+    for chunk, response in zip(space_chunks, responses):
+        for i, space in enumerate(chunk):
+            vote_counts = [x['votes'] for x in response['data'][f's{i}']]
+            avg_d[space] = sum(vote_counts)/n
+
+    return avg_d
+
+
+def prop_aggregates_query(proposals, fields=AGGREGATE_FIELDS):
+    '''
+    Returns graphql query for the aggregate fields (vote count and
+    per-choice scores) of the given proposals.
+    '''
+    return query(
+            'proposals', ['id'] + list(fields), name='Proposals',
+            first=len(proposals), where={'id_in': list(proposals)}
+            )
+
+
+def get_prop_aggregates_many(proposals, fields=AGGREGATE_FIELDS):
+    '''
+    Returns dict of shape {prop_id: {'votes': int, 'scores': list,
+    'scores_total': float}, ...}, read from the proposals' aggregate
+    fields in one request per {PROP_CHUNK} proposals. Only the given
+    fields are requested.
+    '''
+    prop_chunks = chunks(sorted(set(proposals)), PROP_CHUNK)
+    responses = json_from_queries(
+            (prop_aggregates_query(chunk, fields) for chunk in prop_chunks),
+            'proposal_meta'
+            )
+
+    aggr_d = {}
+    for response in responses:
+        for x in response['data']['proposals']:
+            aggr_d[x.pop('id')] = x
+
+    return aggr_d
+
+
+def get_n_votes(proposal):
+    '''
+    Returns number of votes on proposal (from the aggregate vote count).
+    '''
+    return get_prop_aggregates_many([proposal], ['votes'])[proposal]['votes']
 
 
 def get_recent_closed_proposals(space_ens, n=2):
     '''
     Returns the most recent n closed proposal ids for a given space.
     '''
-    n = str(n)
-    space_ens = '"'+space_ens+'"'
-
-    # Get all active proposals for these spaces
-    query_active = '''query Proposals {
-        proposals (
-            first: '''+n+''',
-            skip: 0,
-            where: {
-              space_in: '''+space_ens+''',
-              state: "closed"
-            },
-            orderBy: "created",
-            orderDirection: desc
-        ) {
-            id
-            space {
-              id
-              name
-            }
-          }
-    }'''
-    result = json_from_query(query_active)
+    result = json_from_query(
+            recent_closed_many_query([space_ens], n=n), 'closed_proposals'
+            )
 
-    # Create set of all active proposal id's of those spaces
-    props = [x['id'] for x in result['data']['proposals']]
+    # Create list of the closed proposal id's of this space
+    props = [x['id'] for x in result['data']['s0']]
     return props
 
 
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Compact representation of many sets of proposal ids (or addresses)
+"""
+
+from collections.abc import Mapping
+
+
+class Interner:
+    '''
+    Maps strings (proposal ids, addresses) to dense integer ids 0..n-1 and
+    back, storing each string only once. If the strings are added in sorted
+    order, sorting ids sorts the strings as well.
+    '''
+
+    def __init__(self, strings=()):
+        self.strings = []
+        self.index = {}
+        for s in strings:
+            self.id(s)
+
+    def __len__(self):
+        return len(self.strings)
+
+    def id(self, s):
+        '''Returns the id of a string, adding it if it's new.'''
+        i = self.index.get(s)
+        if i is None:
+            i = self.index[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+    def ids(self, strings, add=True):
+        '''
+        Returns sorted array (int32) of the unique ids of the strings.
+        With add=False, strings that aren't known are left out.
+        '''
+        import numpy as np
+        if add:
+            ids = [self.id(s) for s in strings]
+        else:
+            index = self.index
+            ids = [index[s] for s in strings if s in index]
+        return np.unique(np.array(ids, dtype=np.int32))
+
+    def lookup(self, ids):
+        '''Returns list of the strings of an array of ids (same order).'''
+        strings = self.strings
+        return [strings[i] for i in ids.tolist()]
+
+
+class InternedSets(Mapping):
+    '''
+    Read-only mapping of shape {key: set of strings}, holding each set as a
+    sorted int32 array of interned ids. Keys with equal sets can share one
+    array. Indexing materializes a python set, array(key) doesn't.
+    '''
+
+    def __init__(self, interner):
+        self.interner = interner
+        self.arrays = {}
+
+    def array(self, key):
+        return self.arrays[key]
+
+    def __getitem__(self, key):
+        return set(self.interner.lookup(self.arrays[key]))
+
+    def __iter__(self):
+        return iter(self.arrays)
+
+    def __len__(self):
+        return len(self.arrays)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Incremental decoding of the record lists in a graphql response
+"""
+
+import codecs, json, re
+
+
+_KEY = r'("(?:[^"\\]|\\.)*")\s*:\s*\['
+_HEAD_RE = re.compile(r'\s*\{\s*"data"\s*:\s*\{\s*' + _KEY)
+_NEXT_RE = re.compile(r'\s*,\s*' + _KEY)
+
+
+class RecordStream:
+    '''
+    Decodes a graphql response of shape {"data": {key: [record, ...], ...}}
+    (one key per root field or alias) while it is being received: feed()
+    takes the next chunk of bytes and returns the records completed by it
+    as list of (key, records), so only the records (and never the whole
+    response as bytes or text) are held in memory. Responses of any other
+    shape (errors, null, values that aren't lists) are buffered from that
+    point on and decoded by close() instead.
+
+    stream = RecordStream()
+    for chunk in chunks:
+        consume(stream.feed(chunk))
+    consume(stream.close()[0])
+    '''
+
+    def __init__(self):
+        self.state = 'head'      # -> 'records' <-> 'between' -> 'tail', or 'whole'
+        self.key = None
+        self.keys = []           # keys of the lists entered so far
+        self.buf = ''
+        self._decode = codecs.getincrementaldecoder('utf-8')().decode
+        self._scan = json.JSONDecoder().raw_decode
+
+    def _open(self, regex):
+        '''Enters the next list if the buffer starts with its key.'''
+        m = regex.match(self.buf)
+        if m is None:
+            return False
+        self.key = json.loads(m.group(1))
+        self.keys.append(self.key)
+        self.buf = self.buf[m.end():]
+        self.state = 'records'
+        return True
+
+    def _undecided(self):
+        '''True if the buffer might still turn out to start the next list.'''
+        return '[' not in self.buf and '}' not in self.buf and len(self.buf) < 1024
+
+    def feed(self, chunk):
+        '''Takes the next chunk of bytes, returns list of (key, records).'''
+        self.buf += self._decode(chunk)
+        if self.state == 'head':
+            if self._undecided():
+                return []
+            if not self._open(_HEAD_RE):
+                self.state = 'whole'
+
+        out = []
+        while self.state in ('records', 'between'):
+            if self.state == 'between':
+                if not self._open(_NEXT_RE):
+                    if not self._undecided():
+                        self.state = 'tail'
+                    break
+
+            records, buf, pos = [], self.buf, 0
+            end = len(buf)
+            while True:
+                while pos < end and buf[pos] in ' \t\n\r,':
+                    pos += 1
+                if pos == end:
+                    break
+                if buf[pos] == ']':
+                    self.state = 'between'
+                    pos += 1
+                    break
+                try:
+                    record, pos_next = self._scan(buf, pos)
+                except json.JSONDecodeError:
+                    break      # record isn't complete yet
+                records.append(record)
+                pos = pos_next
+            self.buf = buf[pos:]
+            if records != []:
+                out.append((self.key, records))
+            if self.state == 'records':
+                break
+        return out
+
+    def close(self):
+        '''
+        Ends the response. Returns tuple (list of (key, records) not returned
+        by feed yet, response with all record lists emptied).
+        Raises ValueError if the response is incomplete or not json.
+        '''
+        self.buf += self._decode(b'', True)
+        if self.state == 'records':
+            raise ValueError('Response ended inside a record list.')
+        if self.state in ('head', 'whole'):
+            doc = json.loads(self.buf)
+        else:
+            lists = ', '.join('%s: []' % json.dumps(key) for key in self.keys)
+            doc = json.loads('{"data": {%s%s' % (lists, self.buf))
+
+        out = []
+        data = doc.get('data')
+        if isinstance(data, dict):
+            for key, value in data.items():
+                if isinstance(value, list):
+                    if value != []:
+                        out.append((key, value))
+                    data[key] = []
+        return out, doc
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Per-request metrics of the graphql queries, grouped by kind of query
+"""
+
+import threading, time
+
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class QueryMetrics:
+    '''
+    Collects count, latency, bytes received, errors and retries of every
+    request, grouped by the kind of query (follows, active_proposals,
+    votes, ...). Filled in by the query engine, read out as a summary
+    (report) or as a Prometheus text file (write_prometheus).
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''Forgets everything recorded so far (e.g. at the start of a run).'''
+        with self._lock:
+            self.started = time.time()
+            self.kinds = {}
+
+    def _kind(self, kind):
+        if kind not in self.kinds:
+            self.kinds[kind] = {
+                'requests': 0, 'errors': 0, 'retries': 0, 'bytes': 0,
+                'seconds': 0.0, 'latencies': [],
+            }
+        return self.kinds[kind]
+
+    def record(self, kind, seconds, n_bytes, error=False):
+        '''Records one request (one http round trip).'''
+        with self._lock:
+            k = self._kind(kind)
+            k['requests'] += 1
+            k['seconds'] += seconds
+            k['bytes'] += n_bytes
+            k['latencies'].append(seconds)
+            if error:
+                k['errors'] += 1
+
+    def record_retry(self, kind):
+        '''Records that a request of this kind had to be sent again.'''
+        with self._lock:
+            self._kind(kind)['retries'] += 1
+
+    def snapshot(self):
+        '''Returns a copy of everything recorded so far, to be merged elsewhere.'''
+        with self._lock:
+            return {
+                kind: dict(k, latencies=list(k['latencies']))
+                for kind, k in self.kinds.items()
+            }
+
+    def merge(self, kinds):
+        '''Adds the records of a snapshot (e.g. of a worker process).'''
+        with self._lock:
+            for kind, other in kinds.items():
+                k = self._kind(kind)
+                for key in ('requests', 'errors', 'retries', 'bytes', 'seconds'):
+                    k[key] += other[key]
+                k['latencies'] += other['latencies']
+
+    def summary(self):
+        '''
+        Returns dict of shape {kind: {requests, errors, retries, bytes,
+        seconds, p50, p95, max}, ...}, latencies in seconds.
+        '''
+        out = {}
+        with self._lock:
+            for kind, k in sorted(self.kinds.items()):
+                lat = sorted(k['latencies'])
+                out[kind] = {
+                    key: k[key]
+                    for key in ['requests', 'errors', 'retries', 'bytes', 'seconds']
+                }
+                out[kind]['p50'] = lat[len(lat) // 2] if lat else 0.0
+                out[kind]['p95'] = lat[int(len(lat) * 0.95)] if lat else 0.0
+                out[kind]['max'] = lat[-1] if lat else 0.0
+        return out
+
+    def report(self):
+        '''Returns the summary as a printable table.'''
+        header = (f'{"query kind":<20}{"requests":>9}{"errors":>8}{"retries":>8}'
+                  f'{"MB":>9}{"total s":>9}{"p50 ms":>8}{"p95 ms":>8}')
+        lines = [header, '-' * len(header)]
+        for kind, k in self.summary().items():
+            lines.append(
+                    f'{kind:<20}{k["requests"]:>9}{k["errors"]:>8}{k["retries"]:>8}'
+                    f'{k["bytes"] / 1024**2:>9.2f}{k["seconds"]:>9.2f}'
+                    f'{k["p50"] * 1000:>8.0f}{k["p95"] * 1000:>8.0f}'
+                    )
+        lines.append(f'run time: {time.time() - self.started:.2f}s')
+        return '\n'.join(lines)
+
+    def prometheus(self):
+        '''Returns all metrics in the Prometheus text exposition format.'''
+        lines = []
+
+        def metric(name, _type, _help, samples):
+            lines.append(f'# HELP {name} {_help}')
+            lines.append(f'# TYPE {name} {_type}')
+            for labels, value in samples:
+                lines.append(f'{name}{labels} {value}')
+
+        with self._lock:
+            kinds = sorted(self.kinds.items())
+            label = {kind: f'{{kind="{kind}"}}' for kind, _ in kinds}
+            for key, _help in [
+                    ('requests', 'Requests sent to the snapshot hub.'),
+                    ('errors', 'Requests that failed.'),
+                    ('retries', 'Requests that were sent again.'),
+                    ]:
+                metric(f'snapshot_query_{key}_total', 'counter', _help,
+                       [(label[kind], k[key]) for kind, k in kinds])
+            metric('snapshot_query_response_bytes_total', 'counter',
+                   'Bytes received from the snapshot hub.',
+                   [(label[kind], k['bytes']) for kind, k in kinds])
+
+            hist = []
+            for kind, k in kinds:
+                for bound in LATENCY_BUCKETS:
+                    n = sum(1 for x in k['latencies'] if x <= bound)
+                    hist.append((f'_bucket{{kind="{kind}",le="{bound}"}}', n))
+                hist.append((f'_bucket{{kind="{kind}",le="+Inf"}}', k['requests']))
+                hist.append((f'_sum{label[kind]}', round(k['seconds'], 6)))
+                hist.append((f'_count{label[kind]}', k['requests']))
+            metric('snapshot_query_duration_seconds', 'histogram',
+                   'Latency of requests to the snapshot hub.', hist)
+
+            metric('snapshot_run_duration_seconds', 'gauge',
+                   'Duration of the last run.',
+                   [('', round(time.time() - self.started, 3))])
+            metric('snapshot_run_last_timestamp_seconds', 'gauge',
+                   'Time the last run finished.', [('', int(time.time()))])
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        '''
+        Writes the metrics to a .prom file (atomically, so that a
+        node_exporter textfile collector never reads half a file).
+        '''
+        from functions import write_atomic
+        write_atomic(path, self.prometheus())
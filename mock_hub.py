@@ -0,0 +1,533 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the snapshot hub graphql api, serving synthetic
+follows, proposals and votes at configurable scale and latency.
+
+    python mock_hub.py --port 8765 --wallets 200 --spaces 50 --write-wallets ./wallets.txt
+
+Point the scripts at it with query_engine.configure(url='http://127.0.0.1:8765/graphql').
+"""
+
+import argparse, asyncio, bisect, hashlib, json, random, re, time
+
+
+# ---------------------------------------------------------------------------
+# minimal graphql parser (queries only: fields, aliases, arguments, variables)
+# ---------------------------------------------------------------------------
+
+_TOKEN_RE = re.compile(r'''
+    (?P<ws>[\s,]+|\#[^\n]*)
+  | (?P<punct>\.\.\.|[{}()\[\]:!$=@])
+  | (?P<string>"(?:[^"\\]|\\.)*")
+  | (?P<number>-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+  | (?P<name>[_A-Za-z][_0-9A-Za-z]*)
+''', re.VERBOSE)
+
+
+class GraphQLError(Exception):
+    pass
+
+
+def tokenize(source):
+    tokens, pos = [], 0
+    while pos < len(source):
+        m = _TOKEN_RE.match(source, pos)
+        if m is None:
+            raise GraphQLError(f'Syntax Error: unexpected character at {pos}')
+        pos = m.end()
+        kind = m.lastgroup
+        if kind != 'ws':
+            tokens.append((kind, m.group(kind)))
+    tokens.append(('eof', None))
+    return tokens
+
+
+class Parser:
+
+    def __init__(self, source, variables):
+        self.tokens = tokenize(source)
+        self.pos = 0
+        self.variables = variables or {}
+
+    def peek(self):
+        return self.tokens[self.pos]
+
+    def take(self, value=None):
+        tok = self.tokens[self.pos]
+        if value is not None and tok[1] != value:
+            raise GraphQLError(f'Syntax Error: expected {value}, got {tok[1]}')
+        self.pos += 1
+        return tok
+
+    def document(self):
+        '''Returns the selection set of the first operation.'''
+        if self.peek()[1] in ('query', 'subscription', 'mutation'):
+            self.take()
+            if self.peek()[0] == 'name':
+                self.take()
+            if self.peek()[1] == '(':
+                self.variable_definitions()
+        return self.selection_set()
+
+    def variable_definitions(self):
+        self.take('(')
+        while self.peek()[1] != ')':
+            self.take('$')
+            name = self.take()[1]
+            self.take(':')
+            self.type_ref()
+            if self.peek()[1] == '=':
+                self.take()
+                default = self.value()
+                self.variables.setdefault(name, default)
+        self.take(')')
+
+    def type_ref(self):
+        if self.peek()[1] == '[':
+            self.take()
+            self.type_ref()
+            self.take(']')
+        else:
+            self.take()
+        if self.peek()[1] == '!':
+            self.take()
+
+    def selection_set(self):
+        self.take('{')
+        fields = []
+        while self.peek()[1] != '}':
+            fields.append(self.field())
+        self.take('}')
+        return fields
+
+    def field(self):
+        name = self.take()[1]
+        alias = name
+        if self.peek()[1] == ':':
+            self.take()
+            name = self.take()[1]
+        args = {}
+        if self.peek()[1] == '(':
+            self.take()
+            while self.peek()[1] != ')':
+                arg = self.take()[1]
+                self.take(':')
+                args[arg] = self.value()
+            self.take(')')
+        selections = None
+        if self.peek()[1] == '{':
+            selections = self.selection_set()
+        return alias, name, args, selections
+
+    def value(self):
+        kind, tok = self.peek()
+        if tok == '$':
+            self.take()
+            name = self.take()[1]
+            if name not in self.variables:
+                raise GraphQLError(f'Variable "${name}" is not defined.')
+            return self.variables[name]
+        if tok == '[':
+            self.take()
+            out = []
+            while self.peek()[1] != ']':
+                out.append(self.value())
+            self.take(']')
+            return out
+        if tok == '{':
+            self.take()
+            out = {}
+            while self.peek()[1] != '}':
+                key = self.take()[1]
+                self.take(':')
+                out[key] = self.value()
+            self.take('}')
+            return out
+        self.take()
+        if kind == 'string':
+            return json.loads(tok)
+        if kind == 'number':
+            return float(tok) if any(c in tok for c in '.eE') else int(tok)
+        if tok in ('true', 'false'):
+            return tok == 'true'
+        if tok == 'null':
+            return None
+        return tok    # enum value, e.g. orderDirection: desc
+
+
+# ---------------------------------------------------------------------------
+# synthetic data
+# ---------------------------------------------------------------------------
+
+TYPES = ['single-choice', 'single-choice', 'single-choice', 'basic',
+         'approval', 'weighted', 'quadratic', 'ranked-choice']
+
+
+def _hex(seed, n):
+    return hashlib.sha256(seed.encode()).hexdigest()[:n]
+
+
+class Hub:
+    '''
+    Synthetic snapshot data. Votes of a proposal are generated on first
+    access (spread over the proposal's voting period) and only those
+    created before the current time are visible, so active proposals keep
+    receiving votes while the hub is running.
+    '''
+
+    def __init__(self, wallets=100, spaces=30, follows=10, active=3,
+                 closed=5, votes=500, voted_prob=0.3, seed=0):
+        self.rng = random.Random(seed)
+        self.seed = seed
+        self.votes_per_prop = votes
+        self.voted_prob = voted_prob
+        now = int(time.time())
+
+        self.wallets = ['0x' + _hex(f'{seed}:wallet:{i}', 40) for i in range(wallets)]
+        self.spaces = {}
+        for i in range(spaces):
+            sid = f'space{i}.eth'
+            self.spaces[sid] = {'id': sid, 'name': f'Space {i}'}
+
+        space_ids = list(self.spaces)
+        self.follows = []
+        self.followers = {sid: [] for sid in space_ids}
+        for n, wallet in enumerate(self.wallets):
+            k = min(follows, len(space_ids))
+            for j, sid in enumerate(self.rng.sample(space_ids, k)):
+                self.follows.append({
+                    'id': _hex(f'{seed}:follow:{wallet}:{sid}', 32),
+                    'follower': wallet, 'space': sid,
+                    'created': now - 10**6 + n * 100 + j,
+                })
+                self.followers[sid].append(wallet)
+
+        self.proposals = {}
+        for sid in space_ids:
+            for j in range(active + closed):
+                is_active = j < active
+                if is_active:
+                    start = now - self.rng.randint(3600, 3 * 86400)
+                    end = now + self.rng.randint(600, 5 * 86400)
+                else:
+                    end = now - self.rng.randint(86400, 60 * 86400)
+                    start = end - 5 * 86400
+                _type = self.rng.choice(TYPES)
+                n_choices = 2 if _type == 'basic' else self.rng.randint(2, 5)
+                choices = ['For', 'Against', 'Abstain'][:n_choices] if _type == 'basic' \
+                    else [f'Option {c+1}' for c in range(n_choices)]
+                pid = 'Qm' + _hex(f'{seed}:prop:{sid}:{j}', 44)
+                title = f'[{sid}] Proposal {j}'
+                if self.rng.random() < 0.05:
+                    title += ' - bot check, do not vote'
+                self.proposals[pid] = {
+                    'id': pid, 'title': title,
+                    'body': f'# Proposal {j}\n\n' + 'Lorem ipsum dolor sit amet. ' * 200,
+                    'choices': choices, 'start': start, 'end': end,
+                    'snapshot': str(15000000 + j), 'author': self.wallets[0],
+                    'type': _type, 'space': sid, 'created': start,
+                }
+        self._votes = {}
+
+    # -- derived data ------------------------------------------------------
+
+    def state(self, prop, now):
+        if prop['start'] > now:
+            return 'pending'
+        return 'active' if prop['end'] > now else 'closed'
+
+    def _choice(self, rng, prop, weights):
+        n = len(prop['choices'])
+        _type = prop['type']
+        if _type in ('single-choice', 'basic'):
+            return rng.choices(range(1, n + 1), weights)[0]
+        if _type == 'approval':
+            picked = [c for c in range(1, n + 1) if rng.random() < weights[c-1] / max(weights)]
+            return picked or [rng.randint(1, n)]
+        if _type in ('weighted', 'quadratic'):
+            top = rng.choices(range(1, n + 1), weights)[0]
+            out = {str(top): rng.randint(2, 10)}
+            for c in range(1, n + 1):
+                if c != top and rng.random() < 0.3:
+                    out[str(c)] = 1
+            return out
+        ranking = list(range(1, n + 1))
+        ranking.sort(key=lambda c: -weights[c-1] * rng.random())
+        return ranking
+
+    def votes_of(self, pid):
+        '''Returns all votes of a proposal, sorted by creation time.'''
+        if pid in self._votes:
+            return self._votes[pid]
+        prop = self.proposals[pid]
+        rng = random.Random(f'{self.seed}:votes:{pid}')
+        n = len(prop['choices'])
+        weights = [rng.random() ** 2 + 0.05 for _ in range(n)]
+        voters = [w for w in self.followers[prop['space']]
+                  if rng.random() < self.voted_prob]
+        voters += ['0x' + _hex(f'{pid}:{i}', 40) for i in range(self.votes_per_prop)]
+        votes = []
+        for i, voter in enumerate(voters):
+            created = rng.randint(prop['start'], prop['end'])
+            votes.append({
+                'id': '0x' + _hex(f'{pid}:vote:{i}', 64),
+                'voter': voter, 'created': created, 'proposal': pid,
+                'space': prop['space'], 'choice': self._choice(rng, prop, weights),
+                'vp': 1.0,
+            })
+        votes.sort(key=lambda v: v['created'])
+        self._votes[pid] = (votes, [v['created'] for v in votes])
+        return self._votes[pid]
+
+    def visible_votes(self, pid, now):
+        votes, created = self.votes_of(pid)
+        return votes[:bisect.bisect_right(created, now)]
+
+    def scores(self, prop, votes):
+        scores = [0.0] * len(prop['choices'])
+        for vote in votes:
+            choice = vote['choice']
+            if isinstance(choice, int):
+                choice = [choice]
+            if isinstance(choice, dict):
+                total = sum(choice.values())
+                for c, w in choice.items():
+                    if 0 < int(c) <= len(scores):
+                        scores[int(c)-1] += w / total
+            elif prop['type'] == 'ranked-choice':
+                scores[choice[0]-1] += 1
+            else:
+                for c in choice:
+                    if 0 < c <= len(scores):
+                        scores[c-1] += 1
+        return scores
+
+    # -- resolvers ---------------------------------------------------------
+
+    def records(self, collection, where, now):
+        '''Returns candidate records for a root field, pre-filtered by the
+        most selective where clause available.'''
+        where = where or {}
+        if collection == 'votes':
+            if 'proposal' in where or 'proposal_in' in where:
+                pids = [where['proposal']] if 'proposal' in where else where['proposal_in']
+                out = []
+                for pid in pids:
+                    if pid in self.proposals:
+                        out += self.visible_votes(pid, now)
+                return out
+            out = []
+            for pid in self.proposals:
+                out += self.visible_votes(pid, now)
+            return out
+        if collection == 'follows':
+            return self.follows
+        if collection == 'proposals':
+            out = []
+            for p in self.proposals.values():
+                rec = dict(p)
+                rec['state'] = self.state(p, now)
+                out.append(rec)
+            return out
+        raise GraphQLError(f'Cannot query field "{collection}" on type "Query".')
+
+
+OPS = ('_not_in', '_in', '_gte', '_gt', '_lte', '_lt')
+
+
+def _norm(value):
+    return value.lower() if isinstance(value, str) else value
+
+
+def _matches(record, where):
+    for key, cond in where.items():
+        op = next((o for o in OPS if key.endswith(o)), '')
+        field = key[:len(key) - len(op)]
+        if field not in record:
+            raise GraphQLError(f'Unknown where clause "{key}".')
+        value = _norm(record[field])
+        if op in ('_in', '_not_in'):
+            hit = value in {_norm(c) for c in cond}
+            if hit != (op == '_in'):
+                return False
+        elif op == '_gt':
+            if not value > cond: return False
+        elif op == '_gte':
+            if not value >= cond: return False
+        elif op == '_lt':
+            if not value < cond: return False
+        elif op == '_lte':
+            if not value <= cond: return False
+        elif value != _norm(cond):
+            return False
+    return True
+
+
+def _project(hub, record, selections, kind, now):
+    out = {}
+    for alias, name, args, sub in selections:
+        if name == '__typename':
+            out[alias] = kind
+            continue
+        if kind == 'Proposal' and name == 'space':
+            value = hub.spaces[record['space']]
+            value = _project(hub, value, sub, 'Space', now) if sub else value['id']
+        elif kind in ('Vote', 'Follow') and name == 'space':
+            value = _project(hub, hub.spaces[record['space']], sub, 'Space', now)
+        elif kind == 'Vote' and name == 'proposal':
+            prop = dict(hub.proposals[record['proposal']])
+            prop['state'] = hub.state(prop, now)
+            value = _project(hub, prop, sub, 'Proposal', now)
+        elif kind == 'Proposal' and name in ('votes', 'scores', 'scores_total', 'scores_state'):
+            votes = hub.visible_votes(record['id'], now)
+            if name == 'votes':
+                value = len(votes)
+            elif name == 'scores_state':
+                value = 'final' if record['state'] == 'closed' else 'pending'
+            else:
+                scores = hub.scores(record, votes)
+                value = scores if name == 'scores' else sum(scores)
+        elif name in record:
+            value = record[name]
+        else:
+            raise GraphQLError(f'Cannot query field "{name}" on type "{kind}".')
+        out[alias] = value
+    return out
+
+
+KINDS = {'votes': 'Vote', 'follows': 'Follow', 'proposals': 'Proposal'}
+
+
+def execute(hub, query, variables=None, max_first=None):
+    now = int(time.time())
+    fields = Parser(query, variables).document()
+    data = {}
+    for alias, name, args, sub in fields:
+        if name == 'proposal':
+            prop = hub.proposals.get(args.get('id'))
+            if prop is None:
+                data[alias] = None
+                continue
+            rec = dict(prop)
+            rec['state'] = hub.state(prop, now)
+            data[alias] = _project(hub, rec, sub, 'Proposal', now)
+            continue
+        if name not in KINDS:
+            raise GraphQLError(f'Cannot query field "{name}" on type "Query".')
+        where = args.get('where') or {}
+        records = [r for r in hub.records(name, where, now) if _matches(r, where)]
+        order = args.get('orderBy')
+        if order:
+            records.sort(key=lambda r: r[order],
+                         reverse=args.get('orderDirection', 'desc') == 'desc')
+        first = args.get('first', 20)
+        if max_first is not None and first > max_first:
+            raise GraphQLError(f'The number of items to return must be less than or equal to {max_first}')
+        skip = args.get('skip', 0)
+        data[alias] = [_project(hub, r, sub, KINDS[name], now)
+                       for r in records[skip:skip + first]]
+    return data
+
+
+# ---------------------------------------------------------------------------
+# http server
+# ---------------------------------------------------------------------------
+
+class Stats:
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.throttled = 0
+        self.bytes_sent = 0
+        self.by_root = {}
+
+
+def make_app(hub, latency=0.0, rate_limit=None, max_first=None):
+    '''
+    Returns an aiohttp application serving the hub at /graphql.
+    latency: seconds added to every response.
+    rate_limit: max. requests per second before answering 429.
+    '''
+    from aiohttp import web
+
+    stats = Stats()
+    window = []
+
+    async def graphql(request):
+        now = time.monotonic()
+        if rate_limit is not None:
+            while window and window[0] < now - 1:
+                window.pop(0)
+            if len(window) >= rate_limit:
+                stats.throttled += 1
+                return web.Response(
+                        status=429, text='<html><body>Too Many Requests</body></html>',
+                        content_type='text/html', headers={'Retry-After': '1'})
+            window.append(now)
+
+        stats.requests += 1
+        body = await request.json()
+        if latency:
+            await asyncio.sleep(latency)
+        try:
+            data = execute(hub, body['query'], body.get('variables'), max_first)
+            for root in data:
+                stats.by_root[root] = stats.by_root.get(root, 0) + 1
+            out = {'data': data}
+        except GraphQLError as e:
+            out = {'errors': [{'message': str(e)}]}
+        text = json.dumps(out)
+        stats.bytes_sent += len(text)
+        return web.Response(text=text, content_type='application/json')
+
+    async def get_stats(request):
+        return web.json_response(vars(stats))
+
+    async def reset_stats(request):
+        stats.reset()
+        return web.json_response({})
+
+    app = web.Application(client_max_size=64 * 1024**2)
+    app.router.add_post('/graphql', graphql)
+    app.router.add_get('/stats', get_stats)
+    app.router.add_post('/stats/reset', reset_stats)
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--wallets', type=int, default=100)
+    parser.add_argument('--spaces', type=int, default=30)
+    parser.add_argument('--follows', type=int, default=10, help='spaces followed per wallet')
+    parser.add_argument('--active', type=int, default=3, help='active proposals per space')
+    parser.add_argument('--closed', type=int, default=5, help='closed proposals per space')
+    parser.add_argument('--votes', type=int, default=500, help='votes per proposal')
+    parser.add_argument('--voted-prob', type=float, default=0.3)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per response')
+    parser.add_argument('--rate-limit', type=int, default=None, help='requests per second')
+    parser.add_argument('--max-first', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--write-wallets', default=None, help='write wallet addresses to this file')
+    args = parser.parse_args(argv)
+
+    hub = Hub(wallets=args.wallets, spaces=args.spaces, follows=args.follows,
+              active=args.active, closed=args.closed, votes=args.votes,
+              voted_prob=args.voted_prob, seed=args.seed)
+    if args.write_wallets:
+        with open(args.write_wallets, 'w') as f:
+            f.write('\n'.join(hub.wallets) + '\n')
+
+    from aiohttp import web
+    app = make_app(hub, latency=args.latency, rate_limit=args.rate_limit,
+                   max_first=args.max_first)
+    print(f'Serving synthetic snapshot hub on http://127.0.0.1:{args.port}/graphql', flush=True)
+    web.run_app(app, host='127.0.0.1', port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
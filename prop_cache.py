@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Persistent on-disk cache for proposal metadata
+"""
+
+import json, sqlite3, time
+
+
+class ProposalCache:
+    '''
+    SQLite-backed cache of proposal metadata, keyed by proposal id.
+    Only fields that don't change after a proposal has been created
+    (title, choices, type, space, ...) are cached, so entries are served
+    forever. At most {max_entries} proposals are kept, the least recently
+    used ones are evicted first.
+    '''
+
+    def __init__(self, path, max_entries=20000):
+        self.path = path
+        self.max_entries = max_entries
+        self.con = sqlite3.connect(path, timeout=30)
+        self.con.execute('''
+            CREATE TABLE IF NOT EXISTS proposals (
+                id TEXT PRIMARY KEY,
+                data TEXT NOT NULL,
+                fetched REAL NOT NULL,
+                used REAL NOT NULL
+            )''')
+        self.con.execute(
+                'CREATE INDEX IF NOT EXISTS proposals_used ON proposals (used)'
+                )
+        self.con.commit()
+
+    def get_many(self, ids):
+        '''Returns dict of shape {prop_id: metadata, ...} for all cached ids.'''
+        ids = list(ids)
+        now = time.time()
+        out = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i+500]
+            rows = self.con.execute(
+                    'SELECT id, data FROM proposals WHERE id IN (%s)'
+                    % ','.join('?' * len(chunk)), chunk
+                    ).fetchall()
+            for _id, data in rows:
+                out[_id] = json.loads(data)
+
+        # mark hits as recently used (for eviction)
+        self.con.executemany(
+                'UPDATE proposals SET used = ? WHERE id = ?',
+                [(now, _id) for _id in out]
+                )
+        self.con.commit()
+        return out
+
+    def put_many(self, props):
+        '''Stores dict of shape {prop_id: metadata, ...}.'''
+        now = time.time()
+        self.con.executemany(
+                'INSERT OR REPLACE INTO proposals VALUES (?, ?, ?, ?)',
+                [(_id, json.dumps(data), now, now) for _id, data in props.items()]
+                )
+        self.evict()
+        self.con.commit()
+
+    def evict(self):
+        '''Removes least recently used entries beyond max_entries.'''
+        n = self.con.execute('SELECT COUNT(*) FROM proposals').fetchone()[0]
+        if n > self.max_entries:
+            self.con.execute('''
+                DELETE FROM proposals WHERE id IN (
+                    SELECT id FROM proposals ORDER BY used LIMIT ?
+                )''', (n - self.max_entries,))
+
+    def close(self):
+        self.con.close()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Builds parameterized graphql queries that request only the given fields
+"""
+
+
+# graphql types of the arguments used with the snapshot hub
+ARG_TYPES = {
+    'id': 'String!',
+    'first': 'Int',
+    'skip': 'Int',
+    'orderBy': 'String',
+    'orderDirection': 'OrderDirection',
+}
+WHERE_TYPES = {
+    'votes': 'VoteWhere',
+    'proposals': 'ProposalWhere',
+    'follows': 'FollowWhere',
+}
+
+
+def selection(fields, indent=2):
+    '''
+    Renders a list of fields as graphql selection set. A field is either
+    a name or a dict of shape {name: [sub-field, ...]}.
+    '''
+    pad = '  ' * indent
+    lines = []
+    for field in fields:
+        if isinstance(field, dict):
+            for name, sub in field.items():
+                lines.append(f'{pad}{name} {selection(sub, indent + 1)}')
+        else:
+            lines.append(pad + field)
+    return '{\n' + '\n'.join(lines) + '\n' + '  ' * (indent - 1) + '}'
+
+
+class Query:
+    '''
+    Graphql query of one or more (aliased) root fields. All arguments are
+    sent as variables ($<alias>_<argument>) next to the query text, so the
+    text only depends on the shape of the query, never on the values.
+
+    q = Query('Votes')
+    q.add('votes', ['id', 'created'], where={'proposal': prop_id}, first=1000)
+    json_from_query(q.payload())
+    '''
+
+    def __init__(self, name='Query'):
+        self.name = name
+        self.roots = []      # (alias, root, fields, args)
+
+    def add(self, root, fields, alias=None, **args):
+        '''
+        Adds root field {root} (a collection like 'votes' or a single object
+        like 'proposal'), requesting only {fields} (see selection). Returns
+        the key of its results in the response data (alias or root).
+        '''
+        self.roots.append((alias, root, fields, args))
+        return alias or root
+
+    @property
+    def variables(self):
+        return {
+            f'{alias or root}_{arg}': value
+            for alias, root, _, args in self.roots
+            for arg, value in args.items()
+        }
+
+    def text(self):
+        defs, lines = [], []
+        for alias, root, fields, args in self.roots:
+            key = alias or root
+            refs = []
+            for arg in args:
+                var = f'{key}_{arg}'
+                defs.append(f'${var}: ' + (WHERE_TYPES[root] if arg == 'where' else ARG_TYPES[arg]))
+                refs.append(f'{arg}: ${var}')
+            head = f'{alias}: {root}' if alias else root
+            if refs != []:
+                head += '(' + ', '.join(refs) + ')'
+            lines.append(f'  {head} {selection(fields)}')
+        head = f'query {self.name}' + ('(' + ', '.join(defs) + ')' if defs else '')
+        return head + ' {\n' + '\n'.join(lines) + '\n}'
+
+    def payload(self):
+        '''Returns the request body: {'query': text, 'variables': {...}}.'''
+        return {'query': self.text(), 'variables': self.variables}
+
+
+def query(root, fields, name='Query', **args):
+    '''Returns request body of a query with a single root field.'''
+    q = Query(name)
+    q.add(root, fields, **args)
+    return q.payload()
+
+
+def batch(queries, name=None):
+    '''
+    Combines queries into one, the root fields of query i aliased as
+    q<i>_<n> (n counting the root fields of each query). Queries of the
+    same shape give the same text, so the hub only has to parse each
+    batch shape once. Returns tuple (combined Query, dict mapping each
+    alias to (i, key of the root field in query i)).
+    '''
+    queries = list(queries)
+    combined = Query(name or (queries[0].name if queries else 'Query'))
+    keys = {}
+    for i, q in enumerate(queries):
+        for n, (alias, root, fields, args) in enumerate(q.roots):
+            key = combined.add(root, fields, alias=f'q{i}_{n}', **args)
+            keys[key] = (i, alias or root)
+    return combined, keys
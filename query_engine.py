@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Asynchronous engine that sends all graphql queries to the snapshot hub
+"""
+
+import asyncio, atexit, json, os, random, threading, time
+from email.utils import parsedate_to_datetime
+from metrics import QueryMetrics
+from json_stream import RecordStream
+
+
+HUB_URL = os.environ.get('SNAPSHOT_HUB_URL', 'https://hub.snapshot.org/graphql')
+CONCURRENCY = 10      # max. number of queries in flight at the same time
+RATE_LIMIT = 20       # max. number of requests per second
+MIN_RATE = 0.5        # requests per second the limiter never goes below
+RATE_STEP = 1         # requests per second the rate grows by per second without throttling
+MAX_RETRIES = 6       # attempts per query after the first one
+STREAM_CHUNK = 2**16  # bytes read from the socket at a time when streaming records
+BACKOFF_BASE = 0.5    # seconds, doubled on every retry (plus jitter)
+BACKOFF_MAX = 30      # seconds
+RETRY_STATUS = (429, 500, 502, 503, 504)   # hub is overloaded or failing -> slow down, retry
+
+# outcomes of a request, reported to AdaptiveLimiter.release
+OK = 'ok'                 # the hub answered
+CONGESTED = 'congested'   # throttled, server error or timeout
+FAILED = 'failed'         # no usable answer for another reason (connection, body)
+
+
+class AdaptiveLimiter:
+    '''
+    Client-side limit on requests to the hub: a token bucket holding the
+    request rate and an AIMD window holding the number of requests in
+    flight. Each answered request grows the window by 1/window (one
+    request per round trip) and the rate by {rate_step}/rate (about
+    {rate_step} requests per second, per second). A congested request
+    (throttled, server error or timeout) halves both, at most once per
+    second, other failures leave them as they are. A Retry-After of the
+    hub pauses all requests until then.
+    Lives on the engine's event loop, all methods are coroutines.
+    '''
+
+    def __init__(self, rate=RATE_LIMIT, concurrency=CONCURRENCY,
+                 min_rate=MIN_RATE, rate_step=RATE_STEP):
+        self.max_rate = self.rate = float(rate)
+        self.max_window = self.window = float(concurrency)
+        self.min_rate = min_rate
+        self.rate_step = rate_step
+        self.tokens = 1.0
+        self.in_flight = 0
+        self.resume_at = 0.0
+        self._refilled = time.monotonic()
+        self._decreased = 0.0
+        self._cond = asyncio.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(
+                self.tokens + (now - self._refilled) * self.rate, max(self.rate, 1)
+                )
+        self._refilled = now
+
+    async def acquire(self):
+        '''Waits until a request may be sent.'''
+        async with self._cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self.resume_at:
+                    timeout = self.resume_at - now
+                elif self.in_flight >= int(self.window):
+                    timeout = None
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return
+                else:
+                    timeout = (1 - self.tokens) / self.rate
+                try:
+                    await asyncio.wait_for(self._cond.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, outcome=OK, retry_after=None):
+        '''Reports the outcome (OK, CONGESTED, FAILED) of a request sent after acquire().'''
+        async with self._cond:
+            now = time.monotonic()
+            self._refill(now)
+            self.in_flight -= 1
+            if outcome == OK:
+                self.window = min(self.max_window, self.window + 1 / self.window)
+                self.rate = min(self.max_rate, self.rate + self.rate_step / self.rate)
+            elif outcome == CONGESTED and now - self._decreased > 1:
+                self.window = max(1.0, self.window / 2)
+                self.rate = max(self.min_rate, self.rate / 2)
+                self.tokens = min(self.tokens, 1.0)
+                self._decreased = now
+            if retry_after:
+                self.resume_at = max(self.resume_at, now + retry_after)
+            self._cond.notify_all()
+
+
+def parse_retry_after(value):
+    '''Returns seconds to wait from a Retry-After header (or None).'''
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt, retry_after=None):
+    '''Seconds to wait before retry number {attempt} (full jitter).'''
+    jitter = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+    return (retry_after or 0) + jitter
+
+
+class QueryEngine:
+    '''
+    Runs an asyncio event loop in a background thread, holding a single
+    aiohttp session (one pool of keep-alive connections) for the whole run.
+    Queries can be sent one at a time (query) or fanned out concurrently
+    (query_many). Either way, requests pass an AdaptiveLimiter (at most
+    {concurrency} in flight and {rate} per second, less while the hub
+    throttles), and throttled or failed requests are retried with backoff.
+    Every request is recorded in self.metrics under the kind of query
+    given by the caller (see metrics.QueryMetrics).
+    '''
+
+    def __init__(self, url=HUB_URL, concurrency=CONCURRENCY, rate=RATE_LIMIT):
+        self.url = url
+        self.concurrency = concurrency
+        self.rate = rate
+        self._loop = None
+        self._thread = None
+        self._session = None
+        self._limiter = None
+        self._lock = threading.Lock()
+        self.metrics = QueryMetrics()
+
+    def _start(self):
+        '''Starts event loop and connection pool on first use.'''
+        with self._lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, daemon=True)
+            thread.start()
+            asyncio.run_coroutine_threadsafe(self._open(), loop).result()
+            self._loop, self._thread = loop, thread
+
+    async def _open(self):
+        import aiohttp
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        self._session = aiohttp.ClientSession(connector=connector)
+        self._limiter = AdaptiveLimiter(self.rate, self.concurrency)
+
+    async def _send(self, query, kind):
+        '''
+        Sends the query (a query string or a request body with variables,
+        see query_builder) once. Returns tuple (response as dict, or None if
+        the request should be retried; seconds to wait from the hub's
+        Retry-After header).
+        '''
+        import aiohttp
+        await self._limiter.acquire()
+        started = time.perf_counter()
+        n_bytes, ok, outcome, retry_after, out_json = 0, False, FAILED, None, None
+        try:
+            payload = query if isinstance(query, dict) else {'query': query}
+            async with self._session.post(self.url, json=payload) as r:
+                response = await r.read()
+                status = r.status
+                retry_after = parse_retry_after(r.headers.get('Retry-After'))
+            n_bytes = len(response)
+            if status in RETRY_STATUS:
+                outcome = CONGESTED
+            else:
+                out_json = json.loads(response)
+                ok = 'errors' not in out_json
+                outcome = OK
+        except asyncio.TimeoutError:
+            outcome = CONGESTED
+        except (aiohttp.ClientError, ValueError):
+            pass    # not json (e.g. a proxy error page): retried
+        finally:
+            await self._limiter.release(outcome, retry_after)
+            self.metrics.record(
+                    kind, time.perf_counter() - started, n_bytes, error=not ok
+                    )
+        return out_json, retry_after
+
+    async def _send_stream(self, query, kind, on_records, delivered):
+        '''
+        Same as _send, but decodes the record lists of the response while
+        they are received and passes them to on_records(key, records) in
+        batches, key being the root field or alias of the list (see
+        json_stream.RecordStream). Records whose (key, id) is in delivered
+        (passed on by an earlier attempt that failed midway) are skipped.
+        Returns the response with its record lists emptied.
+        '''
+        import aiohttp
+        await self._limiter.acquire()
+        started = time.perf_counter()
+        n_bytes, ok, outcome, retry_after, out_json = 0, False, FAILED, None, None
+
+        def pass_on(groups):
+            for key, records in groups:
+                records = [x for x in records if (key, x['id']) not in delivered]
+                delivered.update((key, x['id']) for x in records)
+                if records != []:
+                    on_records(key, records)
+
+        try:
+            payload = query if isinstance(query, dict) else {'query': query}
+            async with self._session.post(self.url, json=payload) as r:
+                status = r.status
+                retry_after = parse_retry_after(r.headers.get('Retry-After'))
+                if status in RETRY_STATUS:
+                    n_bytes = len(await r.read())
+                    outcome = CONGESTED
+                else:
+                    stream = RecordStream()
+                    async for chunk in r.content.iter_chunked(STREAM_CHUNK):
+                        n_bytes += len(chunk)
+                        pass_on(stream.feed(chunk))
+                    try:
+                        groups, out_json = stream.close()
+                    except ValueError:    # incomplete or not json
+                        groups = []
+                    else:
+                        ok = 'errors' not in out_json
+                        outcome = OK
+                    pass_on(groups)
+        except asyncio.TimeoutError:
+            outcome = CONGESTED
+        except (aiohttp.ClientError, ValueError):
+            pass    # not json or not utf-8 (e.g. a proxy error page): retried
+        finally:
+            await self._limiter.release(outcome, retry_after)
+            self.metrics.record(
+                    kind, time.perf_counter() - started, n_bytes, error=not ok
+                    )
+        return out_json, retry_after
+
+    async def _post(self, query, kind, on_records=None):
+        delivered = set()
+        for attempt in range(MAX_RETRIES + 1):
+            if on_records is None:
+                out_json, retry_after = await self._send(query, kind)
+            else:
+                out_json, retry_after = await self._send_stream(
+                        query, kind, on_records, delivered
+                        )
+            if out_json is not None:
+                break
+            if attempt == MAX_RETRIES:
+                raise ConnectionError(
+                        f'No valid response from {self.url} after {attempt + 1} attempts.'
+                        )
+            self.metrics.record_retry(kind)
+            await asyncio.sleep(backoff(attempt, retry_after))
+
+        assert 'errors' not in out_json, f"Caught an error: {out_json['errors']}"
+        return out_json
+
+    async def _gather(self, queries, kind):
+        return await asyncio.gather(*(self._post(q, kind) for q in queries))
+
+    async def _gather_stream(self, queries, kind, on_records):
+        return await asyncio.gather(*(
+            self._post(q, kind, lambda key, records, i=i: on_records(i, key, records))
+            for i, q in enumerate(queries)
+        ))
+
+    def _run(self, coro):
+        self._start()
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def query(self, query, kind='other'):
+        '''
+        Returns the response of a single graphql query as dictionary. The
+        query is a string or a request body of shape {'query': ...,
+        'variables': {...}} (see query_builder).
+        '''
+        return self._run(self._post(query, kind))
+
+    def query_many(self, queries, kind='other'):
+        '''
+        Sends all queries concurrently, returns list of responses in the
+        same order as the queries.
+        '''
+        queries = list(queries)
+        if queries == []:
+            return []
+        return self._run(self._gather(queries, kind))
+
+    def stream_many(self, queries, on_records, kind='other'):
+        '''
+        Sends all queries concurrently and streams the record lists of each
+        response: on_records(i, key, records) is called with each batch of
+        records of query i as soon as it is decoded (on the engine's event
+        loop thread), key being the root field or alias they belong to, so
+        a response is never held in memory as a whole. Records must have an
+        'id', which keeps retries from passing on a record twice. Returns
+        list of the responses with their record lists emptied.
+        '''
+        queries = list(queries)
+        if queries == []:
+            return []
+        return self._run(self._gather_stream(queries, kind, on_records))
+
+    def close(self):
+        '''Closes connection pool and stops the event loop.'''
+        with self._lock:
+            if self._loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(
+                    self._session.close(), self._loop
+                    ).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._loop.close()
+            self._loop = self._thread = self._session = self._limiter = None
+
+
+_engine = None
+
+
+def get_engine():
+    '''Returns the engine shared by all queries of this process.'''
+    global _engine
+    if _engine is None:
+        _engine = QueryEngine()
+    return _engine
+
+
+def configure(url=None, concurrency=None, rate=None):
+    '''
+    Replaces the shared engine with one using a different hub url,
+    concurrency limit and/or max. request rate (requests per second).
+    '''
+    global _engine
+    old = get_engine()
+    old.close()
+    _engine = QueryEngine(
+            url=url if url is not None else old.url,
+            concurrency=concurrency if concurrency is not None else old.concurrency,
+            rate=rate if rate is not None else old.rate
+            )
+    _engine.metrics = old.metrics
+    return _engine
+
+
+@atexit.register
+def _close_engine():
+    if _engine is not None:
+        _engine.close()
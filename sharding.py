@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Runs export_to_vote and create_choices_json across several processes
+"""
+
+import os, random
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import functions
+import query_engine
+from functions import (
+        cond_log, chunks, load_wallets, read_from_json, write_to_json,
+        get_joined_spaces_many, get_active_proposals_by_space,
+        already_voted_many, select_to_vote, get_prop_data_many
+        )
+
+
+# settings of functions.py that workers take over from the parent, so
+# changes made at runtime (e.g. functions.VOTE_BUDGET = 500) apply to them
+SHARED_SETTINGS = (
+        'logging', 'IGNORE_LIST', 'PAGE_SIZE', 'VOTE_BUDGET', 'SAMPLE_CONFIDENCE',
+        'SAMPLE_PAGE', 'WALLET_CHUNK', 'SPACE_CHUNK', 'PROP_CHUNK', 'VOTE_BATCH',
+        'PROP_CACHE_SIZE'
+        )
+
+
+def split(items, n):
+    '''Splits items (sorted) into at most n contiguous, equally sized shards.'''
+    items = sorted(items)
+    return chunks(items, -(-len(items) // n)) if items != [] else []
+
+
+def _init_worker(url, concurrency, rate, settings):
+    '''Runs once in each worker process: shares the parent's settings.'''
+    query_engine.configure(url=url, concurrency=concurrency, rate=rate)
+    for name, value in settings.items():
+        setattr(functions, name, value)
+
+
+def _pool(workers):
+    '''
+    Returns a process pool whose workers split the parent's concurrency
+    and request rate between them, so the hub sees the same load as from
+    a single process. Workers are spawned (not forked), as the parent's
+    event loop thread wouldn't survive a fork.
+    '''
+    engine = query_engine.get_engine()
+    return ProcessPoolExecutor(
+            max_workers=workers, mp_context=get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(
+                engine.url, max(1, engine.concurrency // workers),
+                engine.rate / workers,
+                dict({name: getattr(functions, name) for name in SHARED_SETTINGS},
+                     PROP_CACHE_PATH=os.path.abspath(functions.PROP_CACHE_PATH))
+                )
+            )
+
+
+def _take_metrics():
+    '''Returns the request metrics of this worker's task and resets them.'''
+    metrics = functions.query_metrics()
+    kinds = metrics.snapshot()
+    metrics.reset()
+    return kinds
+
+
+def _merged(parts):
+    '''
+    Takes the (result, metrics) pairs of worker tasks. Adds the metrics
+    to those of this process, returns the results.
+    '''
+    results = []
+    for result, kinds in parts:
+        functions.query_metrics().merge(kinds)
+        results.append(result)
+    return results
+
+
+# -- worker tasks (module level, so they can be pickled) --------------------
+# each returns tuple (result, request metrics of the task)
+
+def _follows(wallets):
+    spaces_d = get_joined_spaces_many(wallets)
+    return {w: sorted(spaces) for w, spaces in spaces_d.items()}, _take_metrics()
+
+
+def _active(spaces):
+    props_d = get_active_proposals_by_space(spaces)
+    return {s: sorted(props) for s, props in props_d.items()}, _take_metrics()
+
+
+def _select(wallets, spaces_d, active_d, voted_d, seed):
+    '''
+    Selects the proposals to vote on for a shard of wallets. Votes of the
+    wallets are only queried if voted_d is None (no already_voted.json).
+    '''
+    if voted_d is None:
+        voted_d = already_voted_many({w: sorted(active_d[w]) for w in wallets})
+    to_vote_d = select_to_vote(wallets, voted_d, spaces_d, active_d, seed=seed)
+    return (to_vote_d, voted_d), _take_metrics()
+
+
+def _tally(proposals):
+    return get_prop_data_many(proposals), _take_metrics()
+
+
+# -- sharded stages ---------------------------------------------------------
+
+def export_to_vote_sharded(wallet_path, already_voted_path, export_path,
+                           workers=None, seed=None, export=True):
+    '''
+    Same as export_to_vote, with the wallets split across {workers}
+    processes (default: one per cpu). Work that depends on spaces rather
+    than wallets (active proposals) is split by space instead, so each
+    space is queried by one worker only. Diversity is drawn per wallet
+    from (seed, wallet) with one seed for the whole run, so the merged
+    to_vote.json is byte-identical for any number of workers (given the
+    same seed and the same data on the hub).
+    With a VOTE_STORE_PATH, the votes of the wallets are synced into the
+    vote store by the parent process (see functions.load_voting_history),
+    otherwise they are read from already_voted.json or queried by the
+    workers to create it.
+    '''
+    workers = workers or os.cpu_count()
+    seed = seed if seed is not None else random.randrange(2**32)
+    wallets = load_wallets(wallet_path)
+    voted_all = None
+    if functions.VOTE_STORE_PATH is not None:
+        from vote_store import VoteStore
+        store = VoteStore(functions.VOTE_STORE_PATH)
+        store.import_json(already_voted_path)
+    elif os.path.isfile(already_voted_path):
+        voted_all = read_from_json(already_voted_path)
+    else:
+        print(f'Couldn\'t find {already_voted_path}. Trying to create it...')
+
+    cond_log(f'Querying graphql with {workers} processes...')
+    with _pool(workers) as pool:
+        wallet_shards = split(wallets, workers)
+
+        spaces_d = {}
+        for part in _merged(pool.map(_follows, wallet_shards)):
+            spaces_d.update(part)
+
+        all_spaces = set().union(*spaces_d.values())
+        props_d = {}
+        for part in _merged(pool.map(_active, split(all_spaces, workers))):
+            props_d.update(part)
+        active_d = {
+            w: set().union(*(props_d[s] for s in spaces))
+            for w, spaces in spaces_d.items()
+        }
+        if functions.VOTE_STORE_PATH is not None:
+            voted_all = store.sync(active_d)
+            store.close()
+
+        futures = [
+            pool.submit(
+                _select, shard, {w: spaces_d[w] for w in shard},
+                {w: active_d[w] for w in shard},
+                None if voted_all is None else {w: voted_all.get(w, []) for w in shard},
+                seed
+            )
+            for shard in wallet_shards
+        ]
+        to_vote_d, voted_d = {}, {}
+        for part, voted in _merged(future.result() for future in futures):
+            to_vote_d.update(part)
+            voted_d.update(voted)
+
+    to_vote_d = {w: to_vote_d[w] for w in sorted(to_vote_d)}
+    if voted_all is None and functions.VOTE_STORE_PATH is None:
+        write_to_json({w: voted_d[w] for w in sorted(voted_d)}, already_voted_path)
+        cond_log(f'\nCreated a new {already_voted_path.strip("./")}.')
+    if export:
+        write_to_json(to_vote_d, export_path)
+        cond_log(f'\n...updated {export_path.strip("./")}')
+
+    return to_vote_d
+
+
+def tally_sharded(proposals, workers=None):
+    '''
+    Same as get_prop_data_many, with the unique proposals split across
+    {workers} processes (default: one per cpu), so each proposal is
+    tallied exactly once. Returns dict of shape {prop_id: metadata, ...}
+    in sorted order.
+    '''
+    workers = workers or os.cpu_count()
+    prop_data_d = {}
+    with _pool(workers) as pool:
+        for part in _merged(pool.map(_tally, split(proposals, workers))):
+            prop_data_d.update(part)
+    return {p: prop_data_d[p] for p in sorted(prop_data_d)}
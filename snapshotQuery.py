@@ -5,37 +5,32 @@ Written by Al Matty <al@almatty.com>
 """
 
 from functions import *
-from time import sleep
 
 # file paths
 wallet_path = './wallets.txt'                # text file, 1 wallet per row
-already_voted_path = './already_voted.json'  # path to voting history (not strictly necessary)
+already_voted_path = './already_voted.json'  # voting history, imported into functions.VOTE_STORE_PATH if present (not strictly necessary)
 export_json_path = './to_vote.json'
 export_csv_path = './to_vote.csv'
 encr_pk_path = '../encrPK.json'
 choices_json_path = './choices.json'
+sync_state_path = None                       # e.g. './sync_state.json' to only query what changed since the last run
+metrics_path = None                          # e.g. './snapshot_query.prom' to export request metrics for Prometheus
+normalized_choices = False                   # True = compact choices.json storing each proposal once (see read_choices)
+workers = 1                                  # number of processes to split wallets and proposals across
 
-
-# run script and export proposals up for voting per wallet
-export_to_vote(wallet_path, already_voted_path, export_json_path)
-
-# if there are proposals to vote on, create a json with its most popular choice
-sleep(1)
-create_choices_json(export_json_path, choices_json_path)
-
-# filter out proposals with much less engagement than usual
-sleep(1)
-#filter_out_low_engagement_props(choices_json_path)
-
-# filter out proposals that might try to identify automated voting
-sleep(1)
+# proposals containing one of these in the title are ignored (might try
+# to identify automated voting)
 triggers = ['bot', 'sybil', 'human', 'Do not vote', 'Don\'t vote']
-filter_out_bot_catcher_proposals(choices_json_path, triggers)
 
-# change choice values in json file to work with weighted votes
-sleep(1)
-enable_weighted_vote(choices_json_path)
 
-# create csv file with names of snapshot spaces resolved (optional)
-sleep(1)
-export_readable_csv(export_json_path, export_csv_path)
+# query proposals up for voting per wallet, their most popular choice,
+# filter out proposals with much less engagement than usual or containing
+# a trigger word, and export to_vote.json, choices.json and to_vote.csv
+# (guarded, since worker processes import this module again)
+if __name__ == '__main__':
+    run_pipeline(
+        wallet_path, already_voted_path, export_json_path, choices_json_path,
+        export_csv_path=export_csv_path, triggers=triggers, low_engagement=True,
+        state_path=sync_state_path, metrics_path=metrics_path,
+        normalized=normalized_choices, workers=workers
+    )
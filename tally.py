@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Vectorized vote counting, used by functions.VoteTally
+"""
+
+from itertools import chain
+from math import sqrt
+from statistics import NormalDist
+import numpy as np
+
+
+def _flatten(lists):
+    '''
+    Takes a list of sequences. Returns tuple (row index of every element,
+    position of every element within its row, lengths of rows).
+    '''
+    lengths = np.fromiter(map(len, lists), dtype=np.int64, count=len(lists))
+    rows = np.repeat(np.arange(len(lists)), lengths)
+    offsets = np.cumsum(lengths) - lengths
+    positions = np.arange(lengths.sum()) - np.repeat(offsets, lengths)
+    return rows, positions, lengths
+
+
+class _ChoiceIndex(dict):
+    '''Maps choice keys ("1", "2", ...) to column indices, -1 if unknown.'''
+
+    def __init__(self, n_choices):
+        super().__init__((str(i+1), i) for i in range(n_choices))
+
+    def __missing__(self, key):
+        try:
+            return int(key) - 1
+        except (TypeError, ValueError):
+            return -1
+
+
+def count_single_choice(choices, n_choices):
+    '''
+    Takes a list of single choice votes (ints). Returns tuple
+    (counts per choice as array of length n_choices, list of outsider
+    choices that aren't among the possible choices).
+    '''
+    arr = np.fromiter(choices, dtype=np.int64, count=len(choices))
+    valid = (arr >= 1) & (arr <= n_choices)
+    counts = np.bincount(arr[valid] - 1, minlength=n_choices)
+    outsiders = arr[~valid].tolist()
+    return counts, outsiders
+
+
+def count_top_weighted(choices, n_choices):
+    '''
+    Takes a list of weighted / quadratic votes (dicts {"choice": weight}).
+    Counts for each vote the choice voted highest (ties: the key that comes
+    first in the vote's dict), like quadratic_voting_get_most_popular.
+    Votes giving equal weight to all possible choices aren't counted.
+    Returns counts per choice as array of length n_choices.
+    '''
+    n_votes = len(choices)
+    rows, positions, n_keys = _flatten(choices)
+    if len(rows) == 0:
+        return np.zeros(n_choices, dtype=np.int64)
+    keys = _ChoiceIndex(n_choices)
+    cols = np.fromiter(
+            map(keys.__getitem__, chain.from_iterable(choices)),
+            dtype=np.int64, count=len(rows)
+            )
+    weights = np.fromiter(
+            chain.from_iterable(map(dict.values, choices)),
+            dtype=np.float64, count=len(rows)
+            )
+
+    # highest and lowest weight per vote
+    max_w = np.full(n_votes, -np.inf)
+    np.maximum.at(max_w, rows, weights)
+    min_w = np.full(n_votes, np.inf)
+    np.minimum.at(min_w, rows, weights)
+
+    # first key (in dict order) holding the highest weight
+    first_pos = np.full(n_votes, np.iinfo(np.int64).max)
+    is_max = weights == max_w[rows]
+    np.minimum.at(first_pos, rows[is_max], positions[is_max])
+    top = is_max & (positions == first_pos[rows])
+    top_col = np.full(n_votes, -1, dtype=np.int64)
+    top_col[rows[top]] = cols[top]
+
+    # equal vote for all possible choices -> not counted
+    counted = ~((min_w == max_w) & (n_keys == n_choices))
+    counted &= (top_col >= 0) & (top_col < n_choices)
+    return np.bincount(top_col[counted], minlength=n_choices)
+
+
+def count_ballots(choices):
+    '''
+    Takes a list of approval votes (lists of ints). Counts identical
+    ballots (same choices in the same order). Returns list of tuples
+    (ballot as tuple, count) in order of first appearance.
+    '''
+    if choices == []:
+        return []
+    rows, positions, lengths = _flatten(choices)
+    flat = np.fromiter(
+            chain.from_iterable(choices), dtype=np.int64, count=len(rows)
+            )
+    mat = np.zeros((len(choices), max(int(lengths.max()), 1)), dtype=np.int64)
+    mat[rows, positions] = flat
+
+    # encode each ballot as a single integer if it fits, else compare rows
+    base = int(mat.max()) + 1
+    if mat.shape[1] * np.log2(base) < 62:
+        keys = mat @ (base ** np.arange(mat.shape[1], dtype=np.int64))
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    else:
+        _, first, inverse = np.unique(
+                mat, axis=0, return_index=True, return_inverse=True
+                )
+    counts = np.bincount(inverse.ravel(), minlength=len(first))
+
+    order = np.argsort(first, kind='stable')
+    return [
+        (tuple(choices[first[j]]), int(counts[j]))
+        for j in order
+    ]
+
+
+def instant_runoff(ballots, counts, n_choices):
+    '''
+    Takes distinct rankings (tuples of choices 1..n_choices, most preferred
+    first, as counted by count_ballots) and how often each was cast.
+    Eliminates the choice with the fewest votes round by round, each
+    ranking counting for its most preferred choice still in the race
+    (ties: fewer first preferences, then the higher choice number is
+    eliminated first). The rankings are packed into one int32 matrix
+    once; each round only moves the rankings of the eliminated choice on
+    to their next preference.
+    Returns the full ranking as list of choices: the winner, then the
+    others in reverse order of elimination.
+    '''
+    if n_choices == 0:
+        return []
+
+    # one row per ranking, 0 = no (valid) preference, last column always 0
+    width = max(map(len, ballots), default=0)
+    mat = np.zeros((len(ballots), width + 1), dtype=np.int32)
+    if width > 0:
+        rows, positions, _ = _flatten(ballots)
+        flat = np.fromiter(
+                chain.from_iterable(ballots), dtype=np.int64, count=len(rows)
+                )
+        flat[(flat < 1) | (flat > n_choices)] = 0
+        mat[rows, positions] = flat
+    weights = np.asarray(counts, dtype=np.float64)
+
+    alive = np.ones(n_choices + 1, dtype=bool)
+    alive[0] = False
+    pos = np.zeros(len(mat), dtype=np.int64)
+
+    def advance(rows):
+        '''Moves rows on to their next choice still in the race (or the end).'''
+        while rows.size > 0:
+            stuck = ~alive[mat[rows, pos[rows]]] & (pos[rows] < width)
+            rows = rows[stuck]
+            pos[rows] += 1
+
+    advance(np.arange(len(mat)))
+    top = mat[np.arange(len(mat)), pos]
+    votes = np.bincount(top, weights=weights, minlength=n_choices + 1)
+    first_prefs = votes.copy()
+
+    eliminated = []
+    for _ in range(n_choices - 1):
+        candidates = np.flatnonzero(alive)
+        order = np.lexsort(
+                (-candidates, first_prefs[candidates], votes[candidates])
+                )
+        loser = int(candidates[order[0]])
+        alive[loser] = False
+        eliminated.append(loser)
+
+        # transfer the rankings of the loser
+        moved = np.flatnonzero(top == loser)
+        advance(moved)
+        top[moved] = mat[moved, pos[moved]]
+        votes += np.bincount(top[moved], weights=weights[moved], minlength=n_choices + 1)
+        votes[loser] = 0
+
+    return [int(np.flatnonzero(alive)[0])] + eliminated[::-1]
+
+
+def leader_decided(counts, confidence, look=1, remaining=None, min_votes=30):
+    '''
+    Takes the counts per choice of the votes tallied so far. Returns True
+    if the leading choice is decided: the runner-up can't catch up even if
+    all {remaining} votes still to tally went to it, or the leader's margin
+    over the runner-up is positive at the given confidence (normal bound
+    on the difference of two multinomial shares, from {min_votes} votes
+    on). Meant to be checked after every page: the error allowed at look
+    k is (1 - confidence) / (k * (k + 1)), so the chance of ever stopping
+    on a wrong leader stays below 1 - confidence over all looks.
+    The bound assumes the votes tallied so far are a random sample of all
+    votes. Pages come newest first, so they are a time-ordered prefix and
+    the actual confidence is lower if late votes swing the result.
+    '''
+    counts = np.sort(np.asarray(counts, dtype=np.float64))[::-1]
+    if len(counts) < 2:
+        return True
+    if remaining is not None and counts[0] - counts[1] > remaining:
+        return True
+    n = counts.sum()
+    if confidence is None or n < min_votes:
+        return False
+    p1, p2 = counts[0] / n, counts[1] / n
+    alpha = (1 - confidence) / (look * (look + 1))
+    z = NormalDist().inv_cdf(1 - alpha)
+    return p1 - p2 > z * sqrt((p1 + p2 - (p1 - p2)**2) / n)
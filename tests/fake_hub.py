@@ -0,0 +1,52 @@
+import random
+
+
+ARGS = ('first', 'skip', 'where', 'orderBy', 'orderDirection')
+
+
+class FakeHub:
+    '''
+    Answers the vote queries of functions.py (single or batched under
+    aliases) from a list of in-memory votes, streaming the records of each
+    response in random batches like query_engine.stream_many.
+    '''
+
+    def __init__(self, votes, seed=0):
+        self.votes = votes
+        self.rng = random.Random(seed)
+        self.requests = 0
+
+    def resolve(self, args):
+        where = args['where']
+        votes = self.votes
+        if 'proposal' in where:
+            votes = [v for v in votes if v['proposal']['id'] == where['proposal']]
+        if 'proposal_in' in where:
+            votes = [v for v in votes if v['proposal']['id'] in where['proposal_in']]
+        if 'voter_in' in where:
+            voters = {w.lower() for w in where['voter_in']}
+            votes = [v for v in votes if v['voter'].lower() in voters]
+        if 'created_gte' in where:
+            votes = [v for v in votes if v['created'] >= where['created_gte']]
+        if 'created_lte' in where:
+            votes = [v for v in votes if v['created'] <= where['created_lte']]
+        votes = sorted(votes, key=lambda v: (v['created'], v['id']),
+                       reverse=args['orderDirection'] == 'desc')
+        return votes[args['skip']:args['skip'] + args['first']]
+
+    def stream(self, requests, on_records, kind='other'):
+        for j, payload in enumerate(requests):
+            self.requests += 1
+            roots = {}
+            for var, value in payload['variables'].items():
+                key, arg = var.rsplit('_', 1)
+                assert arg in ARGS
+                roots.setdefault(key, {})[arg] = value
+            for key, args in roots.items():
+                records = self.resolve(args)
+                pos = 0
+                while pos < len(records):
+                    size = self.rng.randint(1, 5)
+                    on_records(j, key, [dict(r) for r in records[pos:pos + size]])
+                    pos += size
+        return [{'data': {key: [] for key in roots}} for _ in requests]
@@ -0,0 +1,62 @@
+import time, types
+
+import daemon
+
+
+class SavedState:
+    '''Stands in for a SyncState loaded from a previous run's file.'''
+
+    def __init__(self):
+        now = int(time.time())
+        self.state = {
+            'full_sync': now,
+            'proposals': {
+                'watermarks': {'a.eth': now, 'b.eth': now},
+                'props': {'p1': ['a.eth', 0, now + 3600], 'p2': ['b.eth', 0, now + 3600]},
+            },
+            'tallies': {'p1': {}, 'p2': {}},
+        }
+        self.calls = {}
+
+    def sync_wallets(self, wallets, due_spaces=None):
+        self.calls['due_spaces'] = due_spaces
+        spaces_d = {'w': {'a.eth', 'b.eth'}}
+        return spaces_d, {'w': {'p1', 'p2'}}, {'w': []}
+
+    def sync_tallies(self, props, due=None):
+        self.calls['due_props'] = due
+        return {p: {} for p in props}
+
+    def save(self):
+        pass
+
+
+def restarted_daemon(monkeypatch):
+    monkeypatch.setattr(daemon, 'load_wallets', lambda path: ['w'])
+    monkeypatch.setattr(daemon, 'select_to_vote',
+                        lambda wallets, voted, spaces, active: {'w': ['p1', 'p2']})
+    monkeypatch.setattr(daemon, 'build_choices', lambda to_vote, data: {})
+    monkeypatch.setattr(daemon, 'finish_pipeline', lambda *args: None)
+    config = types.SimpleNamespace(
+            wallet_path='wallets.txt', export_json_path='to_vote.json',
+            choices_json_path='choices.json', export_csv_path=None,
+            triggers=(), normalized_choices=False, metrics_path=None
+            )
+    d = daemon.Daemon.__new__(daemon.Daemon)
+    d.config, d.state, d.scheduler = config, SavedState(), daemon.PollScheduler()
+    return d
+
+
+def test_first_cycle_after_restart_syncs_saved_state(monkeypatch):
+    d = restarted_daemon(monkeypatch)
+    d.cycle()
+    assert d.state.calls['due_spaces'] == {'a.eth', 'b.eth'}
+    assert d.state.calls['due_props'] == {'p1', 'p2'}
+
+
+def test_second_cycle_waits_for_schedule(monkeypatch):
+    d = restarted_daemon(monkeypatch)
+    d.cycle()
+    d.cycle()
+    assert d.state.calls['due_spaces'] == set()
+    assert d.state.calls['due_props'] == set()
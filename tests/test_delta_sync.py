@@ -0,0 +1,78 @@
+import types
+
+import pytest
+
+import delta_sync, functions
+from delta_sync import SyncState
+from fake_hub import FakeHub
+
+
+T0 = 1_700_000_000
+
+
+class Clock:
+    def __init__(self):
+        self.now = T0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def env(monkeypatch, tmp_path):
+    clock, votes = Clock(), []
+    monkeypatch.setattr(delta_sync, 'time', types.SimpleNamespace(time=clock.time))
+    monkeypatch.setattr(functions, 'json_stream_queries', FakeHub(votes).stream)
+
+    def vote(wallet, prop, created):
+        # the hub returns checksummed addresses
+        votes.append({'id': f'{wallet}-{prop}', 'voter': wallet.upper(),
+                      'created': created, 'proposal': {'id': prop}})
+
+    state = SyncState(str(tmp_path / 'sync_state.json'))
+    # proposals open for a day (see sync_proposals)
+    state.state['proposals']['props'] = {
+        p: ['space.eth', T0 - 3600, T0 + 24 * 3600] for p in ('p1', 'p2', 'p3')
+    }
+    return types.SimpleNamespace(clock=clock, vote=vote, state=state)
+
+
+def test_joined_space_is_looked_up_in_full(env):
+    env.vote('0xa', 'p1', T0 - 10)
+    assert env.state.sync_voted({'0xa': {'p1'}}) == {'0xa': ['p1']}
+
+    # the wallet voted on p2 long before it followed p2's space
+    env.clock.now += 3600
+    env.vote('0xa', 'p2', T0 - 3600)
+    voted = env.state.sync_voted({'0xa': {'p1', 'p2'}})
+    assert sorted(voted['0xa']) == ['p1', 'p2']
+
+
+def test_new_proposal_and_delta_votes(env):
+    env.state.sync_voted({'0xa': {'p1'}, '0xb': {'p1'}})
+
+    # p3 shows up late (its space wasn't due), b voted on it before the last sync
+    env.clock.now += 3600
+    env.vote('0xb', 'p3', T0 - 600)
+    env.vote('0xa', 'p1', T0 + 3000)
+    voted = env.state.sync_voted({'0xa': {'p1', 'p3'}, '0xb': {'p1', 'p3'}})
+    assert voted == {'0xa': ['p1'], '0xb': ['p3']}
+
+
+def test_prune_removed_wallet_and_ended_proposals(env):
+    env.vote('0xa', 'p1', T0 - 10)
+    env.state.sync_voted({'0xa': {'p1', 'p2'}, '0xb': {'p2'}})
+
+    # p1 ended, b isn't tracked anymore
+    env.clock.now += 3600
+    del env.state.state['proposals']['props']['p1']
+    env.state.sync_voted({'0xa': {'p2'}})
+    voted = env.state.state['voted']
+    assert voted['props'] == {'0xa': []}
+    assert voted['checked'] == {'0xa': ['p2']}
+
+    # b voted while it wasn't tracked, comes back and is looked up in full
+    env.vote('0xb', 'p2', T0 + 1000)
+    env.clock.now += 3600
+    voted = env.state.sync_voted({'0xa': {'p2'}, '0xb': {'p2'}})
+    assert voted == {'0xa': [], '0xb': ['p2']}
@@ -0,0 +1,84 @@
+import json, random
+
+import pytest
+
+from json_stream import RecordStream
+
+
+def random_record(rng, i):
+    text = ''.join(rng.choice('ab ]}[{,:"\\é€😀') for _ in range(rng.randint(0, 12)))
+    return {'id': f'0x{i:04x}', 'created': rng.randint(0, 5), 'choice': text,
+            'nested': {'list': [rng.random(), None, True]}}
+
+
+def random_response(rng):
+    data = {}
+    for k in range(rng.randint(1, 4)):
+        kind = rng.random()
+        if kind < 0.7:
+            value = [random_record(rng, rng.randrange(10**4))
+                     for _ in range(rng.randint(0, 30))]
+        elif kind < 0.85:
+            value = None
+        else:
+            value = {'id': 'single', 'title': 'x'}
+        data[f'q{k}_0'] = value
+    response = {'data': data}
+    if rng.random() < 0.1:
+        response = {'data': None, 'errors': [{'message': 'bad [query]'}]}
+    return response
+
+
+def dumps(rng, response):
+    style = rng.choice([{}, {'indent': 2}, {'separators': (',', ':')},
+                        {'ensure_ascii': False}])
+    return json.dumps(response, **style).encode('utf-8')
+
+
+def decode(raw, rng):
+    '''Feeds raw to a RecordStream in random chunks.'''
+    stream = RecordStream()
+    groups, pos = [], 0
+    while pos < len(raw):
+        size = rng.randint(1, 64)
+        groups += stream.feed(raw[pos:pos + size])
+        pos += size
+    rest, doc = stream.close()
+    return groups + rest, doc
+
+
+@pytest.mark.parametrize('seed', range(300))
+def test_matches_json_loads(seed):
+    rng = random.Random(seed)
+    response = random_response(rng)
+    raw = dumps(rng, response)
+    expected = json.loads(raw)
+
+    groups, doc = decode(raw, rng)
+
+    records = {}
+    for key, batch in groups:
+        records.setdefault(key, []).extend(batch)
+    data = expected.get('data') or {}
+    assert records == {k: v for k, v in data.items() if isinstance(v, list) and v != []}
+
+    if isinstance(expected.get('data'), dict):
+        for key, value in expected['data'].items():
+            if isinstance(value, list):
+                expected['data'][key] = []
+    assert doc == expected
+
+
+def test_incomplete_response_raises():
+    raw = json.dumps({'data': {'votes': [{'id': 'a'}, {'id': 'b'}]}}).encode()
+    stream = RecordStream()
+    stream.feed(raw[:-8])
+    with pytest.raises(ValueError):
+        stream.close()
+
+
+def test_not_json_raises():
+    stream = RecordStream()
+    stream.feed(b'<html>403 Forbidden</html>')
+    with pytest.raises(ValueError):
+        stream.close()
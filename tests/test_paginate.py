@@ -0,0 +1,92 @@
+import random
+
+import pytest
+
+import functions
+from functions import paginate_queries, prop_votes_query
+from fake_hub import FakeHub
+
+
+def make_votes(n_props, seed):
+    rng = random.Random(seed)
+    votes = {}
+    for p in range(n_props):
+        # few distinct timestamps -> many pages share one timestamp
+        votes[f'prop{p}'] = [
+            {'id': f'prop{p}-vote{i}', 'created': rng.randint(0, 6), 'choice': 1}
+            for i in range(rng.randint(0, 80))
+        ]
+    return votes
+
+
+@pytest.fixture
+def hub(monkeypatch):
+    def install(votes, seed=0):
+        fake = FakeHub([
+            dict(v, proposal={'id': p}) for p, vs in votes.items() for v in vs
+        ], seed)
+        monkeypatch.setattr(functions, 'json_stream_queries', fake.stream)
+        return fake
+    return install
+
+
+@pytest.mark.parametrize('descending', [False, True])
+@pytest.mark.parametrize('batch_size', [None, 1, 3])
+@pytest.mark.parametrize('page_size', [1, 4, 7, 1000])
+def test_all_records_exactly_once(hub, descending, batch_size, page_size):
+    votes = make_votes(5, seed=page_size)
+    hub(votes, seed=page_size)
+    props = sorted(votes)
+
+    results = paginate_queries(
+            [prop_votes_query(p, descending=descending) for p in props],
+            'votes', page_size=page_size, descending=descending,
+            batch_size=batch_size
+            )
+
+    for prop, records in zip(props, results):
+        ids = [r['id'] for r in records]
+        assert len(ids) == len(set(ids))
+        assert set(ids) == {v['id'] for v in votes[prop]}
+        created = [r['created'] for r in records]
+        assert created == sorted(created, reverse=descending)
+
+
+def test_single_timestamp_pages(hub):
+    votes = {'prop0': [{'id': f'v{i:02d}', 'created': 5, 'choice': 1} for i in range(23)]}
+    hub(votes)
+    results = paginate_queries([prop_votes_query('prop0')], 'votes',
+                               page_size=5, descending=True)
+    assert sorted(r['id'] for r in results[0]) == sorted(v['id'] for v in votes['prop0'])
+
+
+def test_page_done_once_per_full_page(hub):
+    votes = make_votes(4, seed=1)
+    props = sorted(votes)
+
+    def run(batch_size, seed):
+        hub(votes, seed=seed)
+        received = {i: 0 for i in range(len(props))}
+        done = []
+
+        def on_page(i, records):
+            received[i] += len(records)
+
+        def page_done(i):
+            done.append((i, received[i]))
+            return received[i] < 20
+
+        paginate_queries(
+                [prop_votes_query(p) for p in props], 'votes', page_size=6,
+                descending=True, on_page=on_page, batch_size=batch_size,
+                page_done=page_done
+                )
+        return sorted(done), received
+
+    # same looks and stop points however the pages are split and batched
+    assert run(None, 0) == run(2, 1) == run(4, 2)
+    # nothing is passed on after page_done returned False
+    done, received = run(None, 0)
+    for i, count in done:
+        if count >= 20:
+            assert received[i] == count
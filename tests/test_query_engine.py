@@ -0,0 +1,122 @@
+import asyncio, json, threading
+
+import pytest
+from aiohttp import web
+
+import functions
+import query_engine
+from functions import paginate_queries, prop_votes_query
+
+
+class LocalHub:
+    '''
+    aiohttp server on a background thread answering every request with
+    the next of the given responses (status, body bytes), repeating the
+    last one.
+    '''
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+
+    async def _start(self):
+        app = web.Application()
+        app.router.add_post('/graphql', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://127.0.0.1:{port}/graphql'
+
+    async def handle(self, request):
+        await request.read()
+        status, body = self.responses[min(self.requests, len(self.responses) - 1)]
+        self.requests += 1
+        return web.Response(status=status, body=body, content_type='text/html')
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+@pytest.fixture
+def local_hub(monkeypatch):
+    monkeypatch.setattr(query_engine, 'BACKOFF_BASE', 0.001)
+    hubs = []
+
+    def start(responses):
+        hub = LocalHub(responses)
+        hubs.append(hub)
+        query_engine.configure(url=hub.url)
+        return hub
+
+    yield start
+    query_engine.configure(url=query_engine.HUB_URL)
+    for hub in hubs:
+        hub.close()
+
+
+VOTES = {'data': {'votes': [
+    {'id': f'v{i}', 'created': 100 - i, 'choice': 1} for i in range(3)
+]}}
+BAD_BYTES = b'\xff\xfe<html>403 Forbidden</html>'
+
+
+def test_stream_retries_bad_bytes(local_hub):
+    hub = local_hub([(403, BAD_BYTES), (200, BAD_BYTES),
+                     (200, json.dumps(VOTES).encode())])
+    results = paginate_queries([prop_votes_query('p')], 'votes', page_size=10,
+                               descending=True)
+    assert [r['id'] for r in results[0]] == ['v0', 'v1', 'v2']
+    assert hub.requests == 3
+
+
+def test_stream_gives_up_after_retries(local_hub):
+    hub = local_hub([(403, BAD_BYTES)])
+    with pytest.raises(ConnectionError):
+        paginate_queries([prop_votes_query('p')], 'votes', page_size=10)
+    assert hub.requests == query_engine.MAX_RETRIES + 1
+
+
+def test_query_retries_html_page(local_hub):
+    hub = local_hub([(403, b'<html>blocked</html>'), (200, json.dumps(VOTES).encode())])
+    assert functions.json_from_query('{ votes { id } }') == VOTES
+    assert hub.requests == 2
+
+
+def released(outcome, window=4.0, rate=8.0):
+    '''Returns (window, rate) of a limiter after one request with outcome.'''
+    async def run():
+        limiter = query_engine.AdaptiveLimiter(rate=16, concurrency=16)
+        limiter.window, limiter.rate = window, rate
+        await limiter.acquire()
+        await limiter.release(outcome)
+        return limiter.window, limiter.rate
+    return asyncio.run(run())
+
+
+def test_limiter_grows_on_answer():
+    window, rate = released(query_engine.OK)
+    assert window == pytest.approx(4.25) and rate == pytest.approx(8.125)
+
+
+def test_limiter_halves_on_congestion():
+    assert released(query_engine.CONGESTED) == (2.0, 4.0)
+
+
+def test_limiter_unchanged_on_failure():
+    assert released(query_engine.FAILED) == (4.0, 8.0)
+
+
+def test_server_errors_slow_down(local_hub):
+    local_hub([(502, b'Bad Gateway'), (200, json.dumps(VOTES).encode())])
+    functions.json_from_query('{ votes { id } }')
+    limiter = query_engine.get_engine()._limiter
+    assert limiter.window < query_engine.CONCURRENCY
+    assert limiter.rate < query_engine.RATE_LIMIT
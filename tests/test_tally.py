@@ -0,0 +1,212 @@
+import random
+
+import numpy as np
+import pytest
+
+from functions import quadratic_voting_get_most_popular, VoteTally
+from tally import (
+        instant_runoff, count_single_choice, count_top_weighted, count_ballots,
+        leader_decided
+        )
+
+
+def brute_force_runoff(ballots, counts, n_choices):
+    '''Instant runoff recounting every ballot from scratch each round.'''
+    alive = set(range(1, n_choices + 1))
+
+    def top(ballot):
+        for choice in ballot:
+            if choice in alive:
+                return choice
+        return None
+
+    def tally():
+        votes = dict.fromkeys(alive, 0)
+        for ballot, count in zip(ballots, counts):
+            choice = top(ballot)
+            if choice is not None:
+                votes[choice] += count
+        return votes
+
+    first_prefs = tally()
+    eliminated = []
+    while len(alive) > 1:
+        votes = tally()
+        loser = min(alive, key=lambda c: (votes[c], first_prefs[c], -c))
+        alive.remove(loser)
+        eliminated.append(loser)
+    return list(alive) + eliminated[::-1]
+
+
+def random_election(rng):
+    n_choices = rng.randint(1, 7)
+    ballots = set()
+    for _ in range(rng.randint(0, 25)):
+        length = rng.randint(0, n_choices + 1)
+        # mostly valid rankings, some with unknown choices or repeats
+        ballot = rng.sample(range(1, n_choices + 1), min(length, n_choices))
+        if rng.random() < 0.2:
+            ballot.insert(rng.randint(0, len(ballot)), rng.choice([0, n_choices + 1, 99]))
+        if rng.random() < 0.1 and ballot:
+            ballot.append(ballot[0])
+        ballots.add(tuple(ballot))
+    ballots = sorted(ballots)
+    counts = [rng.randint(1, 4) for _ in ballots]
+    return ballots, counts, n_choices
+
+
+@pytest.mark.parametrize('seed', range(1000))
+def test_instant_runoff_matches_brute_force(seed):
+    ballots, counts, n_choices = random_election(random.Random(seed))
+    assert instant_runoff(ballots, counts, n_choices) == \
+        brute_force_runoff(ballots, counts, n_choices)
+
+
+def test_instant_runoff_transfers():
+    # 3 is eliminated first, its ballots go to 2, which then beats 1
+    ballots = [(1, 2, 3), (2, 1, 3), (3, 2, 1)]
+    counts = [4, 3, 2]
+    assert instant_runoff(ballots, counts, 3) == [2, 1, 3]
+
+
+def test_instant_runoff_no_ballots():
+    assert instant_runoff([], [], 3) == [1, 2, 3]
+    assert instant_runoff([], [], 0) == []
+
+
+# -- vectorized counts vs. the per-vote loop they replaced -----------------
+
+def loop_single_choice(choices, n_choices):
+    counts = [0] * n_choices
+    outsiders = []
+    for choice in choices:
+        if 1 <= choice <= n_choices:
+            counts[choice - 1] += 1
+        else:
+            outsiders.append(choice)
+    return counts, outsiders
+
+
+def loop_top_weighted(choices, n_choices):
+    choices_d = {i + 1: 0 for i in range(n_choices)}
+    for choice in choices:
+        highest = quadratic_voting_get_most_popular(choice, choices_d)
+        if highest is not None:
+            choices_d[highest] += 1
+    return list(choices_d.values())
+
+
+def loop_ballots(choices):
+    approvals = {}
+    for choice in choices:
+        approvals[tuple(choice)] = approvals.get(tuple(choice), 0) + 1
+    return list(approvals.items())
+
+
+@pytest.mark.parametrize('seed', range(400))
+def test_count_single_choice_matches_loop(seed):
+    rng = random.Random(seed)
+    n_choices = rng.randint(1, 8)
+    choices = [rng.randint(-1, n_choices + 2) for _ in range(rng.randint(0, 200))]
+    counts, outsiders = count_single_choice(choices, n_choices)
+    assert (counts.tolist(), outsiders) == loop_single_choice(choices, n_choices)
+
+
+@pytest.mark.parametrize('seed', range(400))
+def test_count_top_weighted_matches_loop(seed):
+    rng = random.Random(seed)
+    n_choices = rng.randint(1, 6)
+    weight = (lambda: rng.randint(0, 3)) if seed % 2 else (lambda: rng.random())
+    choices = []
+    for _ in range(rng.randint(0, 100)):
+        keys = rng.sample(range(1, n_choices + 1), rng.randint(1, n_choices))
+        choices.append({str(k): weight() for k in keys})
+    assert count_top_weighted(choices, n_choices).tolist() == \
+        loop_top_weighted(choices, n_choices)
+
+
+@pytest.mark.parametrize('seed', range(400))
+def test_count_ballots_matches_loop(seed):
+    rng = random.Random(seed)
+    # large choice numbers don't fit the integer encoding of the rows
+    top = rng.choice([5, 10**6])
+    pool = [[rng.randint(1, top) for _ in range(rng.randint(0, 5))]
+            for _ in range(rng.randint(1, 10))]
+    choices = [list(rng.choice(pool)) for _ in range(rng.randint(0, 100))]
+    assert count_ballots(choices) == loop_ballots(choices)
+
+
+@pytest.mark.parametrize('prop_type', ['single-choice', 'approval', 'quadratic'])
+def test_tally_independent_of_paging(prop_type):
+    rng = random.Random(prop_type)
+    meta = {'id': 'p', 'title': 't', 'choices': ['a', 'b', 'c', 'd'],
+            'start': 0, 'type': prop_type, 'space': {'id': 's'}}
+    votes = []
+    for i in range(300):
+        if prop_type == 'single-choice':
+            choice = rng.randint(1, 4)
+        elif prop_type == 'approval':
+            choice = rng.sample(range(1, 5), rng.randint(1, 3))
+        else:
+            choice = {str(k): rng.randint(1, 3) for k in rng.sample(range(1, 5), 2)}
+        votes.append({'id': f'v{i}', 'created': i // 7, 'choice': choice})
+
+    whole = VoteTally(meta)
+    whole.add(votes)
+    paged = VoteTally(meta)
+    pos = 0
+    while pos < len(votes):
+        size = rng.randint(1, 40)
+        paged.add(votes[pos:pos + size])
+        pos += size
+    assert paged.to_dict() == whole.to_dict()
+    assert paged.result('p') == whole.result('p')
+
+
+def test_leader_decided_clear_leader():
+    assert leader_decided([900, 100], 0.99)
+    assert leader_decided([100, 900, 50], 0.99, look=10)
+
+
+@pytest.mark.parametrize('look', [1, 2, 5, 20])
+@pytest.mark.parametrize('counts', [[500, 500], [505, 495], [40, 38, 20]])
+def test_leader_decided_close_race_goes_on(counts, look):
+    assert not leader_decided(counts, 0.99, look=look)
+
+
+def test_leader_decided_choices():
+    # k = 1: nothing to decide, k = 2 below min_votes: only remaining decides
+    assert leader_decided([7], 0.99)
+    assert not leader_decided([20, 0], 0.99)
+    assert leader_decided([20, 0], 0.99, remaining=19)
+    assert not leader_decided([20, 0], 0.99, remaining=20)
+    assert not leader_decided([900, 100], None)
+
+
+def false_stop_rate(confidence, corrected, runs=2000, seed=0):
+    '''
+    Share of simulated tallies of an exact tie that stop on the second
+    choice, checking after pages of 100 votes, doubled on every page as in
+    tally_votes_many. Votes arrive in random order.
+    '''
+    rng = np.random.default_rng(seed)
+    budget, wrong = 3200, 0
+    for _ in range(runs):
+        first = np.cumsum(rng.random(budget) < 0.5)
+        n, page, look = 0, 100, 1
+        while n < budget:
+            n, page = min(budget, n + page), page * 2
+            a, b = int(first[n - 1]), n - int(first[n - 1])
+            if leader_decided([a, b], confidence, look if corrected else 1):
+                wrong += b > a
+                break
+            look += 1
+    return wrong / runs
+
+
+@pytest.mark.parametrize('confidence', [0.9, 0.98])
+def test_leader_decided_false_stop_rate(confidence):
+    target = 1 - confidence
+    assert target / 4 < false_stop_rate(confidence, True) <= target
+    # without the correction for the repeated looks, the target is missed
+    assert false_stop_rate(confidence, False) > target
@@ -0,0 +1,77 @@
+import types
+
+import pytest
+
+import functions, vote_store
+from fake_hub import FakeHub
+from vote_store import VoteStore
+
+
+T0 = 1_700_000_000
+
+
+class Clock:
+    def __init__(self):
+        self.now = T0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def env(monkeypatch, tmp_path):
+    clock, votes = Clock(), []
+    monkeypatch.setattr(vote_store, 'time', types.SimpleNamespace(time=clock.time))
+    monkeypatch.setattr(functions, 'json_stream_queries', FakeHub(votes).stream)
+
+    def vote(wallet, prop, created):
+        # the hub returns checksummed addresses
+        votes.append({'id': f'{wallet}-{prop}', 'voter': wallet.upper(),
+                      'created': created, 'proposal': {'id': prop}})
+
+    store = VoteStore(str(tmp_path / 'votes.db'))
+    yield types.SimpleNamespace(clock=clock, vote=vote, store=store)
+    store.close()
+
+
+def rows(store, table):
+    return set(store.con.execute(f'SELECT wallet, proposal FROM {table}'))
+
+
+def test_joined_space_is_looked_up_in_full(env):
+    env.vote('0xa', 'p1', T0 - 10)
+    assert env.store.sync({'0xa': ['p1']}) == {'0xa': ['p1']}
+
+    # the wallet voted on p2 long before it followed p2's space
+    env.clock.now += 3600
+    env.vote('0xa', 'p2', T0 - 3600)
+    assert env.store.sync({'0xa': ['p1', 'p2']}) == {'0xa': ['p1', 'p2']}
+
+
+def test_new_proposal_and_delta_votes(env):
+    env.store.sync({'0xa': ['p1'], '0xb': ['p1']})
+
+    # p3 shows up late (its space wasn't due), b voted on it before the last sync
+    env.clock.now += 3600
+    env.vote('0xb', 'p3', T0 - 600)
+    env.vote('0xa', 'p1', T0 + 3000)
+    voted = env.store.sync({'0xa': ['p1', 'p3'], '0xb': ['p1', 'p3']})
+    assert voted == {'0xa': ['p1'], '0xb': ['p3']}
+
+
+def test_prune_removed_wallet_and_ended_proposals(env):
+    env.vote('0xa', 'p1', T0 - 10)
+    env.vote('0xb', 'p1', T0 - 10)
+    env.store.sync({'0xa': ['p1', 'p2'], '0xb': ['p1']})
+
+    # p1 ended, b isn't tracked anymore
+    env.clock.now += 3600
+    env.store.sync({'0xa': ['p2']})
+    assert rows(env.store, 'votes') == set()
+    assert rows(env.store, 'checked') == {('0xa', 'p2')}
+    assert {w for w, in env.store.con.execute('SELECT wallet FROM wallets')} == {'0xa'}
+
+    # b comes back and is looked up in full
+    env.clock.now += 3600
+    env.vote('0xb', 'p2', T0 + 1000)
+    assert env.store.sync({'0xa': ['p2'], '0xb': ['p2']}) == {'0xa': [], '0xb': ['p2']}
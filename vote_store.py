@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Indexed local store of the votes the wallets have cast on open proposals
+"""
+
+import json, os, sqlite3, time
+from functions import (
+        chunks, paginate_queries, voted_matrix_query, already_voted_many,
+        cond_log, WALLET_CHUNK
+        )
+
+
+FULL_SYNC_EVERY = 24 * 3600   # seconds until all wallets are looked up in full again
+MARGIN = 60                   # seconds of overlap between two syncs
+
+
+class VoteStore:
+    '''
+    SQLite-backed history of (wallet, proposal) votes, replacing
+    already_voted.json. Votes are keyed by (wallet, proposal), so checks
+    are index lookups, and votes on proposals that are no longer open are
+    pruned on every sync, so the store only grows with the open proposals.
+    Each wallet remembers when its votes were last synced and which
+    proposals they were checked against: later syncs only ask the hub
+    for votes cast since then, plus all votes on proposals new to the
+    wallet (see sync).
+
+    store = VoteStore('./vote_history.db')
+    voted_d = store.sync({wallet: active proposals, ...})
+    '''
+
+    def __init__(self, path, full_sync_every=FULL_SYNC_EVERY):
+        self.path = path
+        self.full_sync_every = full_sync_every
+        self.con = sqlite3.connect(path, timeout=30)
+        self.con.executescript('''
+            CREATE TABLE IF NOT EXISTS votes (
+                wallet TEXT NOT NULL,
+                proposal TEXT NOT NULL,
+                PRIMARY KEY (wallet, proposal)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS votes_proposal ON votes (proposal);
+            CREATE TABLE IF NOT EXISTS checked (
+                wallet TEXT NOT NULL,
+                proposal TEXT NOT NULL,
+                PRIMARY KEY (wallet, proposal)
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS wallets (
+                wallet TEXT PRIMARY KEY,
+                synced INTEGER NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value
+            );''')
+        self.con.commit()
+
+    def _meta(self, key, default=None):
+        row = self.con.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def _set_meta(self, key, value):
+        self.con.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+
+    def add_many(self, pairs):
+        '''Stores an iterable of (wallet, proposal) votes.'''
+        self.con.executemany('INSERT OR IGNORE INTO votes VALUES (?, ?)', pairs)
+        self.con.commit()
+
+    def has_voted(self, wallet, proposal):
+        return self.con.execute(
+                'SELECT 1 FROM votes WHERE wallet = ? AND proposal = ?',
+                (wallet, proposal)
+                ).fetchone() is not None
+
+    def _pairs(self, table, wallets):
+        '''
+        Returns set of the (wallet, proposal) pairs of the given wallets in
+        table, looked up {WALLET_CHUNK} wallets at a time.
+        '''
+        pairs = set()
+        for chunk in chunks(wallets, WALLET_CHUNK):
+            pairs.update(self.con.execute(
+                    f'SELECT wallet, proposal FROM {table} WHERE wallet IN (%s)'
+                    % ','.join('?' * len(chunk)), chunk
+                    ))
+        return pairs
+
+    def voted_many(self, wallet_props):
+        '''
+        Takes a dict of shape {wallet: proposals, ...}. Returns dict of shape
+        {wallet: [prop_id, ...], ...} with the proposals each wallet has
+        voted on.
+        '''
+        voted = self._pairs('votes', wallet_props)
+        return {
+            wallet: [p for p in props if (wallet, p) in voted]
+            for wallet, props in wallet_props.items()
+        }
+
+    def prune(self, open_props, wallets):
+        '''
+        Deletes votes on proposals that aren't open anymore and forgets
+        wallets that aren't tracked anymore (they are synced in full if
+        they come back).
+        '''
+        con = self.con
+        for table, column, keep in [('votes', 'proposal', open_props),
+                                    ('checked', 'proposal', open_props),
+                                    ('checked', 'wallet', wallets),
+                                    ('wallets', 'wallet', wallets)]:
+            con.execute('CREATE TEMP TABLE IF NOT EXISTS keep (id TEXT PRIMARY KEY)')
+            con.execute('DELETE FROM keep')
+            con.executemany('INSERT OR IGNORE INTO keep VALUES (?)', ((x,) for x in keep))
+            con.execute(f'DELETE FROM {table} WHERE {column} NOT IN (SELECT id FROM keep)')
+        con.execute('DROP TABLE keep')
+        con.commit()
+
+    def import_json(self, json_path):
+        '''
+        Adds the votes of an already_voted.json of shape
+        {wallet: [prop_id, ...], ...}, if it changed since the last import.
+        '''
+        if not os.path.isfile(json_path):
+            return
+        mtime = os.path.getmtime(json_path)
+        if self._meta('json_mtime', 0) >= mtime:
+            return
+        with open(json_path, 'r') as jfile:
+            data = json.load(jfile)
+        self.add_many((w, p) for w, props in data.items() for p in props)
+        self._set_meta('json_mtime', mtime)
+        self.con.commit()
+        cond_log(f'Imported {json_path.strip("./")} into the vote history.')
+
+    def sync(self, wallet_props):
+        '''
+        Takes a dict of shape {wallet: open proposals, ...}. Brings the votes
+        of all wallets on these proposals up to date and returns them as
+        dict of shape {wallet: [prop_id, ...], ...} (see voted_many).
+        Wallets new to the store, and proposals a wallet hasn't been
+        checked against yet (e.g. of a space it just followed), are looked
+        up in full. Otherwise only votes cast since the wallet's last sync
+        are queried. Everything is looked up in full again every
+        {full_sync_every} seconds.
+        '''
+        now = int(time.time())
+        wallet_props = {w: sorted(props) for w, props in wallet_props.items()}
+        if now - self._meta('full_sync', 0) > self.full_sync_every:
+            self.con.execute('DELETE FROM wallets')
+            self.con.execute('DELETE FROM checked')
+            self._set_meta('full_sync', now)
+
+        synced = {}
+        for chunk in chunks(wallet_props, WALLET_CHUNK):
+            synced.update(self.con.execute(
+                    'SELECT wallet, synced FROM wallets WHERE wallet IN (%s)'
+                    % ','.join('?' * len(chunk)), chunk
+                    ))
+        checked = self._pairs('checked', synced)
+        new, known = {}, {}
+        for wallet, props in wallet_props.items():
+            fresh = [p for p in props if (wallet, p) not in checked]
+            if wallet not in synced or fresh == props:
+                new[wallet] = props
+            else:
+                new[wallet] = fresh
+                known[wallet] = [p for p in props if (wallet, p) in checked]
+        new = {w: props for w, props in new.items() if props != []}
+
+        pairs = []
+        if new != {}:
+            for wallet, props in already_voted_many(new).items():
+                pairs += [(wallet, p) for p in props]
+
+        if known != {}:
+            cursor = min(synced[w] for w in known) - MARGIN
+            props = sorted(set().union(*known.values()))
+            wallet_chunks = chunks(known, WALLET_CHUNK)
+            lower_d = {w.lower(): w for w in known}
+            results = paginate_queries(
+                    [voted_matrix_query(chunk, props) for chunk in wallet_chunks],
+                    'votes', cursors=[cursor] * len(wallet_chunks), kind='voted'
+                    )
+            for records in results:
+                pairs += [
+                    (lower_d[v['voter'].lower()], v['proposal']['id'])
+                    for v in records
+                ]
+
+        self.add_many(pairs)
+        self.con.executemany(
+                'INSERT OR IGNORE INTO checked VALUES (?, ?)',
+                ((w, p) for w, props in new.items() for p in props)
+                )
+        self.con.executemany(
+                'INSERT OR REPLACE INTO wallets VALUES (?, ?)',
+                ((w, now) for w in wallet_props)
+                )
+        self.prune(set().union(*wallet_props.values()), wallet_props)
+        return self.voted_many(wallet_props)
+
+    def close(self):
+        self.con.close()